@@ -1,21 +1,72 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+import logging
+import time
+from datetime import date, timedelta
+
+from fastapi import FastAPI, Body, Depends, HTTPException, Query, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from sqlalchemy import delete, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from typing import List
-
-from database import get_db, engine
+from typing import Any, List, Literal, Optional, Union
+
+from config import settings
+from database import get_db, engine, migrate_on_startup, pool_monitor
+import migrations
+import population_stats
+import queries
+from reference_ranges import ABNORMAL_FLAGS, reference_cache, flag_expression
+import batch
+from cache import CACHE_STATUS_HEADER, response_cache
+import downsample
+import export
+import lab_matrix
+import latest
+import metrics
+import mutations
+import projection
+import search
+import slow_queries
+import subjective_metrics
+import versioning
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, NEXT_CURSOR_HEADER, keyset_page, finish_page
 from models import (
-    Base, Patient, LabTestDefinition, LabResult, 
+    search_key, Patient, LabTestDefinition, LabResult, 
     BioimpedanceEntry, AnthropometryEntry, SubjectiveEntry
 )
 from schemas import (
     PatientCreate, PatientUpdate, Patient as PatientSchema,
     LabTestDefinitionCreate, LabTestDefinitionUpdate, LabTestDefinition as LabTestDefinitionSchema,
-    LabResultCreate, LabResultUpdate, LabResult as LabResultSchema,
+    LabResultCreate, LabResultUpdate, LabResult as LabResultSchema, LabAlert as LabAlertSchema,
     BioimpedanceEntryCreate, BioimpedanceEntryUpdate, BioimpedanceEntry as BioimpedanceEntrySchema,
     AnthropometryEntryCreate, AnthropometryEntryUpdate, AnthropometryEntry as AnthropometryEntrySchema,
-    SubjectiveEntryCreate, SubjectiveEntryUpdate, SubjectiveEntry as SubjectiveEntrySchema
+    SubjectiveEntryCreate, SubjectiveEntryUpdate, SubjectiveEntry as SubjectiveEntrySchema,
+    PatientDashboard as PatientDashboardSchema, BatchResult, SeriesBucket, PopulationStats,
+    PatientLatest as PatientLatestSchema, SubjectivePivot as SubjectivePivotSchema, LabResultMatrix,
+)
+
+logger = logging.getLogger(__name__)
+
+# Per-patient series are paginated too, newest first; one page covers years of visits
+SERIES_PAGE_SIZE = 500
+
+# Default look-back of the abnormal-result worklist
+ALERT_WINDOW_DAYS = 30
+
+# List endpoints select just the response schema's columns (see projection.py)
+PATIENT_COLUMNS = projection.columns(PatientSchema, Patient)
+LAB_DEFINITION_COLUMNS = projection.columns(LabTestDefinitionSchema, LabTestDefinition)
+LAB_RESULT_COLUMNS = projection.columns(LabResultSchema, LabResult)
+BIOIMPEDANCE_COLUMNS = projection.columns(BioimpedanceEntrySchema, BioimpedanceEntry)
+ANTHROPOMETRY_COLUMNS = projection.columns(AnthropometryEntrySchema, AnthropometryEntry)
+SUBJECTIVE_COLUMNS = projection.columns(SubjectiveEntrySchema, SubjectiveEntry)
+SUBJECTIVE_RETURNING = subjective_metrics.returning(SUBJECTIVE_COLUMNS)
+
+# The columns population statistics are computed from (see population_stats.py)
+LAB_SAMPLE_COLUMNS = (LabResult.patient_id, LabResult.test_definition_id, LabResult.collection_date, LabResult.value)
+BIOIMPEDANCE_SAMPLE_COLUMNS = (
+    BioimpedanceEntry.patient_id, BioimpedanceEntry.date,
+    *(getattr(BioimpedanceEntry, metric) for metric in population_stats.BIOIMPEDANCE_METRICS),
 )
 
 app = FastAPI(title="Medical Dashboard API")
@@ -32,115 +83,356 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],              
     allow_headers=["*"], 
+    expose_headers=[
+        "Server-Timing", NEXT_CURSOR_HEADER, "ETag", "Last-Modified", CACHE_STATUS_HEADER,
+        metrics.STATEMENTS_HEADER, metrics.DB_TIME_HEADER,
+    ],
 )             
 
+# Per-route request counts, latency and DB time, served at /metrics
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.instrument_engine(engine)
+slow_queries.instrument_engine(engine)
+
 @app.on_event("startup")
 async def startup():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    if migrate_on_startup:
+        await migrations.run()
+
+# --- Health ---
+
+@app.get("/health/db")
+async def read_db_health():
+    """Connection pool sizing and checkout wait statistics."""
+    return pool_monitor.stats(engine)
+
+@app.get("/health/cache")
+async def read_cache_health():
+    """Response cache hit/miss/eviction counters and memory use."""
+    return response_cache.stats()
+
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics():
+    """Prometheus scrape endpoint."""
+    return Response(metrics.render(metrics.registry, pool_monitor.stats(engine)), media_type=metrics.CONTENT_TYPE)
 
 # --- Patients ---
 
 @app.post("/patients/", response_model=PatientSchema, status_code=status.HTTP_201_CREATED)
 async def create_patient(patient: PatientCreate, db: AsyncSession = Depends(get_db)):
-    db_patient = Patient(**patient.model_dump())
-    db.add(db_patient)
+    db_patient = await mutations.insert_returning(db, Patient, patient.model_dump(), *PATIENT_COLUMNS)
     await db.commit()
-    await db.refresh(db_patient)
-    return db_patient
+    return db_patient._asdict()
 
 @app.get("/patients/", response_model=List[PatientSchema])
-async def read_patients(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(Patient).offset(skip).limit(limit))
-    return result.scalars().all()
-
-@app.get("/patients/{patient_id}", response_model=PatientSchema)
+async def read_patients(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_db),
+):
+    keys = (Patient.id,)
+    result = await db.execute(keyset_page(select(*PATIENT_COLUMNS).order_by(Patient.id), keys, cursor, limit))
+    rows = finish_page(result.all(), keys, limit, response)
+    return projection.json_response(projection.as_dicts(rows), response)
+
+@app.get("/patients/search", response_model=List[PatientSchema])
+async def search_patients(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=150),
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Patients whose name matches ``q``, ignoring case and accents: names starting with
+    it first, then names with a word starting with it, then other substring matches
+    (see search.py).
+    """
+    query = search_key(q)
+    if not query:
+        return projection.json_response([], response)
+    rows, next_cursor = await search.search_page(db, query, cursor, limit, *PATIENT_COLUMNS)
+    if next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return projection.json_response(projection.as_dicts(rows), response)
+
+@app.get("/patients/{patient_id}", response_model=PatientSchema, dependencies=[Depends(versioning.conditional_get)])
 async def read_patient(patient_id: int, db: AsyncSession = Depends(get_db)):
     db_patient = await db.get(Patient, patient_id)
     if db_patient is None:
         raise HTTPException(status_code=404, detail="Patient not found")
     return db_patient
 
+@app.get("/patients/{patient_id}/dashboard", response_model=PatientDashboardSchema, dependencies=[Depends(versioning.conditional_get_with_definitions)])
+async def read_patient_dashboard(
+    patient_id: int,
+    request: Request,
+    response: Response,
+    limit: int = Query(SERIES_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Aggregated dashboard payload: the patient record, the lab definitions and the
+    most recent ``limit`` rows of each per-patient series, read over a single
+    session instead of five requests.
+
+    Each series is capped at ``limit`` (``SERIES_PAGE_SIZE`` by default) with no
+    cursor: older rows are only reachable through the series endpoints, which
+    send the next page's cursor in ``X-Next-Cursor``.
+    """
+    return await response_cache.respond(
+        request, response, PatientDashboardSchema, lambda: _load_patient_dashboard(patient_id, limit, response, db)
+    )
+
+async def _load_patient_dashboard(patient_id: int, limit: int, response: Response, db: AsyncSession):
+    started = time.perf_counter()
+    patient = (await db.execute(select(*PATIENT_COLUMNS).where(Patient.id == patient_id))).first()
+    if patient is None:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    # AsyncSession does not allow concurrent statements, so the queries are
+    # batched sequentially on the one connection checked out for this request.
+    definitions = await db.execute(select(*LAB_DEFINITION_COLUMNS))
+    lab_results = await db.execute(queries.patient_lab_results(patient_id, *LAB_RESULT_COLUMNS).limit(limit))
+    bioimpedance = await db.execute(queries.patient_bioimpedance(patient_id, *BIOIMPEDANCE_COLUMNS).limit(limit))
+    anthropometry = await db.execute(queries.patient_anthropometry(patient_id, *ANTHROPOMETRY_COLUMNS).limit(limit))
+    subjective = await db.execute(queries.patient_subjective(patient_id, *SUBJECTIVE_COLUMNS).limit(limit))
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    response.headers["Server-Timing"] = f"db;dur={elapsed_ms:.1f}"
+    if elapsed_ms > settings.DASHBOARD_LATENCY_BUDGET_MS:
+        logger.warning(
+            "Dashboard for patient %s took %.1fms (budget %.0fms)",
+            patient_id, elapsed_ms, settings.DASHBOARD_LATENCY_BUDGET_MS,
+        )
+
+    return projection.dumps({
+        "patient": patient._asdict(),
+        "lab_definitions": projection.as_dicts(definitions.all()),
+        "lab_results": projection.as_dicts(lab_results.all()),
+        "bioimpedance_entries": projection.as_dicts(bioimpedance.all()),
+        "anthropometry_entries": projection.as_dicts(anthropometry.all()),
+        "subjective_entries": projection.as_dicts(subjective.all()),
+    })
+
+@app.get("/patients/{patient_id}/latest", response_model=PatientLatestSchema, dependencies=[Depends(versioning.conditional_get_with_definitions)])
+async def read_patient_latest(patient_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_db)):
+    """The patient's current state: the most recent result of each test and the latest scans."""
+    async def load():
+        lab_results = await db.execute(latest.latest_lab_results(patient_id, *LAB_RESULT_COLUMNS))
+        bioimpedance = await db.execute(latest.latest_entry(latest.BIOIMPEDANCE, patient_id, *BIOIMPEDANCE_COLUMNS))
+        anthropometry = await db.execute(latest.latest_entry(latest.ANTHROPOMETRY, patient_id, *ANTHROPOMETRY_COLUMNS))
+        bioimpedance, anthropometry = bioimpedance.first(), anthropometry.first()
+        return projection.dumps({
+            "lab_results": projection.as_dicts(lab_results.all()),
+            "bioimpedance": bioimpedance._asdict() if bioimpedance else None,
+            "anthropometry": anthropometry._asdict() if anthropometry else None,
+        })
+    return await response_cache.respond(request, response, PatientLatestSchema, load)
+
 @app.put("/patients/{patient_id}", response_model=PatientSchema)
 async def update_patient(patient_id: int, patient: PatientUpdate, db: AsyncSession = Depends(get_db)):
-    db_patient = await db.get(Patient, patient_id)
+    update_data = patient.model_dump(exclude_unset=True)
+    if update_data.get("full_name") is not None:
+        update_data["search_name"] = search_key(update_data["full_name"])
+    previous_profile = None
+    if "gender" in update_data or "date_of_birth" in update_data:
+        # Population statistics are kept per gender and age band
+        previous_profile = await mutations.previous(db, Patient, patient_id, Patient.gender, Patient.date_of_birth)
+        if previous_profile is None:
+            raise HTTPException(status_code=404, detail="Patient not found")
+
+    db_patient = await mutations.update_returning(db, Patient, patient_id, update_data, *PATIENT_COLUMNS)
     if db_patient is None:
         raise HTTPException(status_code=404, detail="Patient not found")
-    
-    update_data = patient.model_dump(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(db_patient, key, value)
+
+    if previous_profile is not None:
+        previous_profile = population_stats.Profile(*previous_profile)
+        profile = population_stats.Profile(db_patient.gender, db_patient.date_of_birth)
+        if profile != previous_profile:
+            await population_stats.move_patient(db, patient_id, previous_profile, profile)
+    if "gender" in update_data:
+        # Reference ranges are gender specific: re-flag the stored results
+        await db.execute(
+            update(LabResult).where(LabResult.patient_id == patient_id)
+            .values(flag=flag_expression()).execution_options(synchronize_session=False)
+        )
+    await versioning.touch_patients(db, patient_id)
     
     await db.commit()
-    await db.refresh(db_patient)
-    return db_patient
+    return db_patient._asdict()
 
 @app.delete("/patients/{patient_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_patient(patient_id: int, db: AsyncSession = Depends(get_db)):
-    db_patient = await db.get(Patient, patient_id)
-    if db_patient is None:
+    """
+    Delete a patient and their whole history in one transaction, one set-based
+    ``DELETE`` per table; nothing is loaded into the session.
+    """
+    profile = await mutations.previous(db, Patient, patient_id, Patient.gender, Patient.date_of_birth)
+    if profile is None:
         raise HTTPException(status_code=404, detail="Patient not found")
-    await db.delete(db_patient)
+    await population_stats.move_patient(db, patient_id, population_stats.Profile(*profile), None)
+    await latest.clear_patient(db, patient_id)
+    # Explicit rather than relying on ON DELETE CASCADE: SQLite only enforces it with
+    # PRAGMA foreign_keys, and databases created before the cascade keep plain FKs
+    for model in (LabResult, BioimpedanceEntry, AnthropometryEntry, SubjectiveEntry):
+        await db.execute(delete(model).where(model.patient_id == patient_id).execution_options(synchronize_session=False))
+    await mutations.delete_returning(db, Patient, patient_id, Patient.id)
     await db.commit()
 
 # --- Lab Test Definitions ---
 
 @app.post("/lab-definitions/", response_model=LabTestDefinitionSchema, status_code=status.HTTP_201_CREATED)
 async def create_lab_definition(definition: LabTestDefinitionCreate, db: AsyncSession = Depends(get_db)):
-    db_definition = LabTestDefinition(**definition.model_dump())
-    db.add(db_definition)
+    db_definition = await mutations.insert_returning(db, LabTestDefinition, definition.model_dump(), *LAB_DEFINITION_COLUMNS)
+    await versioning.touch_definitions(db)
     await db.commit()
-    await db.refresh(db_definition)
-    return db_definition
-
-@app.get("/lab-definitions/", response_model=List[LabTestDefinitionSchema])
-async def read_lab_definitions(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(LabTestDefinition).offset(skip).limit(limit))
-    return result.scalars().all()
-
-@app.get("/lab-definitions/{definition_id}", response_model=LabTestDefinitionSchema)
-async def read_lab_definition(definition_id: int, db: AsyncSession = Depends(get_db)):
-    db_definition = await db.get(LabTestDefinition, definition_id)
-    if db_definition is None:
-        raise HTTPException(status_code=404, detail="Lab Test Definition not found")
-    return db_definition
+    return db_definition._asdict()
+
+@app.get("/lab-definitions/", response_model=List[LabTestDefinitionSchema], dependencies=[Depends(versioning.conditional_get_definitions)])
+async def read_lab_definitions(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_db),
+):
+    async def load():
+        keys = (LabTestDefinition.id,)
+        statement = select(*LAB_DEFINITION_COLUMNS).order_by(LabTestDefinition.id)
+        result = await db.execute(keyset_page(statement, keys, cursor, limit))
+        return projection.dumps(projection.as_dicts(finish_page(result.all(), keys, limit, response)))
+    return await response_cache.respond(request, response, List[LabTestDefinitionSchema], load)
+
+@app.get("/lab-definitions/{definition_id}", response_model=LabTestDefinitionSchema, dependencies=[Depends(versioning.conditional_get_definitions)])
+async def read_lab_definition(definition_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_db)):
+    async def load():
+        db_definition = await db.get(LabTestDefinition, definition_id)
+        if db_definition is None:
+            raise HTTPException(status_code=404, detail="Lab Test Definition not found")
+        return db_definition
+    return await response_cache.respond(request, response, LabTestDefinitionSchema, load)
 
 @app.put("/lab-definitions/{definition_id}", response_model=LabTestDefinitionSchema)
 async def update_lab_definition(definition_id: int, definition: LabTestDefinitionUpdate, db: AsyncSession = Depends(get_db)):
-    db_definition = await db.get(LabTestDefinition, definition_id)
+    update_data = definition.model_dump(exclude_unset=True)
+    db_definition = await mutations.update_returning(db, LabTestDefinition, definition_id, update_data, *LAB_DEFINITION_COLUMNS)
     if db_definition is None:
         raise HTTPException(status_code=404, detail="Lab Test Definition not found")
-    
-    update_data = definition.model_dump(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(db_definition, key, value)
+
+    if any(key.startswith("ref_") for key in update_data):
+        await db.execute(
+            update(LabResult).where(LabResult.test_definition_id == definition_id)
+            .values(flag=flag_expression()).execution_options(synchronize_session=False)
+        )
+    await versioning.touch_definitions(db)
     
     await db.commit()
-    await db.refresh(db_definition)
-    return db_definition
+    return db_definition._asdict()
 
 @app.delete("/lab-definitions/{definition_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_lab_definition(definition_id: int, db: AsyncSession = Depends(get_db)):
-    db_definition = await db.get(LabTestDefinition, definition_id)
-    if db_definition is None:
+    if await mutations.delete_returning(db, LabTestDefinition, definition_id, LabTestDefinition.id) is None:
         raise HTTPException(status_code=404, detail="Lab Test Definition not found")
-    await db.delete(db_definition)
+    await population_stats.drop_metric(db, "lab", str(definition_id))
+    await latest.clear_test(db, definition_id)
+    await versioning.touch_definitions(db)
     await db.commit()
 
 # --- Lab Results ---
 
 @app.post("/lab-results/", response_model=LabResultSchema, status_code=status.HTTP_201_CREATED)
 async def create_lab_result(result: LabResultCreate, db: AsyncSession = Depends(get_db)):
-    db_result = LabResult(**result.model_dump())
-    db.add(db_result)
+    values = result.model_dump()
+    values["flag"] = flag_expression(result.patient_id, result.test_definition_id, result.value, result.flag)
+    db_result = await mutations.insert_returning(db, LabResult, values, *LAB_RESULT_COLUMNS)
+    await population_stats.update(db, "lab", added=population_stats.lab_samples([db_result]))
+    await latest.added(db, latest.LAB, [db_result])
+    await versioning.touch_patients(db, result.patient_id)
     await db.commit()
-    await db.refresh(db_result)
-    return db_result
-
-@app.get("/patients/{patient_id}/lab-results/", response_model=List[LabResultSchema])
-async def read_patient_lab_results(patient_id: int, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(LabResult).where(LabResult.patient_id == patient_id))
-    return result.scalars().all()
+    return db_result._asdict()
+
+@app.post("/lab-results/batch", response_model=BatchResult[LabResultSchema], status_code=status.HTTP_201_CREATED)
+async def create_lab_results_batch(
+    rows: List[Any] = Body(..., max_length=batch.MAX_BATCH_SIZE), db: AsyncSession = Depends(get_db),
+):
+    """Insert a lab panel in one transaction; invalid rows are skipped and reported."""
+    rows = batch.validate_rows(rows, LabResultCreate)
+    await batch.reject_unknown(db, rows, "patient_id", Patient.id, "Patient")
+    references = await reference_cache.load(db, rows.column("patient_id"), rows.column("test_definition_id"))
+    for index, row in list(rows.valid.items()):
+        if references.ranges.get(row["test_definition_id"]) is None:
+            rows.reject(index, f"Lab Test Definition {row['test_definition_id']} not found")
+            continue
+        row["flag"] = references.flag(row["patient_id"], row["test_definition_id"], row["value"], fallback=row["flag"])
+    await population_stats.update(db, "lab", added=population_stats.lab_samples(rows.valid.values()))
+    await versioning.touch_patients(db, *rows.column("patient_id"))
+    created = await batch.insert_rows(db, LabResult, rows)
+    await latest.added(db, latest.LAB, created)
+    await db.commit()
+    return rows.report(created)
+
+@app.get("/patients/{patient_id}/lab-results/", response_model=Union[List[LabResultSchema], List[SeriesBucket]], dependencies=[Depends(versioning.conditional_get_with_definitions)])
+async def read_patient_lab_results(
+    patient_id: int,
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(SERIES_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    points: Optional[int] = Query(None, ge=downsample.MIN_POINTS, le=MAX_PAGE_SIZE),
+    resample: Optional[downsample.Resample] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    async def load():
+        if downsample.check_params(points, resample, cursor):
+            return projection.dumps(await downsample.load(
+                db, downsample.LAB_RESULT_SERIES, patient_id, queries.patient_lab_results(patient_id, *LAB_RESULT_COLUMNS), points, resample
+            ))
+        statement = keyset_page(queries.patient_lab_results(patient_id, *LAB_RESULT_COLUMNS), queries.LAB_RESULT_KEYS, cursor, limit, descending=True)
+        result = await db.execute(statement)
+        return projection.dumps(projection.as_dicts(finish_page(result.all(), queries.LAB_RESULT_KEYS, limit, response)))
+    return await response_cache.respond(request, response, List[LabResultSchema], load)
+
+@app.get("/patients/{patient_id}/lab-results/matrix", response_model=LabResultMatrix, dependencies=[Depends(versioning.conditional_get_with_definitions)])
+async def read_patient_lab_matrix(
+    patient_id: int,
+    request: Request,
+    response: Response,
+    category: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """The patient's lab history as a tests × collection dates matrix (see lab_matrix.py)."""
+    async def load():
+        result = await db.execute(lab_matrix.statement(patient_id, category))
+        return projection.dumps(lab_matrix.pivot(result.all()))
+    return await response_cache.respond(request, response, LabResultMatrix, load)
+
+@app.get("/lab-results/alerts", response_model=List[LabAlertSchema])
+async def read_lab_alerts(
+    response: Response,
+    since: Optional[date] = None,
+    category: Optional[str] = None,
+    flag: Optional[Literal["Baixo", "Alto"]] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Clinic-wide worklist of out-of-range results collected since ``since`` (default:
+    the last 30 days), newest first. Each flag is read with its own index walk of
+    at most ``limit + 1`` rows and the pages are merged, so the cost does not grow
+    with the size of the table.
+    """
+    if since is None:
+        since = date.today() - timedelta(days=ALERT_WINDOW_DAYS)
+    keys = queries.LAB_RESULT_KEYS
+    rows = []
+    for value in ([flag] if flag else ABNORMAL_FLAGS):
+        statement = keyset_page(queries.lab_alerts(value, since, category), keys, cursor, limit, descending=True)
+        rows.extend((await db.execute(statement)).all())
+    rows.sort(key=lambda row: (row.collection_date, row.id), reverse=True)
+    return projection.json_response(projection.as_dicts(finish_page(rows, keys, limit, response)), response)
 
 @app.get("/lab-results/{result_id}", response_model=LabResultSchema)
 async def read_lab_result(result_id: int, db: AsyncSession = Depends(get_db)):
@@ -151,40 +443,83 @@ async def read_lab_result(result_id: int, db: AsyncSession = Depends(get_db)):
 
 @app.put("/lab-results/{result_id}", response_model=LabResultSchema)
 async def update_lab_result(result_id: int, result: LabResultUpdate, db: AsyncSession = Depends(get_db)):
-    db_result = await db.get(LabResult, result_id)
-    if db_result is None:
+    # Every field feeds the flag or the population statistics, so the old values are always needed
+    previous = await mutations.previous(db, LabResult, result_id, *LAB_SAMPLE_COLUMNS, LabResult.flag)
+    if previous is None:
         raise HTTPException(status_code=404, detail="Lab Result not found")
-    
+
     update_data = result.model_dump(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(db_result, key, value)
+    merged = {**previous._asdict(), **update_data}
+    update_data["flag"] = flag_expression(
+        merged["patient_id"], merged["test_definition_id"], merged["value"], merged["flag"]
+    )
+    db_result = await mutations.update_returning(db, LabResult, result_id, update_data, *LAB_RESULT_COLUMNS)
+    if db_result is None:
+        raise HTTPException(status_code=404, detail="Lab Result not found")
+
+    await population_stats.update(
+        db, "lab", added=population_stats.lab_samples([db_result]), removed=population_stats.lab_samples([previous])
+    )
+    await latest.changed(db, latest.LAB, result_id, previous, db_result)
+    await versioning.touch_patients(db, previous.patient_id, db_result.patient_id)
     
     await db.commit()
-    await db.refresh(db_result)
-    return db_result
+    return db_result._asdict()
 
 @app.delete("/lab-results/{result_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_lab_result(result_id: int, db: AsyncSession = Depends(get_db)):
-    db_result = await db.get(LabResult, result_id)
+    db_result = await mutations.delete_returning(db, LabResult, result_id, *LAB_SAMPLE_COLUMNS)
     if db_result is None:
         raise HTTPException(status_code=404, detail="Lab Result not found")
-    await db.delete(db_result)
+    await population_stats.update(db, "lab", removed=population_stats.lab_samples([db_result]))
+    await latest.removed(db, latest.LAB, [db_result])
+    await versioning.touch_patients(db, db_result.patient_id)
     await db.commit()
 
 # --- Bioimpedance Entries ---
 
 @app.post("/bioimpedance/", response_model=BioimpedanceEntrySchema, status_code=status.HTTP_201_CREATED)
 async def create_bioimpedance(entry: BioimpedanceEntryCreate, db: AsyncSession = Depends(get_db)):
-    db_entry = BioimpedanceEntry(**entry.model_dump())
-    db.add(db_entry)
+    db_entry = await mutations.insert_returning(db, BioimpedanceEntry, entry.model_dump(), *BIOIMPEDANCE_COLUMNS)
+    await population_stats.update(db, "bioimpedance", added=population_stats.bioimpedance_samples([db_entry]))
+    await latest.added(db, latest.BIOIMPEDANCE, [db_entry])
+    await versioning.touch_patients(db, entry.patient_id)
     await db.commit()
-    await db.refresh(db_entry)
-    return db_entry
-
-@app.get("/patients/{patient_id}/bioimpedance/", response_model=List[BioimpedanceEntrySchema])
-async def read_patient_bioimpedance(patient_id: int, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(BioimpedanceEntry).where(BioimpedanceEntry.patient_id == patient_id))
-    return result.scalars().all()
+    return db_entry._asdict()
+
+@app.post("/bioimpedance/batch", response_model=BatchResult[BioimpedanceEntrySchema], status_code=status.HTTP_201_CREATED)
+async def create_bioimpedance_batch(
+    rows: List[Any] = Body(..., max_length=batch.MAX_BATCH_SIZE), db: AsyncSession = Depends(get_db),
+):
+    rows = batch.validate_rows(rows, BioimpedanceEntryCreate)
+    await batch.reject_unknown(db, rows, "patient_id", Patient.id, "Patient")
+    await population_stats.update(db, "bioimpedance", added=population_stats.bioimpedance_samples(rows.valid.values()))
+    await versioning.touch_patients(db, *rows.column("patient_id"))
+    created = await batch.insert_rows(db, BioimpedanceEntry, rows)
+    await latest.added(db, latest.BIOIMPEDANCE, created)
+    await db.commit()
+    return rows.report(created)
+
+@app.get("/patients/{patient_id}/bioimpedance/", response_model=Union[List[BioimpedanceEntrySchema], List[SeriesBucket]], dependencies=[Depends(versioning.conditional_get)])
+async def read_patient_bioimpedance(
+    patient_id: int,
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(SERIES_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    points: Optional[int] = Query(None, ge=downsample.MIN_POINTS, le=MAX_PAGE_SIZE),
+    resample: Optional[downsample.Resample] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    async def load():
+        if downsample.check_params(points, resample, cursor):
+            return projection.dumps(await downsample.load(
+                db, downsample.BIOIMPEDANCE_SERIES, patient_id, queries.patient_bioimpedance(patient_id, *BIOIMPEDANCE_COLUMNS), points, resample
+            ))
+        statement = keyset_page(queries.patient_bioimpedance(patient_id, *BIOIMPEDANCE_COLUMNS), queries.BIOIMPEDANCE_KEYS, cursor, limit, descending=True)
+        result = await db.execute(statement)
+        return projection.dumps(projection.as_dicts(finish_page(result.all(), queries.BIOIMPEDANCE_KEYS, limit, response)))
+    return await response_cache.respond(request, response, List[BioimpedanceEntrySchema], load)
 
 @app.get("/bioimpedance/{entry_id}", response_model=BioimpedanceEntrySchema)
 async def read_bioimpedance_entry(entry_id: int, db: AsyncSession = Depends(get_db)):
@@ -195,40 +530,76 @@ async def read_bioimpedance_entry(entry_id: int, db: AsyncSession = Depends(get_
 
 @app.put("/bioimpedance/{entry_id}", response_model=BioimpedanceEntrySchema)
 async def update_bioimpedance_entry(entry_id: int, entry: BioimpedanceEntryUpdate, db: AsyncSession = Depends(get_db)):
-    db_entry = await db.get(BioimpedanceEntry, entry_id)
-    if db_entry is None:
+    previous = await mutations.previous(db, BioimpedanceEntry, entry_id, *BIOIMPEDANCE_SAMPLE_COLUMNS)
+    if previous is None:
         raise HTTPException(status_code=404, detail="Bioimpedance Entry not found")
     
     update_data = entry.model_dump(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(db_entry, key, value)
+    db_entry = await mutations.update_returning(db, BioimpedanceEntry, entry_id, update_data, *BIOIMPEDANCE_COLUMNS)
+    if db_entry is None:
+        raise HTTPException(status_code=404, detail="Bioimpedance Entry not found")
+    await population_stats.update(
+        db, "bioimpedance",
+        added=population_stats.bioimpedance_samples([db_entry]), removed=population_stats.bioimpedance_samples([previous]),
+    )
+    await latest.changed(db, latest.BIOIMPEDANCE, entry_id, previous, db_entry)
+    await versioning.touch_patients(db, previous.patient_id, db_entry.patient_id)
     
     await db.commit()
-    await db.refresh(db_entry)
-    return db_entry
+    return db_entry._asdict()
 
 @app.delete("/bioimpedance/{entry_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_bioimpedance_entry(entry_id: int, db: AsyncSession = Depends(get_db)):
-    db_entry = await db.get(BioimpedanceEntry, entry_id)
+    db_entry = await mutations.delete_returning(db, BioimpedanceEntry, entry_id, *BIOIMPEDANCE_SAMPLE_COLUMNS)
     if db_entry is None:
         raise HTTPException(status_code=404, detail="Bioimpedance Entry not found")
-    await db.delete(db_entry)
+    await population_stats.update(db, "bioimpedance", removed=population_stats.bioimpedance_samples([db_entry]))
+    await latest.removed(db, latest.BIOIMPEDANCE, [db_entry])
+    await versioning.touch_patients(db, db_entry.patient_id)
     await db.commit()
 
 # --- Anthropometry Entries ---
 
 @app.post("/anthropometry/", response_model=AnthropometryEntrySchema, status_code=status.HTTP_201_CREATED)
 async def create_anthropometry(entry: AnthropometryEntryCreate, db: AsyncSession = Depends(get_db)):
-    db_entry = AnthropometryEntry(**entry.model_dump())
-    db.add(db_entry)
+    db_entry = await mutations.insert_returning(db, AnthropometryEntry, entry.model_dump(), *ANTHROPOMETRY_COLUMNS)
+    await latest.added(db, latest.ANTHROPOMETRY, [db_entry])
+    await versioning.touch_patients(db, entry.patient_id)
     await db.commit()
-    await db.refresh(db_entry)
-    return db_entry
-
-@app.get("/patients/{patient_id}/anthropometry/", response_model=List[AnthropometryEntrySchema])
-async def read_patient_anthropometry(patient_id: int, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(AnthropometryEntry).where(AnthropometryEntry.patient_id == patient_id))
-    return result.scalars().all()
+    return db_entry._asdict()
+
+@app.post("/anthropometry/batch", response_model=BatchResult[AnthropometryEntrySchema], status_code=status.HTTP_201_CREATED)
+async def create_anthropometry_batch(
+    rows: List[Any] = Body(..., max_length=batch.MAX_BATCH_SIZE), db: AsyncSession = Depends(get_db),
+):
+    rows = batch.validate_rows(rows, AnthropometryEntryCreate)
+    await batch.reject_unknown(db, rows, "patient_id", Patient.id, "Patient")
+    await versioning.touch_patients(db, *rows.column("patient_id"))
+    created = await batch.insert_rows(db, AnthropometryEntry, rows)
+    await latest.added(db, latest.ANTHROPOMETRY, created)
+    await db.commit()
+    return rows.report(created)
+
+@app.get("/patients/{patient_id}/anthropometry/", response_model=Union[List[AnthropometryEntrySchema], List[SeriesBucket]], dependencies=[Depends(versioning.conditional_get)])
+async def read_patient_anthropometry(
+    patient_id: int,
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(SERIES_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    points: Optional[int] = Query(None, ge=downsample.MIN_POINTS, le=MAX_PAGE_SIZE),
+    resample: Optional[downsample.Resample] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    async def load():
+        if downsample.check_params(points, resample, cursor):
+            return projection.dumps(await downsample.load(
+                db, downsample.ANTHROPOMETRY_SERIES, patient_id, queries.patient_anthropometry(patient_id, *ANTHROPOMETRY_COLUMNS), points, resample
+            ))
+        statement = keyset_page(queries.patient_anthropometry(patient_id, *ANTHROPOMETRY_COLUMNS), queries.ANTHROPOMETRY_KEYS, cursor, limit, descending=True)
+        result = await db.execute(statement)
+        return projection.dumps(projection.as_dicts(finish_page(result.all(), queries.ANTHROPOMETRY_KEYS, limit, response)))
+    return await response_cache.respond(request, response, List[AnthropometryEntrySchema], load)
 
 @app.get("/anthropometry/{entry_id}", response_model=AnthropometryEntrySchema)
 async def read_anthropometry_entry(entry_id: int, db: AsyncSession = Depends(get_db)):
@@ -239,40 +610,106 @@ async def read_anthropometry_entry(entry_id: int, db: AsyncSession = Depends(get
 
 @app.put("/anthropometry/{entry_id}", response_model=AnthropometryEntrySchema)
 async def update_anthropometry_entry(entry_id: int, entry: AnthropometryEntryUpdate, db: AsyncSession = Depends(get_db)):
-    db_entry = await db.get(AnthropometryEntry, entry_id)
+    update_data = entry.model_dump(exclude_unset=True)
+    previous = None
+    if "patient_id" in update_data or "date" in update_data:
+        # The entry may move away from its patient, or from its place in the latest pointers
+        previous = await mutations.previous(
+            db, AnthropometryEntry, entry_id, AnthropometryEntry.patient_id, AnthropometryEntry.date
+        )
+        if previous is None:
+            raise HTTPException(status_code=404, detail="Anthropometry Entry not found")
+
+    db_entry = await mutations.update_returning(db, AnthropometryEntry, entry_id, update_data, *ANTHROPOMETRY_COLUMNS)
     if db_entry is None:
         raise HTTPException(status_code=404, detail="Anthropometry Entry not found")
-    
-    update_data = entry.model_dump(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(db_entry, key, value)
+    if previous is not None:
+        await latest.changed(db, latest.ANTHROPOMETRY, entry_id, previous, db_entry)
+    await versioning.touch_patients(db, previous.patient_id if previous else None, db_entry.patient_id)
     
     await db.commit()
-    await db.refresh(db_entry)
-    return db_entry
+    return db_entry._asdict()
 
 @app.delete("/anthropometry/{entry_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_anthropometry_entry(entry_id: int, db: AsyncSession = Depends(get_db)):
-    db_entry = await db.get(AnthropometryEntry, entry_id)
+    db_entry = await mutations.delete_returning(db, AnthropometryEntry, entry_id, AnthropometryEntry.patient_id)
     if db_entry is None:
         raise HTTPException(status_code=404, detail="Anthropometry Entry not found")
-    await db.delete(db_entry)
+    await latest.removed(db, latest.ANTHROPOMETRY, [db_entry])
+    await versioning.touch_patients(db, db_entry.patient_id)
     await db.commit()
 
 # --- Subjective Entries ---
 
 @app.post("/subjective/", response_model=SubjectiveEntrySchema, status_code=status.HTTP_201_CREATED)
 async def create_subjective(entry: SubjectiveEntryCreate, db: AsyncSession = Depends(get_db)):
-    db_entry = SubjectiveEntry(**entry.model_dump())
-    db.add(db_entry)
+    values = entry.model_dump()
+    metric_names = await subjective_metrics.intern(db, values)
+    db_entry = await mutations.insert_returning(db, SubjectiveEntry, values, *SUBJECTIVE_RETURNING)
+    await versioning.touch_patients(db, entry.patient_id)
     await db.commit()
-    await db.refresh(db_entry)
-    return db_entry
-
-@app.get("/patients/{patient_id}/subjective/", response_model=List[SubjectiveEntrySchema])
-async def read_patient_subjective(patient_id: int, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(SubjectiveEntry).where(SubjectiveEntry.patient_id == patient_id))
-    return result.scalars().all()
+    return await subjective_metrics.named(db, db_entry, metric_names)
+
+@app.post("/subjective/batch", response_model=BatchResult[SubjectiveEntrySchema], status_code=status.HTTP_201_CREATED)
+async def create_subjective_batch(
+    rows: List[Any] = Body(..., max_length=batch.MAX_BATCH_SIZE), db: AsyncSession = Depends(get_db),
+):
+    rows = batch.validate_rows(rows, SubjectiveEntryCreate)
+    await batch.reject_unknown(db, rows, "patient_id", Patient.id, "Patient")
+    await versioning.touch_patients(db, *rows.column("patient_id"))
+    metric_names = await subjective_metrics.intern(db, *rows.valid.values())
+    created = await batch.insert_rows(db, SubjectiveEntry, rows)
+    subjective_metrics.name_entries(created, metric_names)
+    await db.commit()
+    return rows.report(created)
+
+@app.get("/patients/{patient_id}/subjective/", response_model=Union[List[SubjectiveEntrySchema], List[SeriesBucket]], dependencies=[Depends(versioning.conditional_get)])
+async def read_patient_subjective(
+    patient_id: int,
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(SERIES_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    points: Optional[int] = Query(None, ge=downsample.MIN_POINTS, le=MAX_PAGE_SIZE),
+    resample: Optional[downsample.Resample] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    async def load():
+        if downsample.check_params(points, resample, cursor):
+            return projection.dumps(await downsample.load(
+                db, downsample.SUBJECTIVE_SERIES, patient_id, queries.patient_subjective(patient_id, *SUBJECTIVE_COLUMNS), points, resample
+            ))
+        statement = keyset_page(queries.patient_subjective(patient_id, *SUBJECTIVE_COLUMNS), queries.SUBJECTIVE_KEYS, cursor, limit, descending=True)
+        result = await db.execute(statement)
+        return projection.dumps(projection.as_dicts(finish_page(result.all(), queries.SUBJECTIVE_KEYS, limit, response)))
+    return await response_cache.respond(request, response, List[SubjectiveEntrySchema], load)
+
+@app.get("/patients/{patient_id}/subjective/pivot", response_model=SubjectivePivotSchema, dependencies=[Depends(versioning.conditional_get)])
+async def read_patient_subjective_pivot(
+    patient_id: int,
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(SERIES_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    The subjective logs as one row per date, newest first, with one score per
+    metric the patient has logged (``metrics`` gives the column order). Several
+    entries of a metric on the same date are averaged.
+    """
+    async def load():
+        logged = (await db.execute(queries.patient_subjective_metrics(patient_id))).all()
+        keys = (SubjectiveEntry.date,)
+        statement = keyset_page(
+            queries.subjective_pivot(patient_id, [metric.id for metric in logged]), keys, cursor, limit, descending=True,
+        )
+        rows = finish_page((await db.execute(statement)).all(), keys, limit, response)
+        return projection.dumps({
+            "metrics": [metric.name for metric in logged],
+            "rows": [{"date": row.date, "scores": list(row[1:])} for row in rows],
+        })
+    return await response_cache.respond(request, response, SubjectivePivotSchema, load)
 
 @app.get("/subjective/{entry_id}", response_model=SubjectiveEntrySchema)
 async def read_subjective_entry(entry_id: int, db: AsyncSession = Depends(get_db)):
@@ -283,22 +720,69 @@ async def read_subjective_entry(entry_id: int, db: AsyncSession = Depends(get_db
 
 @app.put("/subjective/{entry_id}", response_model=SubjectiveEntrySchema)
 async def update_subjective_entry(entry_id: int, entry: SubjectiveEntryUpdate, db: AsyncSession = Depends(get_db)):
-    db_entry = await db.get(SubjectiveEntry, entry_id)
+    update_data = entry.model_dump(exclude_unset=True)
+    metric_names = await subjective_metrics.intern(db, update_data)
+    previous_patient_id = None
+    if "patient_id" in update_data:
+        # The entry moves away from its patient, whose views change too
+        previous = await mutations.previous(db, SubjectiveEntry, entry_id, SubjectiveEntry.patient_id)
+        if previous is None:
+            raise HTTPException(status_code=404, detail="Subjective Entry not found")
+        previous_patient_id = previous.patient_id
+
+    db_entry = await mutations.update_returning(db, SubjectiveEntry, entry_id, update_data, *SUBJECTIVE_RETURNING)
     if db_entry is None:
         raise HTTPException(status_code=404, detail="Subjective Entry not found")
-    
-    update_data = entry.model_dump(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(db_entry, key, value)
+    await versioning.touch_patients(db, previous_patient_id, db_entry.patient_id)
+    response = await subjective_metrics.named(db, db_entry, metric_names)
     
     await db.commit()
-    await db.refresh(db_entry)
-    return db_entry
+    return response
 
 @app.delete("/subjective/{entry_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_subjective_entry(entry_id: int, db: AsyncSession = Depends(get_db)):
-    db_entry = await db.get(SubjectiveEntry, entry_id)
+    db_entry = await mutations.delete_returning(db, SubjectiveEntry, entry_id, SubjectiveEntry.patient_id)
     if db_entry is None:
         raise HTTPException(status_code=404, detail="Subjective Entry not found")
-    await db.delete(db_entry)
+    await versioning.touch_patients(db, db_entry.patient_id)
     await db.commit()
+
+# --- Population Statistics ---
+
+@app.get("/stats/lab-tests/{definition_id}", response_model=List[PopulationStats])
+async def read_lab_test_population_stats(
+    definition_id: int,
+    gender: Optional[str] = None,
+    age_band: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """Clinic-wide distribution of a lab test per gender and age band."""
+    return await population_stats.read(db, "lab", str(definition_id), gender, age_band)
+
+@app.get("/stats/bioimpedance/{metric}", response_model=List[PopulationStats])
+async def read_bioimpedance_population_stats(
+    metric: str,
+    gender: Optional[str] = None,
+    age_band: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """Clinic-wide distribution of a bioimpedance metric per gender and age band."""
+    if metric not in population_stats.BIOIMPEDANCE_METRICS:
+        raise HTTPException(status_code=404, detail="Bioimpedance metric not found")
+    return await population_stats.read(db, "bioimpedance", metric, gender, age_band)
+
+# --- Export ---
+
+@app.get("/export/{table}")
+async def export_table(
+    table: export.ExportTable,
+    export_format: export.ExportFormat = Query("ndjson", alias="format"),
+    db: AsyncSession = Depends(get_db),
+):
+    """Stream a whole table as NDJSON or CSV with a server-side cursor."""
+    filename = f"{table.replace('-', '_')}.{export_format}"
+    return StreamingResponse(
+        export.stream_table(db, export.EXPORT_TABLES[table], export_format),
+        media_type=export.EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
@@ -0,0 +1,71 @@
+"""
+Helpers for the bulk ingestion endpoints.
+
+A batch is validated row by row in a single pass, so one bad row does not reject
+the whole import: invalid rows are reported back with their index and the valid
+ones are inserted together in one transaction with a multi-row
+``INSERT ... RETURNING`` (SQLAlchemy batches these with "insertmanyvalues").
+"""
+from typing import Any, Dict, Iterable, List, Set, Type
+
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import InstrumentedAttribute
+
+from models import Base
+
+MAX_BATCH_SIZE = 10_000
+
+
+class BatchRows:
+    """Accumulates the valid rows of a batch, keyed by their index in the request."""
+
+    def __init__(self):
+        self.valid: Dict[int, Dict[str, Any]] = {}
+        self.errors: List[Dict[str, Any]] = []
+
+    def reject(self, index: int, detail: Any) -> None:
+        self.valid.pop(index, None)
+        self.errors.append({"index": index, "detail": detail})
+
+    def column(self, name: str) -> Set[Any]:
+        return {row[name] for row in self.valid.values()}
+
+    def report(self, created: List[Base]) -> Dict[str, Any]:
+        return {"created": created, "errors": sorted(self.errors, key=lambda error: error["index"])}
+
+
+def validate_rows(rows: List[Any], schema: Type[BaseModel]) -> BatchRows:
+    batch = BatchRows()
+    for index, row in enumerate(rows):
+        try:
+            batch.valid[index] = schema.model_validate(row).model_dump()
+        except ValidationError as exc:
+            batch.errors.append({"index": index, "detail": exc.errors(include_url=False, include_context=False)})
+    return batch
+
+
+async def existing_ids(db: AsyncSession, column: InstrumentedAttribute, ids: Iterable[int]) -> Set[int]:
+    ids = set(ids)
+    if not ids:
+        return set()
+    result = await db.execute(select(column).where(column.in_(ids)))
+    return set(result.scalars().all())
+
+
+async def reject_unknown(db: AsyncSession, batch: BatchRows, field: str, column: InstrumentedAttribute, label: str) -> None:
+    """Reject rows whose foreign key does not exist, with one query for the whole batch."""
+    known = await existing_ids(db, column, batch.column(field))
+    for index, row in list(batch.valid.items()):
+        if row[field] not in known:
+            batch.reject(index, f"{label} {row[field]} not found")
+
+
+async def insert_rows(db: AsyncSession, model: Type[Base], batch: BatchRows) -> List[Base]:
+    """Insert the valid rows; the caller commits once its derived state is updated too."""
+    if not batch.valid:
+        return []
+    result = await db.scalars(insert(model).returning(model), list(batch.valid.values()))
+    return result.all()
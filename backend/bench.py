@@ -0,0 +1,381 @@
+"""
+Endpoint benchmark suite.
+
+Drives the app in-process through ``ASGITransport`` against file-backed SQLite
+databases seeded with the load-testing generator (``seed_db.py``) at several
+sizes, and reports p50/p95/p99 latency, throughput and allocations per
+request for each scenario:
+
+    python bench.py --sizes 100 1000 --iterations 200 --save
+    python bench.py --sizes 100 1000 --iterations 200 --compare
+
+Besides the endpoints, paired scenarios time the two ways a handler can do the
+same work straight on a session: building a list body from ORM entities or from
+projected columns (``projection.py``), and writing a row with the ORM or with
+``INSERT ... RETURNING`` (``mutations.py``). ``--latency-ms`` delays every
+statement and commit to stand in for a database behind a network hop, where the
+difference between the write paths is their number of round trips.
+
+Seeded databases are kept under ``bench_data/`` and reused across runs; every run
+starts from a fresh copy, so write scenarios always see the same data. ``--save``
+stores the results as a JSON baseline. ``--compare`` checks the run against it and
+exits with status 1 when a scenario's p50 or p95 got slower than ``--threshold``
+(relative) and ``--min-delta-ms`` (absolute, to ignore noise on fast endpoints).
+Baselines are only comparable on the same machine.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+# The app's own engine is never used (get_db is overridden per database), but config requires a URL
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+
+from httpx import AsyncClient, ASGITransport
+from pydantic import TypeAdapter
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.future import select
+from sqlalchemy.orm import sessionmaker
+
+from app import app
+from cache import response_cache
+from database import ENGINE_PROFILES, engine_options, get_db
+from models import Base, LabResult, LabTestDefinition, Patient
+from reference_ranges import reference_cache
+from schemas import LabResult as LabResultSchema, Patient as PatientSchema
+import mutations
+import projection
+import queries
+import seed_db
+
+DATA_DIR = Path(__file__).parent / "bench_data"
+DEFAULT_BASELINE = Path(__file__).parent / "bench_baseline.json"
+
+# Seeded histories end on a fixed date, so the alerts worklist gets an explicit
+# window covering all of them instead of its default relative to today
+SEEDED_UNTIL = seed_db.GeneratorConfig.end_date
+SEEDED_SINCE = SEEDED_UNTIL - timedelta(days=seed_db.GeneratorConfig.history_days)
+
+
+@dataclass
+class Context:
+    client: AsyncClient
+    # Sessions on the same database, for the scenarios that bypass the endpoints
+    factory: sessionmaker
+    patient_id: int
+    definition_id: int
+    # Advanced by write scenarios so every insert gets a new date
+    counter: int = 0
+
+
+Scenario = Callable[[Context], Awaitable[None]]
+
+
+async def _get(ctx: Context, url: str) -> None:
+    response = await ctx.client.get(url)
+    response.raise_for_status()
+
+
+async def _post(ctx: Context, url: str, payload: Any) -> None:
+    response = await ctx.client.post(url, json=payload)
+    response.raise_for_status()
+
+
+def _lab_result(ctx: Context) -> Dict[str, Any]:
+    ctx.counter += 1
+    return {
+        "patient_id": ctx.patient_id,
+        "test_definition_id": ctx.definition_id,
+        "collection_date": (SEEDED_UNTIL + timedelta(days=ctx.counter)).isoformat(),
+        "value": 90.0 + ctx.counter % 40,
+    }
+
+
+_LAB_RESULTS = TypeAdapter(List[LabResultSchema])
+_LAB_RESULT_COLUMNS = projection.columns(LabResultSchema, LabResult)
+_PATIENT_COLUMNS = projection.columns(PatientSchema, Patient)
+_PATIENT = {"full_name": "Benchmark", "date_of_birth": date(1980, 1, 1), "gender": "Feminino", "height_cm": 165.0}
+
+
+async def lab_results_orm(session: AsyncSession, patient_id: int) -> bytes:
+    """A patient's lab results as list endpoints built them before projection: ORM entities through the schema."""
+    result = await session.execute(queries.patient_lab_results(patient_id))
+    return _LAB_RESULTS.dump_json(_LAB_RESULTS.validate_python(result.scalars().all(), from_attributes=True))
+
+
+async def lab_results_projection(session: AsyncSession, patient_id: int) -> bytes:
+    """The same body from projected column tuples encoded with orjson."""
+    result = await session.execute(queries.patient_lab_results(patient_id, *_LAB_RESULT_COLUMNS))
+    return projection.dumps(projection.as_dicts(result.all()))
+
+
+async def insert_patient_orm(session: AsyncSession) -> Dict[str, Any]:
+    """A create handler's write before ``INSERT ... RETURNING``: add, commit, refresh."""
+    db_patient = Patient(**_PATIENT)
+    session.add(db_patient)
+    await session.commit()
+    await session.refresh(db_patient)
+    return {column.key: getattr(db_patient, column.key) for column in _PATIENT_COLUMNS}
+
+
+async def insert_patient_returning(session: AsyncSession) -> Dict[str, Any]:
+    db_patient = await mutations.insert_returning(session, Patient, _PATIENT, *_PATIENT_COLUMNS)
+    await session.commit()
+    return db_patient._asdict()
+
+
+def _in_session(work: Callable[[AsyncSession, Context], Awaitable[Any]]) -> Scenario:
+    async def scenario(ctx: Context) -> None:
+        async with ctx.factory() as session:
+            await work(session, ctx)
+    return scenario
+
+
+async def dashboard_fanout(ctx: Context) -> None:
+    """The six requests the dashboard made before the aggregate endpoint, issued concurrently."""
+    pid = ctx.patient_id
+    await asyncio.gather(*(_get(ctx, url) for url in (
+        f"/patients/{pid}", "/lab-definitions/", f"/patients/{pid}/lab-results/",
+        f"/patients/{pid}/bioimpedance/", f"/patients/{pid}/anthropometry/", f"/patients/{pid}/subjective/",
+    )))
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    "list_patients": lambda ctx: _get(ctx, "/patients/?limit=50"),
+    "read_patient": lambda ctx: _get(ctx, f"/patients/{ctx.patient_id}"),
+    "patient_dashboard": lambda ctx: _get(ctx, f"/patients/{ctx.patient_id}/dashboard"),
+    "dashboard_fanout": dashboard_fanout,
+    "patient_latest": lambda ctx: _get(ctx, f"/patients/{ctx.patient_id}/latest"),
+    "read_patient_lab_results": lambda ctx: _get(ctx, f"/patients/{ctx.patient_id}/lab-results/"),
+    "read_patient_lab_matrix": lambda ctx: _get(ctx, f"/patients/{ctx.patient_id}/lab-results/matrix"),
+    "lab_results_points": lambda ctx: _get(ctx, f"/patients/{ctx.patient_id}/lab-results/?points=50"),
+    "lab_results_monthly": lambda ctx: _get(ctx, f"/patients/{ctx.patient_id}/lab-results/?resample=month"),
+    "lab_alerts": lambda ctx: _get(ctx, f"/lab-results/alerts?since={SEEDED_SINCE.isoformat()}&limit=100"),
+    "lab_test_stats": lambda ctx: _get(ctx, f"/stats/lab-tests/{ctx.definition_id}"),
+    "create_lab_result": lambda ctx: _post(ctx, "/lab-results/", _lab_result(ctx)),
+    "create_lab_results_batch": lambda ctx: _post(ctx, "/lab-results/batch", [_lab_result(ctx) for _ in range(20)]),
+    "lab_results_body_orm": _in_session(lambda session, ctx: lab_results_orm(session, ctx.patient_id)),
+    "lab_results_body_projection": _in_session(lambda session, ctx: lab_results_projection(session, ctx.patient_id)),
+    "insert_patient_orm": _in_session(lambda session, ctx: insert_patient_orm(session)),
+    "insert_patient_returning": _in_session(lambda session, ctx: insert_patient_returning(session)),
+}
+
+
+def _add_latency(engine, seconds: float) -> None:
+    def wait(*args):
+        time.sleep(seconds)
+    for name in ("before_cursor_execute", "commit"):
+        event.listen(engine.sync_engine, name, wait)
+
+
+def _url(path: Path) -> str:
+    return f"sqlite+aiosqlite:///{path}"
+
+
+async def _seed(path: Path, patients: int, seed: int) -> None:
+    config = seed_db.GeneratorConfig(patients=patients, seed=seed)
+    engine = create_async_engine(_url(path))
+    factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with factory() as session:
+            await seed_db.seed_matrix(session)
+            catalog = seed_db.build_catalog(seed, (await session.execute(select(LabTestDefinition))).scalars().all())
+            for start in range(0, patients, config.chunk_size):
+                await seed_db.load_chunk(session, range(start, min(start + config.chunk_size, patients)), config, catalog)
+    finally:
+        await engine.dispose()
+
+
+async def prepare(patients: int, seed: int) -> Path:
+    """A fresh working copy of the seeded database for ``patients``, seeding it on first use."""
+    DATA_DIR.mkdir(exist_ok=True)
+    template = DATA_DIR / f"seed-{patients}-{seed}.db"
+    if not template.exists():
+        partial = template.with_suffix(".partial")
+        partial.unlink(missing_ok=True)
+        await _seed(partial, patients, seed)
+        partial.rename(template)
+    working = DATA_DIR / f"run-{patients}.db"
+    shutil.copyfile(template, working)
+    return working
+
+
+def percentile(sorted_values: Sequence[float], q: float) -> float:
+    """Nearest-rank percentile of already sorted values."""
+    return sorted_values[min(len(sorted_values) - 1, round(q / 100 * (len(sorted_values) - 1)))]
+
+
+async def measure(scenario: Scenario, ctx: Context, iterations: int, warmup: int, concurrency: int) -> Dict[str, float]:
+    for _ in range(warmup):
+        await scenario(ctx)
+
+    latencies: List[float] = []
+    pending = iter(range(iterations))
+
+    async def worker():
+        for _ in pending:
+            started = time.perf_counter()
+            await scenario(ctx)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    # Allocations are traced in a separate, shorter pass: tracemalloc slows everything down
+    samples = max(iterations // 10, 5)
+    tracemalloc.start()
+    allocated = []
+    try:
+        for _ in range(samples):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            await scenario(ctx)
+            allocated.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "throughput_rps": round(iterations / elapsed, 1),
+        "peak_alloc_kib": round(sum(allocated) / len(allocated) / 1024, 1),
+    }
+
+
+async def run_size(patients: int, args: argparse.Namespace) -> Dict[str, Dict[str, float]]:
+    path = await prepare(patients, args.seed)
+    url = _url(path)
+    engine = create_async_engine(url, **engine_options(url, ENGINE_PROFILES["server"]))
+    factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    if args.latency_ms:
+        _add_latency(engine, args.latency_ms / 1000)
+
+    async def override_get_db():
+        async with factory() as session:
+            yield session
+
+    app.dependency_overrides[get_db] = override_get_db
+    # Ids repeat across databases, so start each size from empty caches
+    reference_cache.clear()
+    await response_cache.clear()
+    saved_backend = response_cache.backend
+    if not args.cache:
+        response_cache.backend = None
+
+    results = {}
+    try:
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://bench") as client:
+            # A patient from the middle of the range, with a typical history
+            ctx = Context(client, factory, patient_id=patients // 2 + 1, definition_id=1)
+            for name in args.scenarios:
+                results[name] = await measure(SCENARIOS[name], ctx, args.iterations, args.warmup, args.concurrency)
+                print(_format(f"{patients}/{name}", results[name]), flush=True)
+    finally:
+        response_cache.backend = saved_backend
+        app.dependency_overrides.pop(get_db, None)
+        await engine.dispose()
+    return results
+
+
+def _format(label: str, result: Dict[str, float]) -> str:
+    return (
+        f"{label:<40} p50 {result['p50_ms']:8.2f} ms  p95 {result['p95_ms']:8.2f} ms  "
+        f"p99 {result['p99_ms']:8.2f} ms  {result['throughput_rps']:8.1f} req/s  "
+        f"{result['peak_alloc_kib']:9.1f} KiB"
+    )
+
+
+def compare(
+    baseline: Dict[str, Any], current: Dict[str, Any], threshold: float, min_delta_ms: float,
+) -> List[str]:
+    """Regressions of ``current`` against ``baseline``, as report lines."""
+    regressions = []
+    for size, scenarios in current["results"].items():
+        for name, result in scenarios.items():
+            before = baseline["results"].get(size, {}).get(name)
+            if before is None:
+                continue
+            for metric in ("p50_ms", "p95_ms"):
+                old, new = before[metric], result[metric]
+                if new > old * (1 + threshold) and new - old > min_delta_ms:
+                    regressions.append(
+                        f"{size}/{name} {metric}: {old:.2f} ms -> {new:.2f} ms ({(new / old - 1) * 100:+.0f}%)"
+                    )
+    return regressions
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Endpoint latency benchmarks against seeded SQLite databases.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000], help="patients per database")
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1, help="requests in flight at once")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--cache", action="store_true", help="keep the response cache enabled (off by default)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated network latency per round trip")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save", action="store_true", help="write the results to --baseline")
+    parser.add_argument("--compare", action="store_true", help="fail on regressions against --baseline")
+    parser.add_argument("--threshold", type=float, default=0.20, help="relative slowdown that counts as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=0.5)
+    parser.add_argument("--output", type=Path, help="also write this run's results here")
+    return parser.parse_args(argv)
+
+
+async def main(argv: Optional[Sequence[str]] = None) -> int:
+    args = parse_args(argv)
+    current = {
+        "meta": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "machine": platform.machine(),
+            "iterations": args.iterations,
+            "concurrency": args.concurrency,
+            "cache": args.cache,
+            "latency_ms": args.latency_ms,
+            "seed": args.seed,
+        },
+        "results": {},
+    }
+    for patients in args.sizes:
+        current["results"][str(patients)] = await run_size(patients, args)
+
+    if args.output:
+        args.output.write_text(json.dumps(current, indent=2) + "\n")
+    if args.save:
+        args.baseline.write_text(json.dumps(current, indent=2) + "\n")
+        print(f"Saved baseline to {args.baseline}")
+    if args.compare:
+        if not args.baseline.exists():
+            print(f"No baseline at {args.baseline}; run with --save first")
+            return 1
+        regressions = compare(json.loads(args.baseline.read_text()), current, args.threshold, args.min_delta_ms)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("No regressions against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
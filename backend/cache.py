@@ -0,0 +1,231 @@
+"""
+Response cache for the read endpoints.
+
+Serialized JSON bodies are cached keyed by endpoint and query parameters, plus
+the response's ``ETag`` and ``Last-Modified`` set by a conditional GET dependency,
+i.e. versions read from the database: the patient's ``data_version`` and, for
+views built from the lab definitions, the catalog version (see ``versioning.py``).
+Write handlers bump those in their own transaction, so a write makes the old
+entries unreachable in every worker, with no cross-process invalidation message.
+
+Entries keyed on database versions are never served stale; old ones age out
+through TTL and LRU eviction. The default backend is in-process
+(``MemoryCacheBackend``); ``RedisCacheBackend`` shares entries across worker
+processes.
+"""
+import functools
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from urllib.parse import urlencode
+
+from fastapi import Request, Response
+from pydantic import TypeAdapter
+
+from config import settings
+from pagination import NEXT_CURSOR_HEADER
+
+# Headers produced while building a body that belong to the cached representation
+CACHED_HEADERS = (NEXT_CURSOR_HEADER,)
+CACHE_STATUS_HEADER = "X-Cache"
+
+
+class CacheBackend:
+    """Byte store with TTL."""
+
+    async def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        raise NotImplementedError
+
+    async def clear(self) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+
+class MemoryCacheBackend(CacheBackend):
+    """In-process LRU with per-entry TTL and a cap on the total bytes held."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self._drop(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    async def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def _drop(self, key: str) -> None:
+        _, value = self._entries.pop(key)
+        self._bytes -= len(key) + len(value)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "memory",
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Shared across worker processes. ``redis`` is only imported when this backend is
+    selected; memory capping and eviction are left to the server's ``maxmemory``/LRU
+    policy.
+    """
+
+    def __init__(self, url: str, namespace: str = "medical-dashboard"):
+        try:
+            import redis.asyncio as redis
+        except ImportError as exc:
+            raise RuntimeError("CACHE_BACKEND=redis requires the 'redis' package") from exc
+        self._client = redis.from_url(url)
+        self._namespace = namespace
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key: str) -> str:
+        return f"{self._namespace}:response:{key}"
+
+    async def get(self, key: str) -> Optional[bytes]:
+        value = await self._client.get(self._key(key))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        await self._client.set(self._key(key), value, px=int(ttl * 1000))
+
+    async def clear(self) -> None:
+        async for key in self._client.scan_iter(match=f"{self._namespace}:*"):
+            await self._client.delete(key)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "redis", "hits": self.hits, "misses": self.misses}
+
+
+@functools.lru_cache(maxsize=None)
+def _adapter(response_type: Any) -> TypeAdapter:
+    return TypeAdapter(response_type)
+
+
+class ResponseCache:
+    def __init__(self, backend: Optional[CacheBackend], ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(request: Request, response: Response) -> str:
+        query = urlencode(sorted(request.query_params.multi_items()))
+        # Last-Modified as well as the ETag: a recreated patient can reuse a deleted one's id and version
+        return f"{request.url.path}?{query}|{response.headers.get('ETag', '')}|{response.headers.get('Last-Modified', '')}"
+
+    async def respond(
+        self,
+        request: Request,
+        response: Response,
+        response_type: Any,
+        load: Callable[[], Awaitable[Any]],
+    ) -> Response:
+        """
+        Serve the cached body for this request, or build it with ``load``, serialize it
+        as ``response_type`` (unless ``load`` returns encoded bytes) and cache it. Headers already set on ``response`` (ETag,
+        cache validators) are carried over to the returned response.
+
+        Endpoints are only cached once a conditional GET dependency has set an ETag.
+        """
+        adapter = _adapter(response_type)
+        status = "MISS"
+        if self.backend is None or "ETag" not in response.headers:
+            body, headers = await self._build(response, adapter, load)
+        else:
+            key = self._key(request, response)
+            cached = await self.backend.get(key)
+            if cached is not None:
+                header_line, body = cached.split(b"\n", 1)
+                headers = json.loads(header_line)
+                status = "HIT"
+            else:
+                body, headers = await self._build(response, adapter, load)
+                await self.backend.set(key, json.dumps(headers).encode() + b"\n" + body, self.ttl)
+        headers[CACHE_STATUS_HEADER] = status
+
+        out = Response(content=body, media_type="application/json", headers=dict(response.headers))
+        out.headers.update(headers)
+        return out
+
+    @staticmethod
+    async def _build(response: Response, adapter: TypeAdapter, load) -> Tuple[bytes, Dict[str, str]]:
+        content = await load()
+        if isinstance(content, bytes):
+            # Already encoded by the projection fast path
+            body = content
+        else:
+            body = adapter.dump_json(adapter.validate_python(content, from_attributes=True))
+        headers = {name: response.headers[name] for name in CACHED_HEADERS if name in response.headers}
+        for name in headers:
+            del response.headers[name]
+        return body, headers
+
+    async def clear(self) -> None:
+        if self.backend is not None:
+            await self.backend.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        if self.backend is None:
+            return {"backend": "none"}
+        return self.backend.stats()
+
+
+def _make_backend() -> Optional[CacheBackend]:
+    if settings.CACHE_BACKEND == "memory":
+        return MemoryCacheBackend(settings.CACHE_MAX_BYTES)
+    if settings.CACHE_BACKEND == "redis":
+        return RedisCacheBackend(settings.CACHE_REDIS_URL)
+    return None
+
+
+response_cache = ResponseCache(_make_backend(), settings.CACHE_TTL_SECONDS)
@@ -1,3 +1,5 @@
+from typing import Literal, Optional
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import field_validator
 
@@ -8,6 +10,33 @@ class Settings(BaseSettings):
     # SECRET_KEY: str 
     LOG_LEVEL: str = "INFO"
 
+    # Engine profile (see database.ENGINE_PROFILES): "server" for long-lived workers,
+    # "serverless" for Vercel functions behind a pooler, "test" for local runs
+    DB_PROFILE: Literal["server", "serverless", "test"] = "server"
+    # Overrides the profile's SQL logging level (e.g. "INFO" to log every statement)
+    DB_LOG_LEVEL: Optional[str] = None
+    # Overrides whether the profile upgrades the schema and backfills derived tables
+    # on startup; without it, run ``python migrations.py`` once per deploy
+    MIGRATE_ON_STARTUP: Optional[bool] = None
+
+    # Adds X-DB-Statements / X-DB-Time-Ms to every response (see metrics.py); for
+    # local debugging and the query budget tests, not production
+    DEBUG_QUERY_HEADERS: bool = False
+
+    # Statements slower than this are logged with their plan (see slow_queries.py); unset disables the log
+    SLOW_QUERY_MS: Optional[float] = 250.0
+    SLOW_QUERY_EXPLAIN: bool = True
+
+    # Latency budget for the aggregated patient dashboard endpoint
+    DASHBOARD_LATENCY_BUDGET_MS: float = 150.0
+
+    # Response cache for the read endpoints (see cache.py): "memory" is per process,
+    # "redis" is shared between workers and needs CACHE_REDIS_URL, "none" disables it
+    CACHE_BACKEND: Literal["memory", "redis", "none"] = "memory"
+    CACHE_TTL_SECONDS: float = 300.0
+    CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    CACHE_REDIS_URL: Optional[str] = None
+
     model_config = SettingsConfigDict(env_file=".env")
 
     @field_validator("DATABASE_URL")
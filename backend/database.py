@@ -1,16 +1,131 @@
+import logging
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, StaticPool
 from config import settings
 
-# Handle SQLite vs Postgres specific args
-connect_args = {"check_same_thread": False} if "sqlite" in settings.DATABASE_URL else {}
 
-engine = create_async_engine(
-    settings.DATABASE_URL,
-    echo=True,
-    connect_args=connect_args,
-    pool_pre_ping=True
-)
+@dataclass(frozen=True)
+class EngineProfile:
+    """
+    Deployment-specific engine settings, selected with ``DB_PROFILE``.
+
+    ``statement_cache_size`` is the asyncpg prepared statement cache; it must be 0
+    behind pgbouncer in transaction mode, where a prepared statement may land on a
+    different server connection than the one that prepared it.
+    """
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout: float = 30.0
+    pool_recycle: int = -1
+    pool_pre_ping: bool = True
+    use_null_pool: bool = False
+    statement_timeout_ms: Optional[int] = None
+    statement_cache_size: int = 100
+    log_level: str = "WARNING"
+    migrate_on_startup: bool = True
+
+
+ENGINE_PROFILES: Dict[str, EngineProfile] = {
+    # Long-lived uvicorn workers: keep warm connections, recycle before server-side idle timeouts
+    "server": EngineProfile(
+        pool_size=10, max_overflow=20, pool_timeout=10.0, pool_recycle=1800,
+        statement_timeout_ms=30_000,
+    ),
+    # Vercel functions: no pool survives between invocations, so don't keep one and
+    # don't rely on prepared statements (pgbouncer-safe). Every cold start would run
+    # the schema checks too, so migrations are run once per deploy instead
+    "serverless": EngineProfile(
+        use_null_pool=True, pool_pre_ping=False,
+        statement_timeout_ms=10_000, statement_cache_size=0, migrate_on_startup=False,
+    ),
+    "test": EngineProfile(
+        pool_size=2, max_overflow=0, pool_pre_ping=False, log_level="INFO",
+    ),
+}
+
+
+def engine_options(database_url: str, profile: EngineProfile) -> Dict[str, Any]:
+    """Keyword arguments for ``create_async_engine`` for the given URL and profile."""
+    options: Dict[str, Any] = {"pool_pre_ping": profile.pool_pre_ping}
+
+    if "sqlite" in database_url:
+        options["connect_args"] = {"check_same_thread": False}
+        if ":memory:" in database_url or database_url.rstrip("/").endswith("sqlite+aiosqlite:"):
+            # Every connection to an in-memory database is a different database
+            options["poolclass"] = StaticPool
+            return options
+    elif "asyncpg" in database_url:
+        connect_args: Dict[str, Any] = {
+            "statement_cache_size": profile.statement_cache_size,
+            "prepared_statement_cache_size": profile.statement_cache_size,
+        }
+        if profile.statement_cache_size == 0:
+            connect_args["prepared_statement_name_func"] = lambda: f"__asyncpg_{uuid.uuid4()}__"
+        if profile.statement_timeout_ms is not None:
+            connect_args["server_settings"] = {"statement_timeout": str(profile.statement_timeout_ms)}
+        options["connect_args"] = connect_args
+
+    if profile.use_null_pool:
+        options["poolclass"] = NullPool
+    else:
+        options.update(
+            pool_size=profile.pool_size,
+            max_overflow=profile.max_overflow,
+            pool_timeout=profile.pool_timeout,
+            pool_recycle=profile.pool_recycle,
+        )
+    return options
+
+
+class PoolMonitor:
+    """Tracks how long requests wait to check a connection out of the pool."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record_wait(self, seconds: float) -> None:
+        self.checkouts += 1
+        self.wait_seconds_total += seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def stats(self, engine) -> Dict[str, Any]:
+        pool = engine.pool
+        stats: Dict[str, Any] = {
+            "profile": settings.DB_PROFILE,
+            "pool": type(pool).__name__,
+            "checkouts": self.checkouts,
+            "wait_seconds_total": round(self.wait_seconds_total, 6),
+            "wait_seconds_avg": round(self.wait_seconds_total / self.checkouts, 6) if self.checkouts else 0.0,
+            "wait_seconds_max": round(self.wait_seconds_max, 6),
+        }
+        if hasattr(pool, "checkedout") and hasattr(pool, "size"):
+            capacity = pool.size() + max(getattr(pool, "_max_overflow", 0), 0)
+            stats.update(
+                size=pool.size(),
+                checked_out=pool.checkedout(),
+                checked_in=pool.checkedin(),
+                overflow=pool.overflow(),
+                utilization=round(pool.checkedout() / capacity, 3) if capacity else 0.0,
+            )
+        return stats
+
+
+profile = ENGINE_PROFILES[settings.DB_PROFILE]
+logging.getLogger("sqlalchemy.engine").setLevel(settings.DB_LOG_LEVEL or profile.log_level)
+
+migrate_on_startup = profile.migrate_on_startup if settings.MIGRATE_ON_STARTUP is None else settings.MIGRATE_ON_STARTUP
+
+engine = create_async_engine(settings.DATABASE_URL, **engine_options(settings.DATABASE_URL, profile))
+
+pool_monitor = PoolMonitor()
 
 async_session_factory = sessionmaker(
     bind=engine,
@@ -21,4 +136,8 @@ async_session_factory = sessionmaker(
 
 async def get_db():
     async with async_session_factory() as session:
+        # Check the connection out up front so the time spent waiting on the pool is measured
+        started = time.perf_counter()
+        await session.connection()
+        pool_monitor.record_wait(time.perf_counter() - started)
         yield session
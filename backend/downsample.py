@@ -0,0 +1,179 @@
+"""
+Server-side downsampling for the evolution charts.
+
+``?points=N`` keeps at most ``N`` real rows per series, chosen with
+Largest-Triangle-Three-Buckets so peaks and troughs survive; the payload keeps the
+endpoint's row schema. ``?resample=week|month`` replaces the rows with one
+bucket per calendar period holding the row count and the mean, min and max of
+every numeric column, aggregated by the database in a single ``GROUP BY``.
+
+Lab results are downsampled per test and subjective entries per metric, since
+each of those is its own line on a chart.
+"""
+from dataclasses import dataclass
+from datetime import date
+from itertools import groupby
+from typing import Any, Dict, List, Literal, Optional, Sequence
+
+import numpy as np
+from fastapi import HTTPException
+from sqlalchemy import Date, Float, Integer, cast, func, type_coerce
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.sql import Select
+
+import projection
+from models import LabResult, BioimpedanceEntry, AnthropometryEntry, SubjectiveEntry
+
+Resample = Literal["week", "month"]
+
+MIN_POINTS = 3
+
+
+@dataclass(frozen=True)
+class Series:
+    model: type
+    date_column: str
+    # Column LTTB preserves the shape of; the other columns follow the chosen rows
+    shape_column: str
+    # One chart line per distinct value of this column
+    group_column: Optional[str] = None
+
+    def numeric_columns(self) -> List[Any]:
+        return [
+            column for column in self.model.__table__.columns
+            if isinstance(column.type, (Float, Integer)) and not column.primary_key and not column.foreign_keys
+            and column.key != self.group_column
+        ]
+
+
+LAB_RESULT_SERIES = Series(LabResult, "collection_date", "value", group_column="test_definition_id")
+BIOIMPEDANCE_SERIES = Series(BioimpedanceEntry, "date", "weight_kg")
+ANTHROPOMETRY_SERIES = Series(AnthropometryEntry, "date", "waist_cm")
+SUBJECTIVE_SERIES = Series(SubjectiveEntry, "date", "score", group_column="metric_name")
+
+
+def check_params(points: Optional[int], resample: Optional[str], cursor: Optional[str]) -> bool:
+    """Whether a downsampled view was requested; it always covers the whole history."""
+    if points is None and resample is None:
+        return False
+    if points is not None and resample is not None:
+        raise HTTPException(status_code=400, detail="Use either points or resample, not both")
+    if cursor is not None:
+        raise HTTPException(status_code=400, detail="Downsampled series are not paginated")
+    return True
+
+
+def lttb_indices(xs: Sequence[float], ys: Sequence[float], threshold: int) -> List[int]:
+    """
+    Indices of the points Largest-Triangle-Three-Buckets keeps out of ``xs``/``ys``
+    (sorted by x): the first and last point, plus per bucket the point forming
+    the largest triangle with the previously kept point and the next bucket's mean.
+
+    Bucket means and triangle areas are computed with numpy; only the walk over
+    the buckets, where each choice depends on the previous one, stays in Python.
+    """
+    n = len(xs)
+    if threshold >= n or threshold < MIN_POINTS:
+        return list(range(n))
+
+    x = np.asarray(xs, dtype=float)
+    y = np.asarray(ys, dtype=float)
+    every = (n - 2) / (threshold - 2)
+    # Bucket b holds points edges[b] up to edges[b + 1]; the last one ends at the final point
+    edges = np.minimum((np.arange(threshold) * every).astype(int) + 1, n)
+    spans = np.diff(edges[1:])
+    mean_x = np.add.reduceat(x, edges[1:-1]) / spans
+    mean_y = np.add.reduceat(y, edges[1:-1]) / spans
+
+    kept = [0]
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        ax, ay = x[previous], y[previous]
+        areas = np.abs((ax - mean_x[bucket]) * (y[start:end] - ay) - (ax - x[start:end]) * (mean_y[bucket] - ay))
+        previous = int(start + np.argmax(areas))
+        kept.append(previous)
+    kept.append(n - 1)
+    return kept
+
+
+def _x(value: date) -> float:
+    return float(value.toordinal())
+
+
+def downsample_rows(rows: Sequence[Row], series: Series, points: int) -> List[Row]:
+    """
+    LTTB over ``rows`` (newest first, as the endpoints return them), per group.
+    Rows without a value in the shape column cannot be placed and are dropped.
+    """
+    plotted = [row for row in rows if getattr(row, series.shape_column) is not None]
+    plotted.reverse()
+    if series.group_column is not None:
+        plotted.sort(key=lambda row: getattr(row, series.group_column))
+
+    kept: List[Row] = []
+    key = (lambda row: getattr(row, series.group_column)) if series.group_column else (lambda row: None)
+    for _, group in groupby(plotted, key=key):
+        group = list(group)
+        xs = [_x(getattr(row, series.date_column)) for row in group]
+        ys = [float(getattr(row, series.shape_column)) for row in group]
+        kept.extend(group[index] for index in lttb_indices(xs, ys, points))
+
+    kept.sort(key=lambda row: (getattr(row, series.date_column), row.id), reverse=True)
+    return kept
+
+
+def _period(column, resample: str, dialect: str):
+    if dialect == "sqlite":
+        if resample == "week":
+            # Monday of the row's week
+            return type_coerce(func.date(column, "weekday 0", "-6 days"), Date)
+        return type_coerce(func.date(column, "start of month"), Date)
+    return cast(func.date_trunc(resample, column), Date)
+
+
+async def resample_rows(db: AsyncSession, series: Series, patient_id: int, resample: str) -> List[Dict[str, Any]]:
+    """One row per (period, group), newest period first."""
+    model = series.model
+    period = _period(getattr(model, series.date_column), resample, db.get_bind().dialect.name).label("period")
+    group = getattr(model, series.group_column) if series.group_column else None
+    numeric = series.numeric_columns()
+
+    statement = select(
+        period,
+        *([group.label("group")] if group is not None else []),
+        func.count().label("count"),
+        # Cast first: Postgres averages integers as NUMERIC
+        *(func.avg(cast(column, Float)).label(f"mean_{column.key}") for column in numeric),
+        *(func.min(column).label(f"min_{column.key}") for column in numeric),
+        *(func.max(column).label(f"max_{column.key}") for column in numeric),
+    ).where(model.patient_id == patient_id)
+    grouping = [period] + ([group] if group is not None else [])
+    statement = statement.group_by(*grouping).order_by(period.desc(), *grouping[1:])
+
+    result = await db.execute(statement)
+    buckets = []
+    for row in result.all():
+        values = row._mapping
+        buckets.append({
+            "period": values["period"],
+            "group": values["group"] if group is not None else None,
+            "count": values["count"],
+            "mean": {column.key: values[f"mean_{column.key}"] for column in numeric},
+            "min": {column.key: values[f"min_{column.key}"] for column in numeric},
+            "max": {column.key: values[f"max_{column.key}"] for column in numeric},
+        })
+    return buckets
+
+
+async def load(
+    db: AsyncSession, series: Series, patient_id: int, statement: Select,
+    points: Optional[int], resample: Optional[str],
+) -> List[Dict[str, Any]]:
+    """The downsampled view of a series; ``statement`` selects its full, projected history."""
+    if resample is not None:
+        return await resample_rows(db, series, patient_id, resample)
+    result = await db.execute(statement)
+    return projection.as_dicts(downsample_rows(result.all(), series, points))
@@ -0,0 +1,137 @@
+"""
+Streaming clinic-wide export of patients and their measurement tables.
+
+Rows are read with a server-side cursor (``stream`` + ``yield_per``) as plain column
+tuples and written out chunk by chunk as NDJSON or CSV, so memory stays flat no
+matter how large the tables are. Used by ``GET /export/{table}`` and by the
+nightly CLI, which exports every table concurrently:
+
+    python export.py --format csv --out exports/
+"""
+import argparse
+import asyncio
+import csv
+import io
+import json
+import os
+from datetime import date, datetime
+from typing import Any, AsyncIterator, Dict, List, Literal, Sequence, Type
+
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+import schemas
+from database import async_session_factory, engine
+from models import Base, Patient, LabResult, BioimpedanceEntry, AnthropometryEntry, SubjectiveEntry, SubjectiveMetric
+
+ExportTable = Literal["patients", "lab-results", "bioimpedance", "anthropometry", "subjective", "subjective-metrics"]
+ExportFormat = Literal["ndjson", "csv"]
+
+EXPORT_TABLES: Dict[str, Type[Base]] = {
+    "patients": Patient,
+    "lab-results": LabResult,
+    "bioimpedance": BioimpedanceEntry,
+    "anthropometry": AnthropometryEntry,
+    "subjective": SubjectiveEntry,
+    # Subjective entries reference their metric by id
+    "subjective-metrics": SubjectiveMetric,
+}
+
+# Tables are exported with the columns their API schema exposes, which leaves out
+# server-side ones such as the patients' search key and cache validators. Subjective
+# entries keep their metric_id (resolved through subjective-metrics) rather than
+# the API's joined metric_name, so they and the metric dictionary export as stored
+EXPORT_SCHEMAS: Dict[Type[Base], Type[BaseModel]] = {
+    Patient: schemas.Patient,
+    LabResult: schemas.LabResult,
+    BioimpedanceEntry: schemas.BioimpedanceEntry,
+    AnthropometryEntry: schemas.AnthropometryEntry,
+}
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+CHUNK_SIZE = 1000
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _ndjson_chunk(columns: Sequence[str], rows: Sequence[Sequence]) -> str:
+    return "".join(
+        json.dumps(dict(zip(columns, row)), default=_json_default, ensure_ascii=False) + "\n"
+        for row in rows
+    )
+
+
+def _csv_chunk(rows: Sequence[Sequence]) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    return buffer.getvalue()
+
+
+def export_columns(model: Type[Base]) -> List[Any]:
+    """The table's columns in storage order, limited to its API schema's fields."""
+    schema = EXPORT_SCHEMAS.get(model)
+    return [column for column in model.__table__.columns if schema is None or column.key in schema.model_fields]
+
+
+async def stream_table(session: AsyncSession, model: Type[Base], export_format: str) -> AsyncIterator[str]:
+    """Yield the table as text chunks of at most ``CHUNK_SIZE`` rows each."""
+    exported = export_columns(model)
+    columns: List[str] = [column.key for column in exported]
+    statement = (
+        select(*exported)
+        .order_by(model.__table__.c.id)
+        .execution_options(yield_per=CHUNK_SIZE)
+    )
+
+    if export_format == "csv":
+        yield _csv_chunk([columns])
+
+    result = await session.stream(statement)
+    async for rows in result.partitions():
+        if export_format == "csv":
+            yield _csv_chunk(rows)
+        else:
+            yield _ndjson_chunk(columns, rows)
+
+
+async def export_table_to_file(session_factory, table: str, export_format: str, out_dir: str) -> str:
+    path = os.path.join(out_dir, f"{table.replace('-', '_')}.{export_format}")
+    async with session_factory() as session:
+        with open(path, "w", encoding="utf-8", newline="") as handle:
+            async for chunk in stream_table(session, EXPORT_TABLES[table], export_format):
+                handle.write(chunk)
+    return path
+
+
+async def export_all(session_factory, export_format: str, out_dir: str) -> List[str]:
+    """Export every table concurrently, each over its own session and connection."""
+    os.makedirs(out_dir, exist_ok=True)
+    return await asyncio.gather(*(
+        export_table_to_file(session_factory, table, export_format, out_dir) for table in EXPORT_TABLES
+    ))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Export all patients and measurements.")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="ndjson")
+    parser.add_argument("--out", default="exports")
+    args = parser.parse_args()
+
+    try:
+        for path in await export_all(async_session_factory, args.format, args.out):
+            print(f"Wrote {path}")
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,54 @@
+"""
+A patient's lab history as a tests × collection dates matrix.
+
+The series endpoint returns one object per result, each repeating the patient
+and test ids and every key name. The matrix carries each date and each test
+descriptor once and the results as parallel arrays: ``values[i][j]`` and
+``flags[i][j]`` are the result of ``tests[i]`` on ``dates[j]``, or null where the
+test was not collected that day. Dates are newest first, like the series;
+tests are ordered by category and name.
+
+One statement reads the results joined to their definitions, ordered so rows of
+a test arrive together; the pivot is a single pass over them. A test collected
+twice on one date shows its latest result (by id).
+"""
+from typing import Any, Dict, List, Optional, Sequence
+
+from sqlalchemy.engine import Row
+from sqlalchemy.future import select
+from sqlalchemy.sql import Select
+
+from models import LabResult, LabTestDefinition
+
+TEST_COLUMNS = (LabTestDefinition.id, LabTestDefinition.name, LabTestDefinition.category, LabTestDefinition.unit)
+
+
+def statement(patient_id: int, category: Optional[str] = None) -> Select:
+    query = (
+        select(*TEST_COLUMNS, LabResult.collection_date, LabResult.value, LabResult.flag)
+        .join(LabTestDefinition, LabTestDefinition.id == LabResult.test_definition_id)
+        .where(LabResult.patient_id == patient_id)
+        .order_by(LabTestDefinition.category, LabTestDefinition.name, LabTestDefinition.id, LabResult.id)
+    )
+    if category is not None:
+        query = query.where(LabTestDefinition.category == category)
+    return query
+
+
+def pivot(rows: Sequence[Row]) -> Dict[str, Any]:
+    """The matrix of ``rows`` as selected by ``statement``."""
+    dates = sorted({row.collection_date for row in rows}, reverse=True)
+    position = {collection_date: index for index, collection_date in enumerate(dates)}
+
+    tests: List[Dict[str, Any]] = []
+    values: List[List[Optional[float]]] = []
+    flags: List[List[Optional[str]]] = []
+    for row in rows:
+        if not tests or tests[-1]["id"] != row.id:
+            tests.append({column.key: getattr(row, column.key) for column in TEST_COLUMNS})
+            values.append([None] * len(dates))
+            flags.append([None] * len(dates))
+        index = position[row.collection_date]
+        values[-1][index] = row.value
+        flags[-1][index] = row.flag
+    return {"dates": dates, "tests": tests, "values": values, "flags": flags}
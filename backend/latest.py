@@ -0,0 +1,231 @@
+"""
+Materialized "latest value" pointers.
+
+``latest_lab_values`` holds, per patient and test, the id of the most recent result
+(by ``(collection_date, id)``, the same order the series endpoints use), and
+``latest_bioimpedance``/``latest_anthropometry`` the most recent entry per patient.
+They only store ids, so re-flagging or editing a result in place never makes
+them stale; reading a patient's current state is a primary-key range scan on the
+pointer table joined to the rows by id.
+
+Write handlers keep them current before committing, one slot (patient, plus test
+for lab results) at a time:
+
+- ``added``: new rows replace a slot's pointer only if they are newer than the
+  row it points at, in one conditional upsert;
+- ``changed``: an edit that keeps the row's slot and date leaves the pointers
+  alone; one that moves it forward is ``added``; one that moves it back or to
+  another slot recomputes the old slot only if its pointer was this row;
+- ``removed``: the slots of deleted rows are recomputed.
+
+Recomputing is set-based: a ``DELETE`` and an ``INSERT ... SELECT`` that keeps
+the rows with no newer sibling, answered from the composite
+``(patient_id, ..., date)`` indexes. ``refresh`` and ``rebuild`` do the same for
+whole patients and tables, for bulk loads and backfills.
+"""
+from dataclasses import dataclass
+from typing import Any, Iterable, Optional, Sequence, Tuple
+
+from sqlalchemy import and_, delete, exists, insert, literal_column, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import aliased
+
+from models import (
+    LabResult, BioimpedanceEntry, AnthropometryEntry,
+    LatestLabValue, LatestBioimpedance, LatestAnthropometry,
+)
+
+
+@dataclass(frozen=True)
+class Pointers:
+    table: type
+    source: type
+    # Columns identifying one "latest" slot besides patient_id
+    group_columns: Tuple[str, ...]
+    date_column: str
+    # Pointer table column holding the source row id
+    id_column: str
+
+    @property
+    def slot_columns(self) -> Tuple[str, ...]:
+        return ("patient_id", *self.group_columns)
+
+
+LAB = Pointers(LatestLabValue, LabResult, ("test_definition_id",), "collection_date", "lab_result_id")
+BIOIMPEDANCE = Pointers(LatestBioimpedance, BioimpedanceEntry, (), "date", "entry_id")
+ANTHROPOMETRY = Pointers(LatestAnthropometry, AnthropometryEntry, (), "date", "entry_id")
+
+ALL = (LAB, BIOIMPEDANCE, ANTHROPOMETRY)
+
+
+def _field(row: Any, name: str) -> Any:
+    return row[name] if isinstance(row, dict) else getattr(row, name)
+
+
+def _slot(pointers: Pointers, row: Any) -> Tuple:
+    return tuple(_field(row, column) for column in pointers.slot_columns)
+
+
+def _in_slots(model: type, pointers: Pointers, slots: Iterable[Tuple]):
+    return or_(*(
+        and_(*(getattr(model, column) == value for column, value in zip(pointers.slot_columns, slot)))
+        for slot in slots
+    ))
+
+
+def _insert(db: AsyncSession):
+    return postgresql.insert if db.get_bind().dialect.name == "postgresql" else sqlite.insert
+
+
+def _latest_rows(pointers: Pointers, condition=None):
+    source = pointers.source
+    newer = aliased(source)
+    date, newer_date = getattr(source, pointers.date_column), getattr(newer, pointers.date_column)
+    same_slot = [newer.patient_id == source.patient_id] + [
+        getattr(newer, column) == getattr(source, column) for column in pointers.group_columns
+    ]
+    statement = select(
+        source.patient_id, *(getattr(source, column) for column in pointers.group_columns), source.id,
+    ).where(~exists().where(
+        *same_slot,
+        or_(newer_date > date, and_(newer_date == date, newer.id > source.id)),
+    ))
+    if condition is not None:
+        statement = statement.where(condition)
+    return statement
+
+
+async def added(db: AsyncSession, pointers: Pointers, rows: Iterable[Any]) -> None:
+    """Point each slot at the newest of ``rows`` (with ``id`` and date) unless it already holds a newer row."""
+    newest = {}
+    for row in rows:
+        slot, order = _slot(pointers, row), (_field(row, pointers.date_column), _field(row, "id"))
+        if slot not in newest or order > newest[slot]:
+            newest[slot] = order
+    if not newest:
+        return
+
+    table, source = pointers.table, pointers.source
+    statement = _insert(db)(table)
+    current, candidate = aliased(source), aliased(source)
+    current_date, candidate_date = getattr(current, pointers.date_column), getattr(candidate, pointers.date_column)
+    # Spelled out: SQLAlchemy does not correlate subqueries of an upsert's WHERE
+    current_is_newer = exists().where(
+        current.id == literal_column(f"{table.__tablename__}.{pointers.id_column}"),
+        candidate.id == literal_column(f"excluded.{pointers.id_column}"),
+        or_(current_date > candidate_date, and_(current_date == candidate_date, current.id > candidate.id)),
+    )
+    # In key order, like the population statistics, so concurrent writers lock slots alike
+    await db.execute(statement.on_conflict_do_update(
+        index_elements=list(pointers.slot_columns),
+        set_={pointers.id_column: getattr(statement.excluded, pointers.id_column)},
+        where=~current_is_newer,
+    ), [
+        {**dict(zip(pointers.slot_columns, slot)), pointers.id_column: row_id}
+        for slot, (_, row_id) in sorted(newest.items())
+    ])
+
+
+async def changed(db: AsyncSession, pointers: Pointers, row_id: int, previous: Any, row: Any) -> None:
+    """Follow an edit of one row, given its slot and date before (``previous``) and after (``row``)."""
+    old_slot, new_slot = _slot(pointers, previous), _slot(pointers, row)
+    old_date, new_date = _field(previous, pointers.date_column), _field(row, pointers.date_column)
+    if old_slot == new_slot and new_date >= old_date:
+        if new_date > old_date:
+            await added(db, pointers, [row])
+        return
+
+    # Moved back or away: the old slot only changes if it pointed at this row
+    table = pointers.table
+    dropped = await db.execute(
+        delete(table).where(_in_slots(table, pointers, [old_slot]), getattr(table, pointers.id_column) == row_id)
+        .returning(table.patient_id)
+    )
+    if dropped.first() is not None:
+        await _fill(db, pointers, [old_slot])
+    if new_slot != old_slot:
+        await added(db, pointers, [row])
+
+
+async def removed(db: AsyncSession, pointers: Pointers, rows: Iterable[Any]) -> None:
+    """Recompute the slots of deleted ``rows``."""
+    slots = sorted({_slot(pointers, row) for row in rows})
+    if not slots:
+        return
+    await db.execute(delete(pointers.table).where(_in_slots(pointers.table, pointers, slots)))
+    await _fill(db, pointers, slots)
+
+
+async def _fill(db: AsyncSession, pointers: Pointers, slots: Sequence[Tuple]) -> None:
+    # Pending deletes of source rows must reach the database before the pointers are recomputed
+    await db.flush()
+    await db.execute(insert(pointers.table).from_select(
+        list(pointers.slot_columns) + [pointers.id_column],
+        _latest_rows(pointers, _in_slots(pointers.source, pointers, slots)),
+    ))
+
+
+async def refresh(db: AsyncSession, pointers: Pointers, *patient_ids: Optional[int]) -> None:
+    """Recompute every pointer of the given patients."""
+    ids = sorted({patient_id for patient_id in patient_ids if patient_id is not None})
+    if not ids:
+        return
+    await _rebuild(db, pointers, ids)
+
+
+async def _rebuild(db: AsyncSession, pointers: Pointers, patient_ids: Optional[Sequence[int]]) -> None:
+    table = pointers.table
+    await db.flush()
+    clear = delete(table)
+    if patient_ids is not None:
+        clear = clear.where(table.patient_id.in_(patient_ids))
+    await db.execute(clear)
+    condition = pointers.source.patient_id.in_(patient_ids) if patient_ids is not None else None
+    await db.execute(insert(table).from_select(
+        list(pointers.slot_columns) + [pointers.id_column], _latest_rows(pointers, condition),
+    ))
+
+
+async def rebuild(db: AsyncSession) -> None:
+    """Recompute every pointer from the raw tables."""
+    for pointers in ALL:
+        await _rebuild(db, pointers, None)
+
+
+async def ensure_built(db: AsyncSession) -> None:
+    """Backfill databases that predate the pointer tables; a no-op once they exist."""
+    for pointers in ALL:
+        has_pointers = (await db.execute(select(pointers.table.patient_id).limit(1))).first()
+        has_rows = (await db.execute(select(pointers.source.id).limit(1))).first()
+        if has_rows and not has_pointers:
+            await _rebuild(db, pointers, None)
+    await db.commit()
+
+
+async def clear_patient(db: AsyncSession, patient_id: int) -> None:
+    for pointers in ALL:
+        await db.execute(delete(pointers.table).where(pointers.table.patient_id == patient_id))
+
+
+async def clear_test(db: AsyncSession, definition_id: int) -> None:
+    await db.execute(delete(LatestLabValue).where(LatestLabValue.test_definition_id == definition_id))
+
+
+def latest_lab_results(patient_id: int, *columns):
+    return (
+        select(*(columns or (LabResult,)))
+        .join(LatestLabValue, LatestLabValue.lab_result_id == LabResult.id)
+        .where(LatestLabValue.patient_id == patient_id)
+        .order_by(LabResult.test_definition_id)
+    )
+
+
+def latest_entry(pointers: Pointers, patient_id: int, *columns):
+    source = pointers.source
+    return (
+        select(*(columns or (source,)))
+        .join(pointers.table, getattr(pointers.table, pointers.id_column) == source.id)
+        .where(pointers.table.patient_id == patient_id)
+    )
@@ -0,0 +1,216 @@
+"""
+Prometheus metrics for the API, served at ``/metrics`` in the text exposition format.
+
+``MetricsMiddleware`` (plain ASGI, so it adds no extra task per request) records
+per route template, e.g. ``/patients/{patient_id}/lab-results/``: request counts
+by status code, a latency histogram, and a histogram of the time spent in the
+database. DB time comes from engine events installed by ``instrument_engine``:
+they add every statement's duration to the ``RequestStats`` of the request in
+the current context. Connection pool gauges are read from ``pool_monitor`` when
+the endpoint is scraped.
+
+Everything is kept in plain dicts in the worker process; with several uvicorn
+workers each one is scraped (or aggregated) separately, as with any
+multi-process Prometheus target.
+
+With ``DEBUG_QUERY_HEADERS`` on, every response also carries the statement count
+and DB time of its request (``X-DB-Statements``, ``X-DB-Time-Ms``), which is how
+``test.py`` enforces per-route query budgets. The headers are taken when the
+response starts, so a streamed body's later queries are not included.
+"""
+import bisect
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from config import settings
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; the last bucket is +Inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Requests that matched no route share one label, so random paths cannot grow the series count
+UNMATCHED_ROUTE = "unmatched"
+
+STATEMENTS_HEADER = "X-DB-Statements"
+DB_TIME_HEADER = "X-DB-Time-Ms"
+
+
+@dataclass
+class RequestStats:
+    """Database work done on behalf of one request."""
+    scope: Dict[str, Any] = field(default_factory=dict)
+    statements: int = 0
+    db_seconds: float = 0.0
+
+    @property
+    def route(self) -> str:
+        route = self.scope.get("route")
+        return getattr(route, "path", None) or UNMATCHED_ROUTE
+
+
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    stats = request_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_seconds += elapsed
+
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute
+    started = exception_context.connection.info.get("query_started") if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """Attribute the statements run on ``engine`` to the current request; idempotent."""
+    sync_engine = engine.sync_engine
+    if event.contains(sync_engine, "after_cursor_execute", _after_cursor_execute):
+        return
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(sync_engine, "handle_error", _handle_error)
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # Per bucket, not cumulative; summed when rendered
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+
+class Registry:
+    def __init__(self):
+        self.requests: Dict[Tuple[str, str, str], int] = defaultdict(int)
+        self.latency: Dict[Tuple[str, str], Histogram] = {}
+        self.db_time: Dict[Tuple[str, str], Histogram] = {}
+        self.statements: Dict[Tuple[str, str], int] = defaultdict(int)
+
+    def record(self, method: str, route: str, status: int, seconds: float, stats: RequestStats) -> None:
+        key = (method, route)
+        self.requests[(method, route, str(status))] += 1
+        if key not in self.latency:
+            self.latency[key] = Histogram()
+            self.db_time[key] = Histogram()
+        self.latency[key].observe(seconds)
+        self.db_time[key].observe(stats.db_seconds)
+        self.statements[key] += stats.statements
+
+    def clear(self) -> None:
+        self.__init__()
+
+
+registry = Registry()
+
+
+class MetricsMiddleware:
+    def __init__(self, app, registry: Registry = registry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope)
+        token = request_stats.set(stats)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if settings.DEBUG_QUERY_HEADERS:
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (STATEMENTS_HEADER.lower().encode(), str(stats.statements).encode()),
+                        (DB_TIME_HEADER.lower().encode(), f"{stats.db_seconds * 1000:.2f}".encode()),
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_stats.reset(token)
+            self.registry.record(scope["method"], stats.route, status, time.perf_counter() - started, stats)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels: Any) -> str:
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _histogram_lines(name: str, histograms: Dict[Tuple[str, str], Histogram]) -> List[str]:
+    lines = []
+    for (method, route), histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(method=method, route=route, le=bound)} {cumulative}")
+        lines.append(f"{name}_sum{_labels(method=method, route=route)} {histogram.total:.6f}")
+        lines.append(f"{name}_count{_labels(method=method, route=route)} {histogram.count}")
+    return lines
+
+
+def render(registry: Registry, pool: Dict[str, Any]) -> str:
+    """The registry and the ``PoolMonitor.stats`` snapshot ``pool`` in the text exposition format."""
+    lines = [
+        "# HELP http_requests_total Requests handled, by route template and status code.",
+        "# TYPE http_requests_total counter",
+    ]
+    for (method, route, status), count in sorted(registry.requests.items()):
+        lines.append(f"http_requests_total{_labels(method=method, route=route, status=status)} {count}")
+
+    lines += [
+        "# HELP http_request_duration_seconds Request latency, by route template.",
+        "# TYPE http_request_duration_seconds histogram",
+        *_histogram_lines("http_request_duration_seconds", registry.latency),
+        "# HELP http_request_db_seconds Time spent executing SQL per request, by route template.",
+        "# TYPE http_request_db_seconds histogram",
+        *_histogram_lines("http_request_db_seconds", registry.db_time),
+        "# HELP http_request_db_statements_total SQL statements executed, by route template.",
+        "# TYPE http_request_db_statements_total counter",
+    ]
+    for (method, route), count in sorted(registry.statements.items()):
+        lines.append(f"http_request_db_statements_total{_labels(method=method, route=route)} {count}")
+
+    gauges = (
+        ("db_pool_size", "size", "gauge", "Connections the pool keeps open."),
+        ("db_pool_checked_out", "checked_out", "gauge", "Connections currently checked out."),
+        ("db_pool_checked_in", "checked_in", "gauge", "Idle connections in the pool."),
+        ("db_pool_overflow", "overflow", "gauge", "Connections open beyond the pool size."),
+        ("db_pool_checkouts_total", "checkouts", "counter", "Connections checked out by requests."),
+        ("db_pool_wait_seconds_total", "wait_seconds_total", "counter", "Time requests spent waiting for a connection."),
+        ("db_pool_wait_seconds_max", "wait_seconds_max", "gauge", "Longest wait for a connection."),
+    )
+    for name, key, kind, description in gauges:
+        if key in pool:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}", f"{name} {pool[key]}"]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,170 @@
+"""
+Idempotent schema upgrades, applied at startup unless the engine profile (or
+``MIGRATE_ON_STARTUP``) turns that off, and otherwise once per deploy:
+
+    python migrations.py
+
+There is no migration framework in this project: ``Base.metadata.create_all`` only
+creates missing tables, so anything added later to an existing table is brought
+up to date here. Every step must be safe to run on every boot.
+"""
+import asyncio
+from datetime import datetime
+
+from sqlalchemy import inspect, insert, select, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateColumn
+
+from database import async_session_factory, engine
+from models import Base, DataVersion, LabResult
+from reference_ranges import flag_expression
+from versioning import DEFINITIONS
+import latest
+import population_stats
+import search
+
+# Marker row in ``data_versions`` recording that stored lab flags were backfilled
+LAB_RESULT_FLAGS = "lab-result-flags"
+
+
+async def run() -> None:
+    """Upgrade the schema, then backfill the derived tables of databases that predate them."""
+    async with engine.begin() as conn:
+        await conn.run_sync(upgrade)
+    async with async_session_factory() as session:
+        await population_stats.ensure_built(session)
+        await latest.ensure_built(session)
+
+
+def upgrade(conn: Connection) -> None:
+    """Create missing tables, then apply incremental changes to existing ones."""
+    Base.metadata.create_all(conn)
+    _intern_subjective_metrics(conn)
+    _add_missing_columns(conn)
+    _population_stats_running_moments(conn)
+    _create_missing_indexes(conn)
+    _update_foreign_key_actions(conn)
+    _backfill_lab_result_flags(conn)
+    search.upgrade(conn)
+
+
+def _intern_subjective_metrics(conn: Connection) -> None:
+    """
+    Move subjective entries from the free-text ``metric_name`` column onto the
+    ``subjective_metrics`` dictionary: one row per distinct name, a ``metric_id``
+    on every entry, and the old column dropped.
+    """
+    columns = {column["name"] for column in inspect(conn).get_columns("subjective_entries")}
+    if "metric_name" not in columns:
+        return
+    if "metric_id" not in columns:
+        conn.exec_driver_sql(
+            "ALTER TABLE subjective_entries ADD COLUMN metric_id SMALLINT REFERENCES subjective_metrics (id)"
+        )
+    conn.exec_driver_sql(
+        "INSERT INTO subjective_metrics (name) SELECT metric_name FROM subjective_entries "
+        "WHERE metric_name NOT IN (SELECT name FROM subjective_metrics) GROUP BY metric_name ORDER BY metric_name"
+    )
+    conn.exec_driver_sql(
+        "UPDATE subjective_entries SET metric_id = "
+        "(SELECT id FROM subjective_metrics WHERE subjective_metrics.name = subjective_entries.metric_name)"
+    )
+    conn.exec_driver_sql("ALTER TABLE subjective_entries DROP COLUMN metric_name")
+    if conn.dialect.name == "postgresql":
+        conn.exec_driver_sql("ALTER TABLE subjective_entries ALTER COLUMN metric_id SET NOT NULL")
+
+
+def _add_missing_columns(conn: Connection) -> None:
+    """New columns must be nullable or carry a server default to be added in place."""
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_sql = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column_sql}")
+
+
+def _population_stats_running_moments(conn: Connection) -> None:
+    """
+    Replace the sum and sum of squares of ``population_stats`` with the mean and
+    M2 now maintained in their place (see ``population_stats.py``).
+    """
+    columns = {column["name"] for column in inspect(conn).get_columns("population_stats")}
+    if "total_sq" not in columns:
+        return
+    conn.exec_driver_sql(
+        "UPDATE population_stats SET "
+        "mean = CASE WHEN count > 0 THEN total / count ELSE 0 END, "
+        "m2 = CASE WHEN count > 1 THEN total_sq - total * total / count ELSE 0 END"
+    )
+    conn.exec_driver_sql("ALTER TABLE population_stats DROP COLUMN total")
+    conn.exec_driver_sql("ALTER TABLE population_stats DROP COLUMN total_sq")
+
+
+def _create_missing_indexes(conn: Connection) -> None:
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(conn)
+
+
+def _update_foreign_key_actions(conn: Connection) -> None:
+    """
+    Recreate foreign keys whose ``ON DELETE`` action changed in the models. SQLite
+    cannot alter constraints in place; there the API's explicit deletes cover it.
+    """
+    if conn.dialect.name != "postgresql":
+        return
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {
+            (tuple(fk["constrained_columns"]), fk["referred_table"]): fk
+            for fk in inspector.get_foreign_keys(table.name)
+        }
+        for constraint in table.foreign_key_constraints:
+            key = (tuple(constraint.column_keys), constraint.referred_table.name)
+            current = existing.get(key)
+            if current is None or (current["options"].get("ondelete") or None) == (constraint.ondelete or None):
+                continue
+            columns = ", ".join(constraint.column_keys)
+            referred = ", ".join(element.column.name for element in constraint.elements)
+            on_delete = f" ON DELETE {constraint.ondelete}" if constraint.ondelete else ""
+            conn.exec_driver_sql(f'ALTER TABLE {table.name} DROP CONSTRAINT "{current["name"]}"')
+            conn.exec_driver_sql(
+                f'ALTER TABLE {table.name} ADD CONSTRAINT "{current["name"]}" FOREIGN KEY ({columns}) '
+                f"REFERENCES {constraint.referred_table.name} ({referred}){on_delete}"
+            )
+
+
+def _backfill_lab_result_flags(conn: Connection) -> None:
+    """
+    Flag lab results stored before flags were computed on write, once. Results
+    without a reference range keep whatever flag they had. Views built from the
+    flags are keyed on the definitions version, so it is bumped with the backfill.
+    """
+    if conn.execute(select(DataVersion.name).where(DataVersion.name == LAB_RESULT_FLAGS)).first():
+        return
+    conn.execute(update(LabResult).values(flag=flag_expression()))
+    now = datetime.utcnow()
+    bumped = conn.execute(
+        update(DataVersion).where(DataVersion.name == DEFINITIONS)
+        .values(version=DataVersion.version + 1, updated_at=now)
+    )
+    if not bumped.rowcount:
+        conn.execute(insert(DataVersion).values(name=DEFINITIONS, version=1, updated_at=now))
+    conn.execute(insert(DataVersion).values(name=LAB_RESULT_FLAGS, version=1, updated_at=now))
+
+
+async def main():
+    try:
+        await run()
+        print("Database is up to date")
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
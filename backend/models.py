@@ -1,27 +1,43 @@
+import unicodedata
 from datetime import date, datetime
 from typing import List, Optional
-from sqlalchemy import String, Float, ForeignKey, Date, DateTime, Integer, Text
-from sqlalchemy.orm import Mapped, mapped_column, relationship, DeclarativeBase
+from sqlalchemy import String, Float, ForeignKey, Date, DateTime, Integer, SmallInteger, Text, Index, select
+from sqlalchemy.orm import Mapped, mapped_column, relationship, column_property, DeclarativeBase
 
 class Base(DeclarativeBase):
     pass
 
+def search_key(text: str) -> str:
+    """``text`` lowercased, without accents and with single spaces: "João  Sá" -> "joao sa"."""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return " ".join("".join(char for char in decomposed if not unicodedata.combining(char)).casefold().split())
+
+def _search_name_default(context) -> str:
+    return search_key(context.get_current_parameters()["full_name"])
+
 class Patient(Base):
     """Core patient demographic data."""
     __tablename__ = "patients"
 
     id: Mapped[int] = mapped_column(primary_key=True)
     full_name: Mapped[str] = mapped_column(String(150))
+    # search_key(full_name), set on insert and by update_patient; indexed by search.py
+    search_name: Mapped[Optional[str]] = mapped_column(String(150), nullable=True, default=_search_name_default)
     date_of_birth: Mapped[date] = mapped_column(Date)
     gender: Mapped[str] = mapped_column(String(20))  # Masculino/Feminino
     height_cm: Mapped[float] = mapped_column(Float)  # Stored in cm
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
-    # Relationships
-    bioimpedance_entries: Mapped[List["BioimpedanceEntry"]] = relationship(back_populates="patient")
-    lab_results: Mapped[List["LabResult"]] = relationship(back_populates="patient")
-    anthropometry_entries: Mapped[List["AnthropometryEntry"]] = relationship(back_populates="patient")
-    subjective_entries: Mapped[List["SubjectiveEntry"]] = relationship(back_populates="patient")
+    # Bumped on every write to the patient or their entries; drives ETag/Last-Modified
+    data_version: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    data_updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+    # Relationships. Child rows go with the patient: the API deletes them set-based
+    # (see delete_patient) and the foreign keys cascade, so the ORM never loads them to delete.
+    bioimpedance_entries: Mapped[List["BioimpedanceEntry"]] = relationship(back_populates="patient", cascade="all, delete-orphan", passive_deletes=True)
+    lab_results: Mapped[List["LabResult"]] = relationship(back_populates="patient", cascade="all, delete-orphan", passive_deletes=True)
+    anthropometry_entries: Mapped[List["AnthropometryEntry"]] = relationship(back_populates="patient", cascade="all, delete-orphan", passive_deletes=True)
+    subjective_entries: Mapped[List["SubjectiveEntry"]] = relationship(back_populates="patient", cascade="all, delete-orphan", passive_deletes=True)
 
 class LabTestDefinition(Base):
     """
@@ -47,9 +63,17 @@ class LabResult(Base):
     One row per test per date.
     """
     __tablename__ = "lab_results"
+    __table_args__ = (
+        # Per-patient history, newest first
+        Index("ix_lab_results_patient_date", "patient_id", "collection_date", "id"),
+        # Evolution of a single test for a patient
+        Index("ix_lab_results_patient_test_date", "patient_id", "test_definition_id", "collection_date"),
+        # Clinic-wide worklist of abnormal results, newest first
+        Index("ix_lab_results_flag_date", "flag", "collection_date", "id"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    patient_id: Mapped[int] = mapped_column(ForeignKey("patients.id"))
+    patient_id: Mapped[int] = mapped_column(ForeignKey("patients.id", ondelete="CASCADE"))
     test_definition_id: Mapped[int] = mapped_column(ForeignKey("lab_test_definitions.id"))
     collection_date: Mapped[date] = mapped_column(Date)
     
@@ -67,9 +91,12 @@ class BioimpedanceEntry(Base):
     Structured as a wide table since these are usually captured in a single scan.
     """
     __tablename__ = "bioimpedance_entries"
+    __table_args__ = (
+        Index("ix_bioimpedance_entries_patient_date", "patient_id", "date", "id"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    patient_id: Mapped[int] = mapped_column(ForeignKey("patients.id"))
+    patient_id: Mapped[int] = mapped_column(ForeignKey("patients.id", ondelete="CASCADE"))
     date: Mapped[date] = mapped_column(Date)
 
     weight_kg: Mapped[float] = mapped_column(Float)
@@ -88,9 +115,12 @@ class AnthropometryEntry(Base):
     Tape measurements (Medidas).
     """
     __tablename__ = "anthropometry_entries"
+    __table_args__ = (
+        Index("ix_anthropometry_entries_patient_date", "patient_id", "date", "id"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    patient_id: Mapped[int] = mapped_column(ForeignKey("patients.id"))
+    patient_id: Mapped[int] = mapped_column(ForeignKey("patients.id", ondelete="CASCADE"))
     date: Mapped[date] = mapped_column(Date)
 
     waist_cm: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
@@ -103,18 +133,99 @@ class AnthropometryEntry(Base):
 
     patient: Mapped["Patient"] = relationship(back_populates="anthropometry_entries")
 
+class SubjectiveMetric(Base):
+    """
+    Dictionary of subjective metric names ('Sono', 'Libido', 'Energia'). Entries
+    reference a metric by its small id instead of repeating the name on every row;
+    the API still reads and writes names (see subjective_metrics.py).
+    """
+    __tablename__ = "subjective_metrics"
+
+    # SQLite only autoincrements an INTEGER PRIMARY KEY
+    id: Mapped[int] = mapped_column(SmallInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    name: Mapped[str] = mapped_column(String(50), unique=True)
+
 class SubjectiveEntry(Base):
     """
     Weekly/Daily logs for Sleep, Libido, Energy.
     """
     __tablename__ = "subjective_entries"
+    __table_args__ = (
+        Index("ix_subjective_entries_patient_date", "patient_id", "date", "id"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    patient_id: Mapped[int] = mapped_column(ForeignKey("patients.id"))
+    patient_id: Mapped[int] = mapped_column(ForeignKey("patients.id", ondelete="CASCADE"))
     date: Mapped[date] = mapped_column(Date)
 
-    metric_name: Mapped[str] = mapped_column(String(50)) # 'Sono', 'Libido', 'Energia'
+    metric_id: Mapped[int] = mapped_column(SmallInteger, ForeignKey("subjective_metrics.id"))
+    # Resolved in SQL wherever entries are read, RETURNING clauses included
+    metric_name: Mapped[str] = column_property(
+        select(SubjectiveMetric.name).where(SubjectiveMetric.id == metric_id).scalar_subquery()
+    )
     score: Mapped[int] = mapped_column(Integer) # 1-10 Scale or similar
     notes: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
 
-    patient: Mapped["Patient"] = relationship(back_populates="subjective_entries")
\ No newline at end of file
+    patient: Mapped["Patient"] = relationship(back_populates="subjective_entries")
+
+class PopulationStat(Base):
+    """
+    Running aggregates of one metric (a lab test or a bioimpedance column) over every
+    patient of a gender and age band, maintained incrementally by the write
+    handlers (see ``population_stats.py``).
+    """
+    __tablename__ = "population_stats"
+
+    source: Mapped[str] = mapped_column(String(20), primary_key=True)  # 'lab' or 'bioimpedance'
+    metric: Mapped[str] = mapped_column(String(50), primary_key=True)  # definition id or column name
+    gender: Mapped[str] = mapped_column(String(20), primary_key=True)
+    age_band: Mapped[str] = mapped_column(String(10), primary_key=True)
+
+    count: Mapped[int] = mapped_column(Integer, default=0)
+    mean: Mapped[float] = mapped_column(Float, default=0.0, server_default="0")
+    m2: Mapped[float] = mapped_column(Float, default=0.0, server_default="0")  # sum of squared deviations from the mean
+
+class PopulationStatBin(Base):
+    """Log-scale histogram bucket of a ``PopulationStat``, for percentile estimates."""
+    __tablename__ = "population_stat_bins"
+
+    source: Mapped[str] = mapped_column(String(20), primary_key=True)
+    metric: Mapped[str] = mapped_column(String(50), primary_key=True)
+    gender: Mapped[str] = mapped_column(String(20), primary_key=True)
+    age_band: Mapped[str] = mapped_column(String(10), primary_key=True)
+    bin: Mapped[int] = mapped_column(Integer, primary_key=True)
+
+    count: Mapped[int] = mapped_column(Integer, default=0)
+
+class LatestLabValue(Base):
+    """Points at each patient's most recent result of every test (see ``latest.py``)."""
+    __tablename__ = "latest_lab_values"
+
+    patient_id: Mapped[int] = mapped_column(ForeignKey("patients.id", ondelete="CASCADE"), primary_key=True)
+    test_definition_id: Mapped[int] = mapped_column(ForeignKey("lab_test_definitions.id", ondelete="CASCADE"), primary_key=True)
+    lab_result_id: Mapped[int] = mapped_column(ForeignKey("lab_results.id", ondelete="CASCADE"))
+
+class LatestBioimpedance(Base):
+    """Points at each patient's most recent bioimpedance scan."""
+    __tablename__ = "latest_bioimpedance"
+
+    patient_id: Mapped[int] = mapped_column(ForeignKey("patients.id", ondelete="CASCADE"), primary_key=True)
+    entry_id: Mapped[int] = mapped_column(ForeignKey("bioimpedance_entries.id", ondelete="CASCADE"))
+
+class LatestAnthropometry(Base):
+    """Points at each patient's most recent tape measurements."""
+    __tablename__ = "latest_anthropometry"
+
+    patient_id: Mapped[int] = mapped_column(ForeignKey("patients.id", ondelete="CASCADE"), primary_key=True)
+    entry_id: Mapped[int] = mapped_column(ForeignKey("anthropometry_entries.id", ondelete="CASCADE"))
+
+class DataVersion(Base):
+    """
+    Version of a shared catalog that patient views are built from, e.g. the lab
+    definitions; bumped by its write handlers (see ``versioning.py``).
+    """
+    __tablename__ = "data_versions"
+
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
@@ -0,0 +1,52 @@
+"""
+Single-statement write paths for the mutation handlers.
+
+``INSERT ... RETURNING`` creates a row and hands back the full response row,
+server defaults and generated id included, so creates need no refresh.
+``UPDATE ... RETURNING`` and ``DELETE ... RETURNING`` change one row by id and hand
+back the columns the handler needs in the same round trip, without loading or
+tracking an ORM instance; an empty result means the row does not exist and the
+handler answers 404. Handlers whose derived state depends on the values a row
+had before the write (population statistics, latest pointers, the versions of a
+patient the row moves away from) read just those columns first with ``previous``.
+"""
+from typing import Any, Dict, Optional, Type
+
+from sqlalchemy import delete, insert, update
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from models import Base
+
+
+async def insert_returning(db: AsyncSession, model: Type[Base], values: Dict[str, Any], *columns) -> Row:
+    """Insert one row and return its ``columns``."""
+    return (await db.execute(insert(model).values(**values).returning(*columns))).one()
+
+
+async def previous(db: AsyncSession, model: Type[Base], row_id: int, *columns) -> Optional[Row]:
+    """The current values of ``columns`` of one row, or None if it does not exist."""
+    return (await db.execute(select(*columns).where(model.id == row_id))).first()
+
+
+async def update_returning(
+    db: AsyncSession, model: Type[Base], row_id: int, values: Dict[str, Any], *columns,
+) -> Optional[Row]:
+    """Apply ``values`` to one row and return its new ``columns``, or None if it does not exist."""
+    if not values:
+        return await previous(db, model, row_id, *columns)
+    result = await db.execute(
+        update(model).where(model.id == row_id).values(**values).returning(*columns)
+        .execution_options(synchronize_session=False)
+    )
+    return result.first()
+
+
+async def delete_returning(db: AsyncSession, model: Type[Base], row_id: int, *columns) -> Optional[Row]:
+    """Delete one row and return its ``columns``, or None if it did not exist."""
+    result = await db.execute(
+        delete(model).where(model.id == row_id).returning(*columns)
+        .execution_options(synchronize_session=False)
+    )
+    return result.first()
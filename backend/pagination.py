@@ -0,0 +1,77 @@
+"""
+Keyset (cursor) pagination helpers.
+
+A page is selected with ``WHERE (k1, k2, ...) > (v1, v2, ...)`` on the same keys the
+statement is ordered by, so fetching page N costs the same index seek as page 1.
+The cursor is the key of the last row of the previous page, encoded as opaque
+url-safe base64 JSON. Bodies stay plain lists; the cursor for the next page is
+returned in the ``X-Next-Cursor`` header and is absent on the last page.
+"""
+import base64
+import json
+from datetime import date, datetime
+from typing import Any, List, Optional, Sequence
+
+from fastapi import HTTPException, Response
+from sqlalchemy import Select, tuple_
+from sqlalchemy.orm import InstrumentedAttribute
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    payload = [value.isoformat() if isinstance(value, (date, datetime)) else value for value in values]
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, keys: Sequence[InstrumentedAttribute]) -> List[Any]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        if not isinstance(payload, list) or len(payload) != len(keys):
+            raise ValueError("cursor does not match the page keys")
+        return [_coerce(key, value) for key, value in zip(keys, payload)]
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _coerce(key: InstrumentedAttribute, value: Any) -> Any:
+    python_type = key.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    if python_type is date:
+        return date.fromisoformat(value)
+    return python_type(value)
+
+
+def keyset_page(
+    statement: Select,
+    keys: Sequence[InstrumentedAttribute],
+    cursor: Optional[str],
+    limit: int,
+    descending: bool = False,
+) -> Select:
+    """
+    Restrict ``statement`` to the page after ``cursor``. ``statement`` must already be
+    ordered by ``keys`` in the given direction. One extra row is fetched so
+    ``finish_page`` can tell whether another page exists.
+    """
+    if cursor is not None:
+        row_key = tuple_(*keys)
+        boundary = tuple_(*decode_cursor(cursor, keys))
+        statement = statement.where(row_key < boundary if descending else row_key > boundary)
+    return statement.limit(limit + 1)
+
+
+def finish_page(items: Sequence[Any], keys: Sequence[InstrumentedAttribute], limit: int, response: Response) -> List[Any]:
+    """Trim the look-ahead row and emit the next cursor header when there is one."""
+    items = list(items)
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor([getattr(last, key.key) for key in keys])
+    return items
@@ -0,0 +1,356 @@
+"""
+Population reference statistics per lab test and bioimpedance metric.
+
+For every (metric, gender, age band) the database keeps the count, mean and sum of
+squared deviations from the mean (Welford's M2) of the measured values, plus a
+log-scale histogram (relative accuracy ``ALPHA``, as in DDSketch) from which
+percentiles are estimated. Write handlers call ``update`` with the rows they add
+and remove, in the same transaction, and the aggregates are merged in with atomic
+``INSERT ... ON CONFLICT DO UPDATE`` statements (Chan et al.'s pairwise update),
+so nothing is ever recomputed from the raw tables on a read.
+
+Age bands use the patient's age on the measurement date, which never changes;
+only edits to the patient's gender or date of birth move their rows between
+cells (``move_patient``). Existing databases are backfilled once with ``rebuild``:
+
+    python population_stats.py
+"""
+import asyncio
+import functools
+import math
+from collections import defaultdict
+from datetime import date
+from typing import Any, Dict, Iterable, List, Literal, NamedTuple, Optional, Sequence, Tuple
+
+from sqlalchemy import case, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from database import async_session_factory, engine
+from models import Patient, LabResult, BioimpedanceEntry, PopulationStat, PopulationStatBin
+
+Source = Literal["lab", "bioimpedance"]
+
+# Histogram bins are within 1% of every value they hold
+ALPHA = 0.01
+GAMMA = (1 + ALPHA) / (1 - ALPHA)
+_LOG_GAMMA = math.log(GAMMA)
+# Values at or below zero (not meaningful for these metrics) share one bin
+ZERO_BIN = -(2 ** 31)
+
+AGE_BAND_WIDTH = 10
+OLDEST_AGE_BAND = 80
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# Rows read from the raw tables per round trip by ``rebuild``
+REBUILD_CHUNK_SIZE = 5000
+
+BIOIMPEDANCE_METRICS = tuple(
+    column.key for column in BioimpedanceEntry.__table__.columns
+    if column.key not in ("id", "patient_id", "date")
+)
+
+_CELL = ("source", "metric", "gender", "age_band")
+
+
+class Sample(NamedTuple):
+    patient_id: int
+    metric: str
+    measured_on: date
+    value: float
+
+
+class Profile(NamedTuple):
+    gender: str
+    date_of_birth: date
+
+
+@functools.lru_cache(maxsize=65536)
+def age_band(date_of_birth: date, measured_on: date) -> str:
+    age = measured_on.year - date_of_birth.year - ((measured_on.month, measured_on.day) < (date_of_birth.month, date_of_birth.day))
+    lower = min(max(age, 0) // AGE_BAND_WIDTH * AGE_BAND_WIDTH, OLDEST_AGE_BAND)
+    if lower == OLDEST_AGE_BAND:
+        return f"{OLDEST_AGE_BAND}+"
+    return f"{lower}-{lower + AGE_BAND_WIDTH - 1}"
+
+
+def bin_index(value: float) -> int:
+    if value <= 0:
+        return ZERO_BIN
+    return math.ceil(math.log(value) / _LOG_GAMMA)
+
+
+def bin_value(index: int) -> float:
+    """Representative value of a bin: within ``ALPHA`` of everything in it."""
+    if index == ZERO_BIN:
+        return 0.0
+    return 2 * GAMMA ** index / (GAMMA + 1)
+
+
+def _field(row: Any, name: str) -> Any:
+    return row[name] if isinstance(row, dict) else getattr(row, name)
+
+
+def lab_samples(rows: Iterable[Any]) -> List[Sample]:
+    """Samples of lab result rows (ORM objects or dicts)."""
+    return [
+        Sample(_field(row, "patient_id"), str(_field(row, "test_definition_id")), _field(row, "collection_date"), _field(row, "value"))
+        for row in rows
+    ]
+
+
+def bioimpedance_samples(rows: Iterable[Any]) -> List[Sample]:
+    """One sample per non-null metric of each bioimpedance row (ORM objects or dicts)."""
+    return [
+        Sample(_field(row, "patient_id"), metric, _field(row, "date"), _field(row, metric))
+        for row in rows for metric in BIOIMPEDANCE_METRICS
+        if _field(row, metric) is not None
+    ]
+
+
+class _Deltas:
+    def __init__(self):
+        # Per cell: signed count, and the signed sums of (value - shift) and its
+        # square around the cell's first value, which keeps them small
+        self.stats: Dict[Tuple, List[float]] = {}
+        self.bins: Dict[Tuple, int] = defaultdict(int)
+
+    def add(self, source: str, sample: Sample, profile: Profile, sign: int) -> None:
+        cell = (source, sample.metric, profile.gender, age_band(profile.date_of_birth, sample.measured_on))
+        value = float(sample.value)
+        stat = self.stats.setdefault(cell, [0, value, 0.0, 0.0])
+        offset = value - stat[1]
+        stat[0] += sign
+        stat[2] += sign * offset
+        stat[3] += sign * offset * offset
+        self.bins[cell + (bin_index(value),)] += sign
+
+    def moments(self) -> Iterable[Tuple[Tuple, int, float, float]]:
+        """
+        ``(cell, count, mean, m2)`` of every changed cell, in key order. Removals make
+        them signed; an edit within one cell has no count, so its mean and m2 carry
+        the change of the sum and of the sum of squares instead (see ``_merge``).
+        """
+        for cell, (count, shift, offsets, squares) in sorted(self.stats.items()):
+            if count:
+                yield cell, count, shift + offsets / count, squares - offsets * offsets / count
+            elif offsets or squares:
+                yield cell, 0, offsets, squares + 2 * shift * offsets
+
+
+async def _profiles(db: AsyncSession, patient_ids: Iterable[int]) -> Dict[int, Profile]:
+    ids = set(patient_ids)
+    if not ids:
+        return {}
+    result = await db.execute(select(Patient.id, Patient.gender, Patient.date_of_birth).where(Patient.id.in_(ids)))
+    return {row.id: Profile(row.gender, row.date_of_birth) for row in result.all()}
+
+
+def _insert(db: AsyncSession):
+    return postgresql.insert if db.get_bind().dialect.name == "postgresql" else sqlite.insert
+
+
+def _merge(excluded) -> Dict[str, Any]:
+    """The stored moments merged with a delta row from ``_Deltas.moments``."""
+    count, mean, m2 = PopulationStat.count, PopulationStat.mean, PopulationStat.m2
+    total = count + excluded.count
+    difference = excluded.mean - mean
+    merged_mean = case(
+        (total <= 0, 0.0),
+        (count <= 0, excluded.mean),
+        (excluded.count == 0, mean + excluded.mean / total),
+        else_=mean + difference * excluded.count / total,
+    )
+    merged_m2 = case(
+        (total <= 0, 0.0),
+        (count <= 0, excluded.m2),
+        # excluded.mean and excluded.m2 are the changes of the sum and the sum of squares
+        (excluded.count == 0, m2 + excluded.m2 - 2 * mean * excluded.mean - excluded.mean * excluded.mean / total),
+        else_=m2 + excluded.m2 + difference * difference * count * excluded.count / total,
+    )
+    return {"count": total, "mean": merged_mean, "m2": merged_m2}
+
+
+async def _apply(db: AsyncSession, deltas: _Deltas) -> None:
+    # Rows are upserted in key order, not arrival order: concurrent transactions
+    # touching overlapping cells then lock them in the same order and cannot deadlock
+    insert = _insert(db)
+    stats = [dict(zip(_CELL, cell), count=count, mean=mean, m2=m2) for cell, count, mean, m2 in deltas.moments()]
+    if stats:
+        statement = insert(PopulationStat)
+        await db.execute(statement.on_conflict_do_update(index_elements=list(_CELL), set_=_merge(statement.excluded)), stats)
+
+    bins = [dict(zip(_CELL + ("bin",), key), count=count) for key, count in sorted(deltas.bins.items()) if count]
+    if bins:
+        statement = insert(PopulationStatBin)
+        await db.execute(statement.on_conflict_do_update(
+            index_elements=list(_CELL + ("bin",)),
+            set_={"count": PopulationStatBin.count + statement.excluded.count},
+        ), bins)
+
+
+async def update(
+    db: AsyncSession, source: Source, added: Sequence[Sample] = (), removed: Sequence[Sample] = (),
+) -> None:
+    """Fold rows added to and removed from ``source`` into the aggregates; call before committing."""
+    profiles = await _profiles(db, [sample.patient_id for sample in (*added, *removed)])
+    deltas = _Deltas()
+    for samples, sign in ((added, 1), (removed, -1)):
+        for sample in samples:
+            profile = profiles.get(sample.patient_id)
+            if profile is not None:
+                deltas.add(source, sample, profile, sign)
+    await _apply(db, deltas)
+
+
+async def add_known(db: AsyncSession, source: Source, samples: Iterable[Sample], profiles: Dict[int, Profile]) -> None:
+    """``update`` for bulk loaders that already hold the patients' profiles."""
+    deltas = _Deltas()
+    for sample in samples:
+        deltas.add(source, sample, profiles[sample.patient_id], 1)
+    await _apply(db, deltas)
+
+
+async def _patient_samples(db: AsyncSession, patient_id: int) -> Dict[str, List[Sample]]:
+    # Built from the raw tuples: a patient can have a very long history
+    labs = await db.execute(select(
+        LabResult.test_definition_id, LabResult.collection_date, LabResult.value
+    ).where(LabResult.patient_id == patient_id))
+    bioimpedance = await db.execute(select(
+        BioimpedanceEntry.date, *(getattr(BioimpedanceEntry, metric) for metric in BIOIMPEDANCE_METRICS),
+    ).where(BioimpedanceEntry.patient_id == patient_id))
+    return {
+        "lab": [Sample(patient_id, str(definition_id), measured_on, value) for definition_id, measured_on, value in labs.tuples()],
+        "bioimpedance": [
+            Sample(patient_id, metric, row[0], value)
+            for row in bioimpedance.tuples()
+            for metric, value in zip(BIOIMPEDANCE_METRICS, row[1:]) if value is not None
+        ],
+    }
+
+
+async def move_patient(db: AsyncSession, patient_id: int, old: Optional[Profile], new: Optional[Profile]) -> None:
+    """
+    Move a patient's rows between cells after their gender or date of birth changed;
+    ``new=None`` removes them (patient deletion).
+    """
+    deltas = _Deltas()
+    for source, samples in (await _patient_samples(db, patient_id)).items():
+        for sample in samples:
+            if old is not None:
+                deltas.add(source, sample, old, -1)
+            if new is not None:
+                deltas.add(source, sample, new, 1)
+    await _apply(db, deltas)
+
+
+async def drop_metric(db: AsyncSession, source: Source, metric: str) -> None:
+    for model in (PopulationStat, PopulationStatBin):
+        await db.execute(delete(model).where(model.source == source, model.metric == metric))
+
+
+async def rebuild(db: AsyncSession) -> None:
+    """
+    Recompute every aggregate from the raw tables. Rows are streamed with their
+    patient's profile joined in and merged ``REBUILD_CHUNK_SIZE`` at a time, so
+    memory stays flat however large the tables are.
+    """
+    await db.execute(delete(PopulationStatBin))
+    await db.execute(delete(PopulationStat))
+
+    profile = (Patient.gender, Patient.date_of_birth)
+    sources = (
+        ("lab", lab_samples, select(
+            LabResult.patient_id, LabResult.test_definition_id, LabResult.collection_date, LabResult.value, *profile,
+        ).join(Patient, Patient.id == LabResult.patient_id)),
+        ("bioimpedance", bioimpedance_samples, select(
+            BioimpedanceEntry.patient_id, BioimpedanceEntry.date,
+            *(getattr(BioimpedanceEntry, metric) for metric in BIOIMPEDANCE_METRICS), *profile,
+        ).join(Patient, Patient.id == BioimpedanceEntry.patient_id)),
+    )
+    for source, samples, statement in sources:
+        result = await db.stream(statement.execution_options(yield_per=REBUILD_CHUNK_SIZE))
+        async for rows in result.partitions():
+            profiles = {row.patient_id: Profile(row.gender, row.date_of_birth) for row in rows}
+            deltas = _Deltas()
+            for sample in samples(rows):
+                deltas.add(source, sample, profiles[sample.patient_id], 1)
+            await _apply(db, deltas)
+
+
+async def ensure_built(db: AsyncSession) -> None:
+    """Backfill databases that predate the aggregates; a no-op once they exist."""
+    if (await db.execute(select(PopulationStat.count).limit(1))).first() is not None:
+        return
+    has_rows = (await db.execute(select(LabResult.id).limit(1))).first() or \
+        (await db.execute(select(BioimpedanceEntry.id).limit(1))).first()
+    if has_rows:
+        await rebuild(db)
+        await db.commit()
+
+
+def _percentiles(bins: Sequence[Tuple[int, int]], count: int) -> Dict[str, float]:
+    percentiles = {}
+    cumulative = 0
+    targets = iter(PERCENTILES)
+    target = next(targets)
+    for index, bin_count in bins:
+        cumulative += bin_count
+        # Nearest rank: the bin holding the round(q * (n - 1))-th smallest value
+        while target is not None and cumulative > round(target / 100 * (count - 1)):
+            percentiles[f"p{target}"] = bin_value(index)
+            target = next(targets, None)
+    return percentiles
+
+
+async def read(
+    db: AsyncSession, source: Source, metric: str, gender: Optional[str] = None, band: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """The aggregates of one metric per (gender, age band); reads only that metric's cells."""
+    filters = [PopulationStat.source == source, PopulationStat.metric == metric, PopulationStat.count > 0]
+    bin_filters = [PopulationStatBin.source == source, PopulationStatBin.metric == metric, PopulationStatBin.count > 0]
+    if gender is not None:
+        filters.append(PopulationStat.gender == gender)
+        bin_filters.append(PopulationStatBin.gender == gender)
+    if band is not None:
+        filters.append(PopulationStat.age_band == band)
+        bin_filters.append(PopulationStatBin.age_band == band)
+
+    stats = await db.execute(select(PopulationStat).where(*filters).order_by(PopulationStat.gender, PopulationStat.age_band))
+    bins = await db.execute(
+        select(PopulationStatBin.gender, PopulationStatBin.age_band, PopulationStatBin.bin, PopulationStatBin.count)
+        .where(*bin_filters).order_by(PopulationStatBin.gender, PopulationStatBin.age_band, PopulationStatBin.bin)
+    )
+    histograms: Dict[Tuple[str, str], List[Tuple[int, int]]] = defaultdict(list)
+    for row in bins.all():
+        histograms[(row.gender, row.age_band)].append((row.bin, row.count))
+
+    cells = []
+    for stat in stats.scalars().all():
+        variance = max(stat.m2, 0.0) / (stat.count - 1) if stat.count > 1 else 0.0
+        cells.append({
+            "gender": stat.gender,
+            "age_band": stat.age_band,
+            "count": stat.count,
+            "mean": stat.mean,
+            "variance": variance,
+            "std_dev": math.sqrt(variance),
+            "percentiles": _percentiles(histograms[(stat.gender, stat.age_band)], stat.count),
+        })
+    return cells
+
+
+async def main():
+    try:
+        async with async_session_factory() as session:
+            await rebuild(session)
+            await session.commit()
+        print("Rebuilt population statistics")
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
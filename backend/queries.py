@@ -0,0 +1,111 @@
+"""
+Statement builders for the per-patient series.
+
+Every series is returned newest first, ordered by ``(date, id)`` so the order is
+total and matches the composite ``(patient_id, date, id)`` indexes declared in
+``models.py``; the database walks the index backwards instead of sorting. The
+same keys drive keyset pagination (see ``pagination.py``).
+
+Builders select whole entities by default; pass ``columns`` to project just those
+(see ``projection.py``).
+"""
+from datetime import date
+from typing import Optional, Sequence
+
+from sqlalchemy import Float, Select, case, cast, func
+from sqlalchemy.future import select
+
+from models import Patient, LabTestDefinition, LabResult, BioimpedanceEntry, AnthropometryEntry, SubjectiveEntry, SubjectiveMetric
+
+
+LAB_RESULT_KEYS = (LabResult.collection_date, LabResult.id)
+BIOIMPEDANCE_KEYS = (BioimpedanceEntry.date, BioimpedanceEntry.id)
+ANTHROPOMETRY_KEYS = (AnthropometryEntry.date, AnthropometryEntry.id)
+SUBJECTIVE_KEYS = (SubjectiveEntry.date, SubjectiveEntry.id)
+
+
+def patient_lab_results(patient_id: int, *columns) -> Select:
+    return (
+        select(*(columns or (LabResult,)))
+        .where(LabResult.patient_id == patient_id)
+        .order_by(LabResult.collection_date.desc(), LabResult.id.desc())
+    )
+
+
+def patient_bioimpedance(patient_id: int, *columns) -> Select:
+    return (
+        select(*(columns or (BioimpedanceEntry,)))
+        .where(BioimpedanceEntry.patient_id == patient_id)
+        .order_by(BioimpedanceEntry.date.desc(), BioimpedanceEntry.id.desc())
+    )
+
+
+def patient_anthropometry(patient_id: int, *columns) -> Select:
+    return (
+        select(*(columns or (AnthropometryEntry,)))
+        .where(AnthropometryEntry.patient_id == patient_id)
+        .order_by(AnthropometryEntry.date.desc(), AnthropometryEntry.id.desc())
+    )
+
+
+def patient_subjective(patient_id: int, *columns) -> Select:
+    return (
+        select(*(columns or (SubjectiveEntry,)))
+        .where(SubjectiveEntry.patient_id == patient_id)
+        .order_by(SubjectiveEntry.date.desc(), SubjectiveEntry.id.desc())
+    )
+
+
+def patient_subjective_metrics(patient_id: int) -> Select:
+    """The metrics a patient has logged, by name."""
+    logged = select(SubjectiveEntry.metric_id).where(SubjectiveEntry.patient_id == patient_id)
+    return (
+        select(SubjectiveMetric.id, SubjectiveMetric.name)
+        .where(SubjectiveMetric.id.in_(logged))
+        .order_by(SubjectiveMetric.name)
+    )
+
+
+def subjective_pivot(patient_id: int, metric_ids: Sequence[int]) -> Select:
+    """
+    A patient's subjective entries pivoted by conditional aggregation: one row per
+    date, newest first, holding the date and the mean score of each of
+    ``metric_ids`` on it (NULL where it was not logged).
+    """
+    score = cast(SubjectiveEntry.score, Float)
+    return (
+        select(
+            SubjectiveEntry.date,
+            *(
+                func.avg(case((SubjectiveEntry.metric_id == metric_id, score))).label(f"metric_{index}")
+                for index, metric_id in enumerate(metric_ids)
+            ),
+        )
+        .where(SubjectiveEntry.patient_id == patient_id)
+        .group_by(SubjectiveEntry.date)
+        .order_by(SubjectiveEntry.date.desc())
+    )
+
+
+def lab_alerts(flag: str, since: date, category: Optional[str] = None) -> Select:
+    """
+    Results with ``flag`` collected on or after ``since``, newest first, with the
+    patient's name and the test definition. A single flag walks the
+    ``(flag, collection_date, id)`` index backwards; callers wanting several
+    flags merge one query per flag.
+    """
+    statement = (
+        select(
+            LabResult.id, LabResult.patient_id, Patient.full_name.label("patient_name"),
+            LabResult.test_definition_id, LabTestDefinition.name.label("test_name"),
+            LabTestDefinition.category, LabTestDefinition.unit,
+            LabResult.collection_date, LabResult.value, LabResult.flag,
+        )
+        .join(Patient, Patient.id == LabResult.patient_id)
+        .join(LabTestDefinition, LabTestDefinition.id == LabResult.test_definition_id)
+        .where(LabResult.flag == flag, LabResult.collection_date >= since)
+        .order_by(LabResult.collection_date.desc(), LabResult.id.desc())
+    )
+    if category is not None:
+        statement = statement.where(LabTestDefinition.category == category)
+    return statement
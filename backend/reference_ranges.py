@@ -0,0 +1,160 @@
+"""
+Server-side lab result flagging.
+
+Flags are computed on write from the ``LabTestDefinition`` reference ranges and the
+patient's gender, using the same rules the dashboard used to apply in the browser.
+When a test has no reference range for the patient's gender, the client-provided
+flag is kept as is.
+
+A flag is stored with the result, so it must not be computed from stale data in
+any worker. Single-row writes compute it inside their ``INSERT``/``UPDATE`` with
+``flag_expression``, from the rows current in that transaction. Batches, which
+also reject unknown tests, read their patients' genders together with the lab
+definitions version (see ``versioning.py``) in one statement; ranges are cached
+in process for as long as that version stays the same, and read by id on a miss.
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import String, and_, case, func, literal
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.sql.operators import ColumnOperators
+
+from models import DataVersion, LabResult, LabTestDefinition, Patient
+from versioning import DEFINITIONS
+
+FLAG_LOW = "Baixo"
+FLAG_NORMAL = "Normal"
+FLAG_HIGH = "Alto"
+
+ABNORMAL_FLAGS = (FLAG_LOW, FLAG_HIGH)
+
+
+def is_female(gender: Optional[str]) -> bool:
+    return bool(gender) and gender.lower().startswith("f")
+
+
+@dataclass(frozen=True)
+class ReferenceRange:
+    ref_min_male: Optional[float]
+    ref_max_male: Optional[float]
+    ref_min_female: Optional[float]
+    ref_max_female: Optional[float]
+
+    def bounds(self, gender: Optional[str]) -> Tuple[Optional[float], Optional[float]]:
+        if is_female(gender):
+            return self.ref_min_female, self.ref_max_female
+        return self.ref_min_male, self.ref_max_male
+
+
+def compute_flag(value: float, reference: Optional[ReferenceRange], gender: Optional[str]) -> Optional[str]:
+    """Low/Normal/High for ``value``, or None when there is no range to compare against."""
+    if reference is None:
+        return None
+    lower, upper = reference.bounds(gender)
+    if lower is None and upper is None:
+        return None
+    if lower is not None and value < lower:
+        return FLAG_LOW
+    if upper is not None and value > upper:
+        return FLAG_HIGH
+    return FLAG_NORMAL
+
+
+@dataclass(frozen=True)
+class References:
+    """What one write needs to flag its results: ranges (None for unknown tests) and genders."""
+    ranges: Dict[int, Optional[ReferenceRange]]
+    genders: Dict[int, Optional[str]]
+
+    def flag(self, patient_id: int, definition_id: int, value: float, fallback: Optional[str] = None) -> Optional[str]:
+        computed = compute_flag(value, self.ranges.get(definition_id), self.genders.get(patient_id))
+        return computed if computed is not None else fallback
+
+
+class ReferenceRangeCache:
+    """
+    Reference ranges by definition id, unknown ids included (as None), valid for
+    one lab definitions version. Patient genders are not cached: they are read
+    in the statement that checks the version.
+    """
+
+    def __init__(self):
+        self._version: Optional[int] = None
+        self._ranges: Dict[int, Optional[ReferenceRange]] = {}
+
+    async def load(self, db: AsyncSession, patient_ids: Iterable[int], definition_ids: Iterable[int]) -> References:
+        patient_ids, definition_ids = set(patient_ids), set(definition_ids)
+        version = func.coalesce(
+            select(DataVersion.version).where(DataVersion.name == DEFINITIONS).scalar_subquery(), 0
+        ).label("version")
+        rows = []
+        if patient_ids:
+            rows = (await db.execute(select(Patient.id, Patient.gender, version).where(Patient.id.in_(patient_ids)))).all()
+        current = rows[0].version if rows else (await db.execute(select(version))).scalar_one()
+        if current != self._version:
+            self._version, self._ranges = current, {}
+
+        ranges = {definition_id: self._ranges[definition_id] for definition_id in definition_ids if definition_id in self._ranges}
+        missing = definition_ids - ranges.keys()
+        if missing:
+            result = await db.execute(select(
+                LabTestDefinition.id,
+                LabTestDefinition.ref_min_male, LabTestDefinition.ref_max_male,
+                LabTestDefinition.ref_min_female, LabTestDefinition.ref_max_female,
+            ).where(LabTestDefinition.id.in_(missing)))
+            found = {row.id: ReferenceRange(*row[1:]) for row in result.all()}
+            ranges.update({definition_id: found.get(definition_id) for definition_id in missing})
+            # Unless another request saw a newer version meanwhile
+            if self._version == current:
+                self._ranges.update(ranges)
+        return References(ranges, {row.id: row.gender for row in rows})
+
+    def clear(self) -> None:
+        self._version = None
+        self._ranges = {}
+
+
+reference_cache = ReferenceRangeCache()
+
+
+def flag_expression(
+    patient_id: Any = LabResult.patient_id,
+    definition_id: Any = LabResult.test_definition_id,
+    value: Any = LabResult.value,
+    fallback: Any = LabResult.flag,
+):
+    """
+    SQL equivalent of ``compute_flag``. By default it re-flags stored results in
+    bulk, e.g. after a definition's ranges or a patient's gender change, and rows
+    without a range for their patient's gender keep their current flag. Given
+    plain values instead, it flags the row an ``INSERT``/``UPDATE`` is writing,
+    with no lookup before the statement.
+    """
+    patient_id, definition_id, value = (
+        argument if isinstance(argument, ColumnOperators) else literal(argument)
+        for argument in (patient_id, definition_id, value)
+    )
+    if not isinstance(fallback, ColumnOperators):
+        fallback = literal(fallback, String)
+    female = func.lower(
+        select(Patient.gender).where(Patient.id == patient_id).correlate(LabResult).scalar_subquery()
+    ).like("f%")
+
+    def bound(female_column, male_column):
+        return (
+            select(case((female, female_column), else_=male_column))
+            .where(LabTestDefinition.id == definition_id)
+            .correlate(LabResult)
+            .scalar_subquery()
+        )
+
+    lower = bound(LabTestDefinition.ref_min_female, LabTestDefinition.ref_min_male)
+    upper = bound(LabTestDefinition.ref_max_female, LabTestDefinition.ref_max_male)
+    return case(
+        (and_(lower.is_(None), upper.is_(None)), fallback),
+        (value < lower, FLAG_LOW),
+        (value > upper, FLAG_HIGH),
+        else_=FLAG_NORMAL,
+    )
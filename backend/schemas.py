@@ -1,6 +1,6 @@
 from pydantic import BaseModel, ConfigDict
 from datetime import date as DateType, datetime
-from typing import List, Optional
+from typing import Any, Dict, Generic, List, Optional, TypeVar, Union
 
 # --- Patient Schemas ---
 class PatientBase(BaseModel):
@@ -78,6 +78,19 @@ class LabResult(LabResultBase):
 
     model_config = ConfigDict(from_attributes=True)
 
+class LabAlert(BaseModel):
+    """An out-of-range result on the clinic-wide worklist."""
+    id: int
+    patient_id: int
+    patient_name: str
+    test_definition_id: int
+    test_name: str
+    category: str
+    unit: str
+    collection_date: DateType
+    value: float
+    flag: str
+
 # --- BioimpedanceEntry Schemas ---
 class BioimpedanceEntryBase(BaseModel):
     patient_id: int
@@ -164,3 +177,79 @@ class SubjectiveEntry(SubjectiveEntryBase):
     id: int
 
     model_config = ConfigDict(from_attributes=True)
+
+# --- Dashboard Schemas ---
+class PatientDashboard(BaseModel):
+    """Everything the patient dashboard needs, returned in a single response."""
+    patient: Patient
+    lab_definitions: List[LabTestDefinition]
+    lab_results: List[LabResult]
+    bioimpedance_entries: List[BioimpedanceEntry]
+    anthropometry_entries: List[AnthropometryEntry]
+    subjective_entries: List[SubjectiveEntry]
+
+class PatientLatest(BaseModel):
+    """The most recent result of each lab test and the latest scans of a patient."""
+    lab_results: List[LabResult]
+    bioimpedance: Optional[BioimpedanceEntry] = None
+    anthropometry: Optional[AnthropometryEntry] = None
+
+# --- Downsampling Schemas ---
+class SeriesBucket(BaseModel):
+    """One ``?resample=`` period of a series: row count and per-column mean/min/max."""
+    period: DateType
+    # test_definition_id for lab results, metric_name for subjective entries
+    group: Optional[Union[int, str]] = None
+    count: int
+    mean: Dict[str, Optional[float]]
+    min: Dict[str, Optional[float]]
+    max: Dict[str, Optional[float]]
+
+# --- Lab Matrix Schemas ---
+class LabMatrixTest(BaseModel):
+    id: int
+    name: str
+    category: str
+    unit: str
+
+class LabResultMatrix(BaseModel):
+    """A patient's lab results pivoted: ``values[i][j]`` is ``tests[i]`` on ``dates[j]``."""
+    dates: List[DateType]
+    tests: List[LabMatrixTest]
+    values: List[List[Optional[float]]]
+    flags: List[List[Optional[str]]]
+
+# --- Subjective Pivot Schemas ---
+class SubjectivePivotRow(BaseModel):
+    date: DateType
+    # Aligned with SubjectivePivot.metrics; None where the metric was not logged that day
+    scores: List[Optional[float]]
+
+class SubjectivePivot(BaseModel):
+    """A patient's subjective logs as one row per date and one column per metric."""
+    metrics: List[str]
+    rows: List[SubjectivePivotRow]
+
+# --- Population Statistics Schemas ---
+class PopulationStats(BaseModel):
+    """Aggregates of one metric over the patients of a gender and age band."""
+    gender: str
+    age_band: str
+    count: int
+    mean: float
+    variance: float
+    std_dev: float
+    # Estimated within 1%; keys are "p5", "p25", "p50", "p75", "p95"
+    percentiles: Dict[str, float]
+
+# --- Batch Schemas ---
+T = TypeVar("T")
+
+class BatchError(BaseModel):
+    index: int
+    detail: Any
+
+class BatchResult(BaseModel, Generic[T]):
+    """Rows inserted by a batch endpoint, plus the rows rejected and why."""
+    created: List[T]
+    errors: List[BatchError]
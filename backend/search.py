@@ -0,0 +1,199 @@
+"""
+Indexed patient name search.
+
+Names are matched on ``Patient.search_name``, the full name lowercased and without
+accents (``models.search_key``), so "joao" finds "João" and "JOÃO" alike. The
+query is normalized the same way. Matches come in three tiers, ranked in order:
+
+0. the name starts with the query;
+1. a later word of the name starts with it (queries of two or more characters);
+2. every word of the query appears somewhere else in the name (queries with a
+   word of three or more characters, the shortest a trigram index can look up).
+
+Within a tier the newest patients come first. Each tier is its own statement,
+ordered by id and limited to what is left of the page, and later tiers only run
+when the earlier ones did not fill it. The cursor is ``(tier, id)`` of the last
+row, in the ``X-Next-Cursor`` header as with the other lists.
+
+SQLite: ``patients_search`` is a contentless FTS5 table with the trigram
+tokenizer, holding each name prefixed with ``NAME_START`` and kept in sync by
+triggers on ``patients``. A string query on it is a substring match, so the
+marker turns tier 0 into the substring ``NAME_START + query`` and tier 1 into
+``" " + query`` minus tier 0. FTS5 walks the matches in rowid (patient id)
+order, so a page stops after ``limit`` rows rather than ranking every match:
+common surnames like "silva" match a large share of the table.
+
+Postgres: the tiers are ``LIKE`` patterns answered by a ``pg_trgm`` GIN index on
+``search_name``. A GIN index returns no order, so each tier is a bitmap scan over
+all of its matches plus a top-``limit`` sort by id: it does not stop early, and
+short or common terms cost in proportion to how many patients they match.
+
+The index is created with the ``patients`` table and by ``upgrade`` on databases
+that predate it, which also backfills ``search_name``.
+"""
+from typing import Any, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Integer, and_, bindparam, event, literal_column, not_, update
+from sqlalchemy.engine import Connection, Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.sql import Select, column, table
+
+from models import Patient, search_key
+from pagination import decode_cursor, encode_cursor
+
+SEARCH_TABLE = "patients_search"
+
+# Prepended to every indexed name so that "starts with" is a substring match too
+NAME_START = "\x01 "
+
+# Shortest string the trigram indexes can look up
+MIN_TRIGRAM_LENGTH = 3
+
+_fts = table(SEARCH_TABLE, column("rowid", Integer))
+_CURSOR_KEYS = (literal_column("tier", Integer), Patient.id)
+
+_INDEXED_NAME = "char(1) || ' ' || {}.search_name"
+
+_SQLITE_DDL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(name, content='', tokenize='trigram')",
+    # Contentless: a row is removed by repeating the values it was indexed with
+    f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_insert AFTER INSERT ON patients "
+    f"WHEN new.search_name IS NOT NULL BEGIN "
+    f"INSERT INTO {SEARCH_TABLE}(rowid, name) VALUES (new.id, {_INDEXED_NAME.format('new')}); END",
+    f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_delete AFTER DELETE ON patients "
+    f"WHEN old.search_name IS NOT NULL BEGIN "
+    f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, name) VALUES ('delete', old.id, {_INDEXED_NAME.format('old')}); END",
+    f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_update AFTER UPDATE OF search_name ON patients BEGIN "
+    f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, name) "
+    f"SELECT 'delete', old.id, {_INDEXED_NAME.format('old')} WHERE old.search_name IS NOT NULL; "
+    f"INSERT INTO {SEARCH_TABLE}(rowid, name) "
+    f"SELECT new.id, {_INDEXED_NAME.format('new')} WHERE new.search_name IS NOT NULL; END",
+)
+
+_POSTGRES_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_patients_search_name_trgm ON patients USING gin (search_name gin_trgm_ops)",
+)
+
+
+def install(conn: Connection) -> None:
+    """Create the search index for ``patients``; idempotent."""
+    if conn.dialect.name == "sqlite":
+        exists = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SEARCH_TABLE,)
+        ).first()
+        for statement in _SQLITE_DDL:
+            conn.exec_driver_sql(statement)
+        if not exists:
+            # Index the rows written before the table existed
+            conn.exec_driver_sql(
+                f"INSERT INTO {SEARCH_TABLE}(rowid, name) "
+                f"SELECT id, {_INDEXED_NAME.format('patients')} FROM patients WHERE search_name IS NOT NULL"
+            )
+    elif conn.dialect.name == "postgresql":
+        for statement in _POSTGRES_DDL:
+            conn.exec_driver_sql(statement)
+
+
+def upgrade(conn: Connection) -> None:
+    """Fill ``search_name`` for patients created before the column, then install the index."""
+    missing = conn.execute(select(Patient.id, Patient.full_name).where(Patient.search_name.is_(None))).all()
+    if missing:
+        conn.execute(
+            update(Patient.__table__).where(Patient.__table__.c.id == bindparam("patient_id"))
+            .values(search_name=bindparam("key")),
+            [{"patient_id": patient_id, "key": search_key(full_name)} for patient_id, full_name in missing],
+        )
+    install(conn)
+
+
+@event.listens_for(Patient.__table__, "after_create")
+def _after_create(target, connection, **kwargs):
+    install(connection)
+
+
+@event.listens_for(Patient.__table__, "before_drop")
+def _before_drop(target, connection, **kwargs):
+    if connection.dialect.name == "sqlite":
+        connection.exec_driver_sql(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+
+def _phrase(text: str) -> str:
+    # An FTS5 string, which the trigram tokenizer matches as a substring
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _sqlite_tiers(query: str, columns: Sequence[Any]) -> List[Optional[Tuple[Select, Any]]]:
+    words = query.split()
+    matches: List[Optional[Tuple[str, List]]] = [(_phrase(NAME_START + query), []), None, None]
+    if len(query) + 1 >= MIN_TRIGRAM_LENGTH:
+        matches[1] = (f"{_phrase(' ' + query)} NOT {_phrase(NAME_START + query)}", [])
+        indexed = [word for word in words if len(word) >= MIN_TRIGRAM_LENGTH]
+        if indexed:
+            short = [Patient.search_name.contains(word, autoescape=True) for word in words if len(word) < MIN_TRIGRAM_LENGTH]
+            matches[2] = (f"{' '.join(_phrase(word) for word in indexed)} NOT {_phrase(' ' + query)}", short)
+
+    tiers = []
+    for match in matches:
+        if match is None:
+            tiers.append(None)
+            continue
+        expression, conditions = match
+        statement = (
+            select(*columns).select_from(_fts).join(Patient, Patient.id == _fts.c.rowid)
+            .where(literal_column(SEARCH_TABLE).op("MATCH")(expression), *conditions)
+            .order_by(_fts.c.rowid.desc())
+        )
+        tiers.append((statement, _fts.c.rowid))
+    return tiers
+
+
+def _like_tiers(query: str, columns: Sequence[Any]) -> List[Optional[Tuple[Select, Any]]]:
+    words = query.split()
+    starts_name = Patient.search_name.startswith(query, autoescape=True)
+    starts_word = Patient.search_name.contains(" " + query, autoescape=True)
+    conditions = [starts_name, None, None]
+    if len(query) + 1 >= MIN_TRIGRAM_LENGTH:
+        conditions[1] = and_(starts_word, not_(starts_name))
+        if any(len(word) >= MIN_TRIGRAM_LENGTH for word in words):
+            conditions[2] = and_(
+                *(Patient.search_name.contains(word, autoescape=True) for word in words),
+                not_(starts_name), not_(starts_word),
+            )
+    return [
+        None if condition is None else (select(*columns).where(condition).order_by(Patient.id.desc()), Patient.id)
+        for condition in conditions
+    ]
+
+
+async def search_page(
+    db: AsyncSession, query: str, cursor: Optional[str], limit: int, *columns,
+) -> Tuple[List[Row], Optional[str]]:
+    """
+    One page of the patients matching ``query`` (already normalized with
+    ``search_key`` and not empty) and the cursor of the next page, if any.
+    ``columns`` must include ``Patient.id``.
+    """
+    start_tier, before_id = decode_cursor(cursor, _CURSOR_KEYS) if cursor is not None else (0, None)
+    build = _sqlite_tiers if db.get_bind().dialect.name == "sqlite" else _like_tiers
+
+    # One row past the page tells whether there is a next one
+    rows: List[Tuple[int, Row]] = []
+    for tier, built in enumerate(build(query, columns)):
+        if built is None or tier < start_tier:
+            continue
+        statement, row_id = built
+        if tier == start_tier and before_id is not None:
+            statement = statement.where(row_id < before_id)
+        result = await db.execute(statement.limit(limit + 1 - len(rows)))
+        rows += [(tier, row) for row in result.all()]
+        if len(rows) > limit:
+            break
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        tier, last = rows[-1]
+        next_cursor = encode_cursor([tier, last.id])
+    return [row for _, row in rows], next_cursor
@@ -1,12 +1,39 @@
-import random
+"""
+Seeds the database.
+
+Without arguments this resets the tables and creates the lab test catalog plus 15
+demo patients. With ``--patients`` it switches to the load-testing generator,
+which bulk-inserts a reproducible synthetic clinic of any size:
+
+    python seed_db.py --patients 100000 --min-visits 4 --max-visits 24 \
+        --history-days 1825 --workers 4 --seed 42
+
+Every patient is generated from its own RNG seeded with ``(seed, patient index)``,
+so the data is identical whatever the chunk size or number of worker processes.
+"""
+import argparse
 import asyncio
-from datetime import date, timedelta
+import concurrent.futures
+import multiprocessing
+import random
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Sequence, Tuple
+
 from faker import Faker
-from sqlalchemy import select
+from sqlalchemy import select, text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 from models import Base, Patient, LabTestDefinition, LabResult, BioimpedanceEntry, SubjectiveEntry, AnthropometryEntry
 from config import settings
+import latest
+import search  # registers the name search index with the patients table
+import population_stats
+import subjective_metrics
+import versioning
+from reference_ranges import ReferenceRange, compute_flag
 
 # 1. SETUP ASYNC ENGINE
 # Handle SQLite vs Postgres specific args
@@ -54,12 +81,14 @@ async def seed_matrix(session: AsyncSession):
             ref_min_female=d["min_f"], ref_max_female=d["max_f"]
         )
         session.add(new_test)
+    await versioning.touch_definitions(session)
     await session.commit()
 
 async def generate_patients(session: AsyncSession, count=20):
     print(f"Generating {count} patients with history...")
     result = await session.execute(select(LabTestDefinition))
     lab_defs = result.scalars().all()
+    metric_ids = await subjective_metrics.ids(session, ["Sono", "Energia", "Humor"])
 
     for _ in range(count):
         # Create Patient
@@ -147,14 +176,238 @@ async def generate_patients(session: AsyncSession, count=20):
             # 4. Subjective Data (Weekly logs for that month)
             for w in range(4):
                 log_date = visit_date + timedelta(days=w*7)
-                session.add(SubjectiveEntry(patient_id=p.id, date=log_date, metric_name="Sono", score=random.randint(4, 9)))
-                session.add(SubjectiveEntry(patient_id=p.id, date=log_date, metric_name="Energia", score=random.randint(5, 10)))
-                session.add(SubjectiveEntry(patient_id=p.id, date=log_date, metric_name="Humor", score=random.randint(5, 10)))
+                session.add(SubjectiveEntry(patient_id=p.id, date=log_date, metric_id=metric_ids["Sono"], score=random.randint(4, 9)))
+                session.add(SubjectiveEntry(patient_id=p.id, date=log_date, metric_id=metric_ids["Energia"], score=random.randint(5, 10)))
+                session.add(SubjectiveEntry(patient_id=p.id, date=log_date, metric_id=metric_ids["Humor"], score=random.randint(5, 10)))
 
     await session.commit()
     print("Success! Database populated.")
 
+# --- Load-testing generator ---
+
+SUBJECTIVE_METRICS = (("Sono", 4, 9), ("Energia", 5, 10), ("Humor", 5, 10))
+
+
+@dataclass(frozen=True)
+class GeneratorConfig:
+    patients: int
+    seed: int = 42
+    min_visits: int = 3
+    max_visits: int = 12
+    # Each patient's history spans between a quarter of this and all of it
+    history_days: int = 730
+    tests_per_visit: int = 5
+    # Subjective logs (three metrics) every this many days between first and last visit
+    subjective_every_days: int = 7
+    # Fixed so runs are reproducible; pass --end-date to move the histories
+    end_date: date = date(2025, 12, 31)
+    chunk_size: int = 500
+    workers: int = 1
+
+
+@dataclass(frozen=True)
+class Catalog:
+    definitions: Tuple[Tuple[int, ReferenceRange], ...]
+    male_names: Tuple[str, ...]
+    female_names: Tuple[str, ...]
+    surnames: Tuple[str, ...]
+
+
+def build_catalog(seed: int, definitions: Sequence[LabTestDefinition]) -> Catalog:
+    """Name pools drawn once from a seeded Faker; combining them per patient is much cheaper."""
+    names = Faker(["pt_BR"])
+    names.seed_instance(seed)
+    return Catalog(
+        definitions=tuple(
+            (d.id, ReferenceRange(d.ref_min_male, d.ref_max_male, d.ref_min_female, d.ref_max_female))
+            for d in sorted(definitions, key=lambda d: d.id)
+        ),
+        male_names=tuple(names.first_name_male() for _ in range(500)),
+        female_names=tuple(names.first_name_female() for _ in range(500)),
+        surnames=tuple(names.last_name() for _ in range(1000)),
+    )
+
+
+def generate_patient(index: int, config: GeneratorConfig, catalog: Catalog) -> Dict[str, List[dict]]:
+    """All rows of patient ``index`` (id ``index + 1``), from that patient's own RNG."""
+    rng = random.Random(f"{config.seed}:{index}")
+    patient_id = index + 1
+    sex = rng.choice(["Masculino", "Feminino"])
+    male = sex == "Masculino"
+    height_cm = float(rng.randint(165, 190) if male else rng.randint(155, 175))
+    birth = config.end_date - timedelta(days=rng.randint(18 * 365, 85 * 365))
+
+    span = rng.randint(max(config.history_days // 4, 1), max(config.history_days, 1))
+    first_visit = config.end_date - timedelta(days=span)
+    visits = rng.randint(config.min_visits, config.max_visits)
+    step = span / max(visits - 1, 1)
+    visit_dates = [first_visit + timedelta(days=round(i * step)) for i in range(visits)]
+
+    rows: Dict[str, List[dict]] = {"patients": [{
+        "id": patient_id,
+        "full_name": f"{rng.choice(catalog.male_names if male else catalog.female_names)} "
+                     f"{rng.choice(catalog.surnames)} {rng.choice(catalog.surnames)}",
+        "date_of_birth": birth,
+        "gender": sex,
+        "height_cm": height_cm,
+        "created_at": datetime.combine(first_visit, datetime.min.time()),
+    }], "bioimpedance": [], "anthropometry": [], "lab_results": [], "subjective": []}
+
+    weight = rng.uniform(55, 100)
+    tests_per_visit = min(config.tests_per_visit, len(catalog.definitions))
+    for visit_date in visit_dates:
+        weight += rng.uniform(-1.5, 1.0)
+        fat_pct = rng.uniform(15, 25) if male else rng.uniform(22, 32)
+        rows["bioimpedance"].append({
+            "patient_id": patient_id, "date": visit_date,
+            "weight_kg": round(weight, 2), "bmi": round(weight / (height_cm / 100) ** 2, 1),
+            "body_fat_percent": round(fat_pct, 1), "fat_mass_kg": round(weight * fat_pct / 100, 1),
+            "muscle_mass_kg": round(weight * (0.4 if male else 0.35), 1),
+            "visceral_fat_level": float(rng.randint(3, 10)), "basal_metabolic_rate_kcal": int(weight * 22),
+            "hydration_percent": round(rng.uniform(50, 65), 1),
+        })
+        rows["anthropometry"].append({
+            "patient_id": patient_id, "date": visit_date,
+            "waist_cm": round(rng.uniform(70, 100), 1), "abdomen_cm": round(rng.uniform(75, 105), 1),
+            "hips_cm": round(rng.uniform(90, 110), 1),
+            "right_arm_cm": round(rng.uniform(25, 35), 1), "left_arm_cm": round(rng.uniform(25, 35), 1),
+            "right_thigh_cm": round(rng.uniform(45, 60), 1), "left_thigh_cm": round(rng.uniform(45, 60), 1),
+        })
+        for definition_id, reference in rng.sample(catalog.definitions, k=tests_per_visit):
+            lower, upper = reference.bounds(sex)
+            lower, upper = lower or 0.0, upper or 100.0
+            roll = rng.random()
+            if roll < 0.85:
+                value = rng.uniform(lower, upper)
+            elif roll < 0.925:
+                value = upper * rng.uniform(1.05, 1.2)
+            else:
+                value = lower * rng.uniform(0.8, 0.95)
+            value = round(value, 2)
+            rows["lab_results"].append({
+                "patient_id": patient_id, "test_definition_id": definition_id, "collection_date": visit_date,
+                "value": value, "flag": compute_flag(value, reference, sex),
+            })
+
+    day = 0
+    while day <= span:
+        log_date = first_visit + timedelta(days=day)
+        for metric, low, high in SUBJECTIVE_METRICS:
+            rows["subjective"].append({
+                "patient_id": patient_id, "date": log_date, "metric_name": metric, "score": rng.randint(low, high),
+            })
+        day += config.subjective_every_days
+    return rows
+
+
+TABLES = (
+    ("patients", Patient), ("bioimpedance", BioimpedanceEntry), ("anthropometry", AnthropometryEntry),
+    ("lab_results", LabResult), ("subjective", SubjectiveEntry),
+)
+
+
+async def load_chunk(session: AsyncSession, indices: range, config: GeneratorConfig, catalog: Catalog) -> int:
+    """Insert one chunk of patients and their derived state in a single transaction."""
+    rows: Dict[str, List[dict]] = {name: [] for name, _ in TABLES}
+    for index in indices:
+        for name, patient_rows in generate_patient(index, config, catalog).items():
+            rows[name].extend(patient_rows)
+
+    await subjective_metrics.intern(session, *rows["subjective"])
+    for name, model in TABLES:
+        if rows[name]:
+            await session.execute(model.__table__.insert(), rows[name])
+
+    profiles = {row["id"]: population_stats.Profile(row["gender"], row["date_of_birth"]) for row in rows["patients"]}
+    await population_stats.add_known(session, "lab", population_stats.lab_samples(rows["lab_results"]), profiles)
+    await population_stats.add_known(
+        session, "bioimpedance", population_stats.bioimpedance_samples(rows["bioimpedance"]), profiles
+    )
+    patient_ids = list(profiles)
+    for pointers in latest.ALL:
+        await latest.refresh(session, pointers, *patient_ids)
+    await session.commit()
+    return sum(len(batch) for batch in rows.values())
+
+
+async def load_range(config: GeneratorConfig, start: int, stop: int, worker: int) -> int:
+    """Generate patients ``[start, stop)`` over a dedicated engine (one per worker process)."""
+    quiet_engine = create_async_engine(settings.DATABASE_URL, poolclass=NullPool)
+    factory = sessionmaker(bind=quiet_engine, class_=AsyncSession, expire_on_commit=False)
+    inserted = 0
+    started = time.perf_counter()
+    try:
+        async with factory() as session:
+            catalog = build_catalog(config.seed, (await session.execute(select(LabTestDefinition))).scalars().all())
+            for chunk_start in range(start, stop, config.chunk_size):
+                chunk = range(chunk_start, min(chunk_start + config.chunk_size, stop))
+                inserted += await load_chunk(session, chunk, config, catalog)
+                done = chunk.stop - start
+                elapsed = time.perf_counter() - started
+                print(
+                    f"[worker {worker}] {done}/{stop - start} patients ({done / (stop - start):.0%}), "
+                    f"{inserted:,} rows, {inserted / elapsed:,.0f} rows/s",
+                    flush=True,
+                )
+    finally:
+        await quiet_engine.dispose()
+    return inserted
+
+
+def _run_worker(config: GeneratorConfig, start: int, stop: int, worker: int) -> int:
+    return asyncio.run(load_range(config, start, stop, worker))
+
+
+async def generate_scale(config: GeneratorConfig) -> None:
+    workers = config.workers
+    if "sqlite" in settings.DATABASE_URL and workers > 1:
+        print("SQLite allows a single writer; generating with one worker.")
+        workers = 1
+
+    started = time.perf_counter()
+    if workers == 1:
+        inserted = await load_range(config, 0, config.patients, 0)
+    else:
+        bounds = [config.patients * i // workers for i in range(workers + 1)]
+        loop = asyncio.get_running_loop()
+        context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            inserted = sum(await asyncio.gather(*(
+                loop.run_in_executor(pool, _run_worker, config, bounds[i], bounds[i + 1], i) for i in range(workers)
+            )))
+
+    if "postgresql" in settings.DATABASE_URL:
+        # Patient ids were assigned explicitly; move the sequence past them
+        async with engine.begin() as conn:
+            await conn.execute(text(
+                "SELECT setval(pg_get_serial_sequence('patients', 'id'), (SELECT max(id) FROM patients))"
+            ))
+
+    elapsed = time.perf_counter() - started
+    print(f"Inserted {inserted:,} rows for {config.patients:,} patients in {elapsed:.1f}s ({inserted / elapsed:,.0f} rows/s)")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Reset the database and seed it with demo or load-testing data.")
+    parser.add_argument("--patients", type=int, help="switch to the bulk generator with this many patients")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--min-visits", type=int, default=GeneratorConfig.min_visits)
+    parser.add_argument("--max-visits", type=int, default=GeneratorConfig.max_visits)
+    parser.add_argument("--history-days", type=int, default=GeneratorConfig.history_days)
+    parser.add_argument("--tests-per-visit", type=int, default=GeneratorConfig.tests_per_visit)
+    parser.add_argument("--subjective-every-days", type=int, default=GeneratorConfig.subjective_every_days)
+    parser.add_argument("--end-date", type=date.fromisoformat, default=GeneratorConfig.end_date)
+    parser.add_argument("--chunk-size", type=int, default=GeneratorConfig.chunk_size, help="patients per transaction")
+    parser.add_argument("--workers", type=int, default=1, help="parallel worker processes (Postgres only)")
+    args = parser.parse_args(argv)
+    if args.min_visits < 1 or args.max_visits < args.min_visits:
+        parser.error("need 1 <= --min-visits <= --max-visits")
+    return args
+
+
 async def main():
+    args = parse_args()
+
     # 2. CREATE TABLES (Dropping all to be safe for a seed script)
     print("Resetting database tables...")
     async with engine.begin() as conn:
@@ -162,9 +415,26 @@ async def main():
         await conn.run_sync(Base.metadata.create_all)
     
     # 3. RUN SEED
+    if args.patients is None:
+        random.seed(args.seed)
+        Faker.seed(args.seed)
+        async with async_session_factory() as session:
+            await seed_matrix(session)
+            await generate_patients(session, count=15) # Generating 15 diverse patients
+            await population_stats.rebuild(session)
+            await latest.rebuild(session)
+            await session.commit()
+        return
+
     async with async_session_factory() as session:
         await seed_matrix(session)
-        await generate_patients(session, count=15) # Generating 15 diverse patients
+    await engine.dispose()
+    await generate_scale(GeneratorConfig(
+        patients=args.patients, seed=args.seed,
+        min_visits=args.min_visits, max_visits=args.max_visits, history_days=args.history_days,
+        tests_per_visit=args.tests_per_visit, subjective_every_days=args.subjective_every_days,
+        end_date=args.end_date, chunk_size=args.chunk_size, workers=args.workers,
+    ))
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,179 @@
+"""
+Slow-query log.
+
+``instrument_engine`` times every statement run on the engine. Statements slower
+than ``SLOW_QUERY_MS`` are written to the ``slow_queries`` logger as one JSON
+object holding the SQL, the parameters with patient data redacted, the duration
+and the route of the request that ran it (see ``metrics.request_stats``).
+
+With ``SLOW_QUERY_EXPLAIN`` on, the record is completed in a background task that
+asks the database for the plan of the same statement (``EXPLAIN QUERY PLAN`` on
+SQLite, ``EXPLAIN`` without ``ANALYZE`` on Postgres) over a separate connection,
+so the request that ran the query does not wait for it. Each statement text is
+explained at most once per ``EXPLAIN_INTERVAL_SECONDS``, and at most
+``MAX_EXPLAINED_STATEMENTS`` texts are remembered (``IN`` lists of varying length
+keep producing new ones); engines whose pool hands out a single shared
+connection (in-memory SQLite) are never explained, since the extra checkout
+would end the request's transaction.
+"""
+import asyncio
+import json
+import logging
+import re
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any, Dict, List, Optional, Set
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import StaticPool
+
+import metrics
+from config import settings
+
+logger = logging.getLogger("slow_queries")
+
+EXPLAIN_INTERVAL_SECONDS = 300.0
+MAX_EXPLAINED_STATEMENTS = 1000
+
+# Bind names whose integer values are identifiers or paging, not patient data
+_SAFE_PARAMETERS = {"id", "patient_id", "test_definition_id", "lab_result_id", "entry_id", "limit", "offset"}
+_BIND_SUFFIX = re.compile(r"_\d+$")
+_EXPLAINABLE = re.compile(r"^\s*(select|with|insert|update|delete)\b", re.IGNORECASE)
+
+_instrumented: "weakref.WeakSet[Any]" = weakref.WeakSet()
+# Statement text -> when it was last explained, oldest first
+_explained_at: "OrderedDict[str, float]" = OrderedDict()
+_pending: Set["asyncio.Task"] = set()
+
+
+def redact(parameters: Any, names: Optional[List[str]] = None) -> Any:
+    """
+    ``parameters`` with every value replaced by its type, except integer ids and
+    paging values (identified by bind name) and NULLs.
+    """
+    if isinstance(parameters, Mapping):
+        return {name: _redact_value(name, value) for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [
+            _redact_value(names[index] if names and index < len(names) else None, value)
+            for index, value in enumerate(parameters)
+        ]
+    return None
+
+
+def _redact_value(name: Optional[str], value: Any) -> Any:
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, int) and name is not None and _BIND_SUFFIX.sub("", name) in _SAFE_PARAMETERS:
+        return value
+    return f"<{type(value).__name__}>"
+
+
+def _bind_names(context) -> Optional[List[str]]:
+    compiled = getattr(context, "compiled", None)
+    return list(compiled.positiontup) if compiled is not None and compiled.positiontup else None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("slow_query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(engine: AsyncEngine, conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["slow_query_started"].pop()) * 1000
+    threshold = settings.SLOW_QUERY_MS
+    if threshold is None or elapsed_ms < threshold or conn.info.get("explaining"):
+        return
+
+    stats = metrics.request_stats.get()
+    record: Dict[str, Any] = {
+        "event": "slow_query",
+        "duration_ms": round(elapsed_ms, 2),
+        "threshold_ms": threshold,
+        "route": stats.route if stats is not None else None,
+        "method": stats.scope.get("method") if stats is not None else None,
+        "statement": statement,
+        # Each parameter set of an executemany is a separate row; only their number is logged
+        "parameters": f"<{len(parameters)} parameter sets>" if executemany else redact(parameters, _bind_names(context)),
+    }
+
+    if _should_explain(engine, statement, executemany):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            task = loop.create_task(_explain_and_log(engine, statement, parameters, record))
+            _pending.add(task)
+            task.add_done_callback(_pending.discard)
+            return
+    _log(record)
+
+
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    started = connection.info.get("slow_query_started") if connection is not None else None
+    if started:
+        started.pop()
+
+
+def _should_explain(engine: AsyncEngine, statement: str, executemany: bool) -> bool:
+    if not settings.SLOW_QUERY_EXPLAIN or executemany or not _EXPLAINABLE.match(statement):
+        return False
+    if isinstance(engine.sync_engine.pool, StaticPool):
+        return False
+    now = time.monotonic()
+    while _explained_at:
+        oldest, explained_at = next(iter(_explained_at.items()))
+        if now - explained_at < EXPLAIN_INTERVAL_SECONDS and len(_explained_at) < MAX_EXPLAINED_STATEMENTS:
+            break
+        del _explained_at[oldest]
+    if statement in _explained_at:
+        return False
+    _explained_at[statement] = now
+    return True
+
+
+async def _explain_and_log(engine: AsyncEngine, statement: str, parameters: Any, record: Dict[str, Any]) -> None:
+    # Not part of the request that triggered it
+    metrics.request_stats.set(None)
+    sqlite = engine.dialect.name == "sqlite"
+    try:
+        async with engine.connect() as conn:
+            conn.info["explaining"] = True
+            try:
+                prefix = "EXPLAIN QUERY PLAN " if sqlite else "EXPLAIN "
+                result = await conn.exec_driver_sql(prefix + statement, parameters)
+                # SQLite rows are (id, parent, notused, detail); Postgres has one text column
+                record["plan"] = [row[-1] for row in result.all()]
+            finally:
+                conn.info.pop("explaining", None)
+    except Exception as exc:
+        record["plan_error"] = f"{type(exc).__name__}: {exc}"
+    _log(record)
+
+
+def _log(record: Dict[str, Any]) -> None:
+    logger.warning("%s", json.dumps(record, default=str))
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """Log the statements on ``engine`` slower than ``SLOW_QUERY_MS``; idempotent."""
+    sync_engine = engine.sync_engine
+    if sync_engine in _instrumented:
+        return
+    _instrumented.add(sync_engine)
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(
+        sync_engine, "after_cursor_execute",
+        lambda *args: _after_cursor_execute(engine, *args),
+    )
+    event.listen(sync_engine, "handle_error", _handle_error)
+
+
+async def drain() -> None:
+    """Wait for the plans still being captured (tests, shutdown)."""
+    while _pending:
+        await asyncio.gather(*list(_pending), return_exceptions=True)
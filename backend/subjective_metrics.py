@@ -0,0 +1,85 @@
+"""
+The subjective metric dictionary.
+
+Entries store ``metric_id``, a small integer into ``subjective_metrics``, instead
+of repeating the metric name on every row; the API keeps reading and writing
+names. ``intern`` swaps the ``metric_name`` of incoming rows for its id, adding
+names seen for the first time to the dictionary, and reads resolve the name in
+SQL through ``SubjectiveEntry.metric_name``. Metrics are never renamed or
+removed, so an id means the same metric for the life of the database.
+
+That column property is a correlated subquery, which SQLAlchemy cannot render
+inside ``RETURNING``, so write handlers return ``metric_id`` (``returning``) and
+put the name back with ``named``.
+"""
+from typing import Any, Dict, Iterable, List, Sequence
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import SubjectiveEntry, SubjectiveMetric
+
+
+def _insert(db: AsyncSession):
+    return postgresql.insert if db.get_bind().dialect.name == "postgresql" else sqlite.insert
+
+
+async def ids(db: AsyncSession, names: Iterable[str]) -> Dict[str, int]:
+    """The ids of ``names``, adding the ones not in the dictionary yet."""
+    names = set(names)
+    if not names:
+        return {}
+    statement = select(SubjectiveMetric.name, SubjectiveMetric.id)
+    known = dict((await db.execute(statement.where(SubjectiveMetric.name.in_(names)))).all())
+    missing = names - known.keys()
+    if missing:
+        # Another request may add the same name meanwhile; its row wins and is read back
+        await db.execute(
+            _insert(db)(SubjectiveMetric).values([{"name": name} for name in sorted(missing)])
+            .on_conflict_do_nothing(index_elements=["name"])
+        )
+        known.update((await db.execute(statement.where(SubjectiveMetric.name.in_(missing)))).all())
+    return known
+
+
+async def names(db: AsyncSession, metric_ids: Iterable[int]) -> Dict[int, str]:
+    result = await db.execute(
+        select(SubjectiveMetric.id, SubjectiveMetric.name).where(SubjectiveMetric.id.in_(set(metric_ids)))
+    )
+    return dict(result.all())
+
+
+async def intern(db: AsyncSession, *rows: Dict[str, Any]) -> Dict[int, str]:
+    """
+    Replace the ``metric_name`` of ``rows`` with the ``metric_id`` it stands for, in
+    place. Returns the names of those ids, for ``named``.
+    """
+    rows = [row for row in rows if "metric_name" in row]
+    metric_ids = await ids(db, (row["metric_name"] for row in rows if row["metric_name"] is not None))
+    for row in rows:
+        row["metric_id"] = metric_ids.get(row.pop("metric_name"))
+    return {metric_id: name for name, metric_id in metric_ids.items()}
+
+
+def returning(columns: Sequence[Any]) -> List[Any]:
+    """``columns`` with ``metric_name`` swapped for ``metric_id``, for a ``RETURNING`` clause."""
+    return [SubjectiveEntry.metric_id if column is SubjectiveEntry.metric_name else column for column in columns]
+
+
+async def named(db: AsyncSession, row: Row, metric_names: Dict[int, str]) -> Dict[str, Any]:
+    """A row returned with ``returning`` as a response dict, its metric name looked up if not known."""
+    values = row._asdict()
+    metric_id = values.pop("metric_id")
+    if metric_id not in metric_names:
+        metric_names = await names(db, [metric_id])
+    values["metric_name"] = metric_names[metric_id]
+    return values
+
+
+def name_entries(entries: Sequence[SubjectiveEntry], metric_names: Dict[int, str]) -> None:
+    """Set the metric name of entities inserted with ``RETURNING``, which does not load it."""
+    for entry in entries:
+        set_committed_value(entry, "metric_name", metric_names[entry.metric_id])
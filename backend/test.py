@@ -1,12 +1,40 @@
+import csv
+import io
+import json
+from datetime import date, timedelta
+
+from typing import List
+
 import pytest
 from httpx import AsyncClient, ASGITransport
+from sqlalchemy import event, literal, select
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import NullPool, StaticPool
+
+from sqlalchemy.dialects import sqlite
+from pydantic import TypeAdapter
 
 from app import app
+from config import settings
+import database
 from database import get_db
-from models import Base
+from models import Base, Patient, LabTestDefinition, LabResult, BioimpedanceEntry, AnthropometryEntry, SubjectiveEntry, SubjectiveMetric
+import schemas
+import migrations
+import population_stats
+import latest
+import search
+import queries
+from reference_ranges import reference_cache
+import bench
+import cache
+from cache import MemoryCacheBackend, response_cache
+import downsample
+import export
+import metrics
+import slow_queries
+import versioning
 
 # Setup in-memory database
 SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
@@ -28,9 +56,24 @@ async def override_get_db():
         yield session
 
 app.dependency_overrides[get_db] = override_get_db
+metrics.instrument_engine(engine)
+# Statement counts per response, for assert_max_queries
+settings.DEBUG_QUERY_HEADERS = True
+
+async def assert_max_queries(client, budget, method, url, **kwargs):
+    """Issue a request and fail if it ran more SQL statements than ``budget``."""
+    response = await client.request(method, url, **kwargs)
+    assert response.status_code < 400, response.text
+    statements = int(response.headers[metrics.STATEMENTS_HEADER])
+    assert statements <= budget, f"{method} {url} ran {statements} SQL statements (budget {budget})"
+    return response
 
 @pytest.fixture
 async def client():
+    # Ids are reused across tests, so start from empty caches
+    reference_cache.clear()
+    await response_cache.clear()
+
     # Create tables
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
@@ -240,6 +283,48 @@ async def test_delete_patient(client):
     get_resp = await client.get(f"/patients/{patient_id}")
     assert get_resp.status_code == 404
 
+@pytest.mark.asyncio
+async def test_delete_patient_removes_history(client):
+    definition_id = (await client.post("/lab-definitions/", json={
+        "name": "Glicose", "category": "Bioquímica", "unit": "mg/dL"
+    })).json()["id"]
+    patient_ids = [(await client.post("/patients/", json={
+        "full_name": name,
+        "date_of_birth": "1980-01-01",
+        "gender": "Feminino",
+        "height_cm": 160.0
+    })).json()["id"] for name in ("Deleted Patient", "Kept Patient")]
+    days = ["2023-01-01", "2023-02-01", "2023-03-01"]
+    for patient_id in patient_ids:
+        await client.post("/lab-results/batch", json=[
+            {"patient_id": patient_id, "test_definition_id": definition_id, "collection_date": day, "value": 90.0}
+            for day in days
+        ])
+        await client.post("/bioimpedance/batch", json=[{
+            "patient_id": patient_id, "date": day, "weight_kg": 60.0, "bmi": 23.4,
+            "body_fat_percent": 25.0, "fat_mass_kg": 15.0, "muscle_mass_kg": 25.0,
+        } for day in days])
+        await client.post("/anthropometry/batch", json=[{"patient_id": patient_id, "date": day, "waist_cm": 75.0} for day in days])
+        await client.post("/subjective/batch", json=[
+            {"patient_id": patient_id, "date": day, "metric_name": "Sono", "score": 7} for day in days
+        ])
+
+    deleted, kept = patient_ids
+    response = await client.delete(f"/patients/{deleted}")
+    assert response.status_code == 204
+    assert (await client.delete(f"/patients/{deleted}")).status_code == 404
+
+    async with TestingSessionLocal() as session:
+        for model in (LabResult, BioimpedanceEntry, AnthropometryEntry, SubjectiveEntry):
+            owners = (await session.execute(select(model.patient_id))).scalars().all()
+            assert owners == [kept] * len(days), model.__name__
+        for pointers in latest.ALL:
+            owners = (await session.execute(select(pointers.table.patient_id))).scalars().all()
+            assert set(owners) == {kept}
+    cells = (await client.get(f"/stats/lab-tests/{definition_id}")).json()
+    assert [cell["count"] for cell in cells] == [len(days)]
+    assert len((await client.get(f"/patients/{kept}/lab-results/")).json()) == len(days)
+
 @pytest.mark.asyncio
 async def test_read_lab_definitions(client):
     # Create a lab definition
@@ -365,6 +450,126 @@ async def test_read_patient_subjective(client):
     assert len(data) > 0
     assert data[0]["metric_name"] == "Energy"
 
+@pytest.mark.asyncio
+async def test_read_patient_lab_matrix(client):
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Lab Matrix Patient",
+        "date_of_birth": "1990-01-01",
+        "gender": "Masculino",
+        "height_cm": 175.0
+    })).json()["id"]
+    definitions = {}
+    for name, category in (("Glicose", "Metabólica"), ("Hemoglobina", "Hemograma"), ("Insulina", "Metabólica")):
+        definitions[name] = (await client.post("/lab-definitions/", json={
+            "name": name, "category": category, "unit": "mg/dL", "ref_min_male": 70.0, "ref_max_male": 99.0,
+        })).json()["id"]
+    days = [f"2023-{month:02d}-01" for month in range(1, 11)]
+    results = [
+        {"patient_id": patient_id, "test_definition_id": definitions[name], "collection_date": day, "value": 80.0 + index}
+        for name in ("Glicose", "Hemoglobina") for index, day in enumerate(days)
+    ]
+    results += [
+        {"patient_id": patient_id, "test_definition_id": definitions["Insulina"], "collection_date": "2023-03-01", "value": 120.0},
+        # The later result of a test on the same date wins
+        {"patient_id": patient_id, "test_definition_id": definitions["Glicose"], "collection_date": "2023-10-01", "value": 101.0},
+    ]
+    await client.post("/lab-results/batch", json=results)
+
+    response = await client.get(f"/patients/{patient_id}/lab-results/matrix")
+    assert response.status_code == 200
+    matrix = response.json()
+    assert matrix["dates"] == list(reversed(days))
+    assert [test["name"] for test in matrix["tests"]] == ["Hemoglobina", "Glicose", "Insulina"]
+    assert matrix["tests"][0] == {"id": definitions["Hemoglobina"], "name": "Hemoglobina", "category": "Hemograma", "unit": "mg/dL"}
+    glucose, insulin = matrix["values"][1], matrix["values"][2]
+    assert glucose[0] == 101.0 and matrix["flags"][1][0] == "Alto"
+    assert glucose[-1] == 80.0 and matrix["flags"][1][-1] == "Normal"
+    assert insulin == [None] * 7 + [120.0, None, None]
+    assert matrix["flags"][2] == [None] * 7 + ["Alto", None, None]
+
+    filtered = (await client.get(f"/patients/{patient_id}/lab-results/matrix", params={"category": "Metabólica"})).json()
+    assert [test["name"] for test in filtered["tests"]] == ["Glicose", "Insulina"]
+    assert filtered["values"] == matrix["values"][1:]
+
+    # Each date and test is sent once instead of once per result
+    series = await client.get(f"/patients/{patient_id}/lab-results/")
+    assert len(response.content) * 3 < len(series.content)
+
+@pytest.mark.asyncio
+async def test_read_patient_subjective_pivot(client):
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Subj Pivot Patient",
+        "date_of_birth": "1990-01-01",
+        "gender": "Feminino",
+        "height_cm": 160.0
+    })).json()["id"]
+    await client.post("/subjective/batch", json=[
+        {"patient_id": patient_id, "date": "2023-01-01", "metric_name": "Sono", "score": 6},
+        {"patient_id": patient_id, "date": "2023-01-01", "metric_name": "Energia", "score": 8},
+        {"patient_id": patient_id, "date": "2023-01-08", "metric_name": "Sono", "score": 7},
+        {"patient_id": patient_id, "date": "2023-01-08", "metric_name": "Sono", "score": 9},
+        {"patient_id": patient_id, "date": "2023-01-15", "metric_name": "Humor", "score": 5},
+    ])
+
+    response = await client.get(f"/patients/{patient_id}/subjective/pivot")
+    assert response.status_code == 200
+    assert response.json() == {
+        "metrics": ["Energia", "Humor", "Sono"],
+        "rows": [
+            {"date": "2023-01-15", "scores": [None, 5.0, None]},
+            {"date": "2023-01-08", "scores": [None, None, 8.0]},
+            {"date": "2023-01-01", "scores": [8.0, None, 6.0]},
+        ],
+    }
+
+    # One dictionary row per name, however many entries use it
+    async with TestingSessionLocal() as session:
+        names = (await session.execute(select(SubjectiveMetric.name))).scalars().all()
+    assert sorted(names) == ["Energia", "Humor", "Sono"]
+
+    first = await client.get(f"/patients/{patient_id}/subjective/pivot", params={"limit": 2})
+    assert [row["date"] for row in first.json()["rows"]] == ["2023-01-15", "2023-01-08"]
+    second = await client.get(
+        f"/patients/{patient_id}/subjective/pivot", params={"limit": 2, "cursor": first.headers["X-Next-Cursor"]}
+    )
+    assert [row["date"] for row in second.json()["rows"]] == ["2023-01-01"]
+
+@pytest.mark.asyncio
+async def test_migrations_intern_subjective_metric_names(client):
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Subj Legacy Patient",
+        "date_of_birth": "1990-01-01",
+        "gender": "Feminino",
+        "height_cm": 160.0
+    })).json()["id"]
+    async with engine.begin() as conn:
+        # The table as it was with the metric name on every row
+        await conn.exec_driver_sql("DROP TABLE subjective_entries")
+        await conn.exec_driver_sql(
+            "CREATE TABLE subjective_entries (id INTEGER PRIMARY KEY, patient_id INTEGER REFERENCES patients (id), "
+            "date DATE NOT NULL, metric_name VARCHAR(50) NOT NULL, score INTEGER NOT NULL, notes TEXT)"
+        )
+        await conn.exec_driver_sql(
+            f"INSERT INTO subjective_entries (patient_id, date, metric_name, score) VALUES "
+            f"({patient_id}, '2023-01-01', 'Sono', 7), ({patient_id}, '2023-01-08', 'Humor', 6), "
+            f"({patient_id}, '2023-01-08', 'Sono', 8)"
+        )
+        await conn.run_sync(migrations.upgrade)
+        # Idempotent
+        await conn.run_sync(migrations.upgrade)
+        columns = {row[1] for row in (await conn.exec_driver_sql("PRAGMA table_info('subjective_entries')")).all()}
+
+    assert "metric_name" not in columns and "metric_id" in columns
+    response = await client.get(f"/patients/{patient_id}/subjective/")
+    assert [(entry["date"], entry["metric_name"]) for entry in response.json()] == [
+        ("2023-01-08", "Sono"), ("2023-01-08", "Humor"), ("2023-01-01", "Sono"),
+    ]
+    response = await client.post("/subjective/", json={
+        "patient_id": patient_id, "date": "2023-01-15", "metric_name": "Sono", "score": 9,
+    })
+    assert response.status_code == 201
+    assert response.json()["metric_name"] == "Sono"
+
 @pytest.mark.asyncio
 async def test_update_lab_definition(client):
     # Create
@@ -666,3 +871,1193 @@ async def test_delete_subjective_entry(client):
     assert get_resp.status_code == 404
 
 
+@pytest.mark.asyncio
+async def test_read_patient_dashboard(client):
+    # Setup patient, lab def and one entry per series
+    p_resp = await client.post("/patients/", json={
+        "full_name": "Dashboard Patient",
+        "date_of_birth": "1990-01-01",
+        "gender": "Feminino",
+        "height_cm": 165.0
+    })
+    patient_id = p_resp.json()["id"]
+
+    d_resp = await client.post("/lab-definitions/", json={
+        "name": "Dashboard Lab",
+        "category": "Test",
+        "unit": "g"
+    })
+    def_id = d_resp.json()["id"]
+
+    await client.post("/lab-results/", json={
+        "patient_id": patient_id,
+        "test_definition_id": def_id,
+        "collection_date": "2023-01-01",
+        "value": 50.0
+    })
+    await client.post("/bioimpedance/", json={
+        "patient_id": patient_id,
+        "date": "2023-01-01",
+        "weight_kg": 60.0,
+        "bmi": 22.0,
+        "body_fat_percent": 20.0,
+        "fat_mass_kg": 12.0,
+        "muscle_mass_kg": 40.0
+    })
+    await client.post("/anthropometry/", json={
+        "patient_id": patient_id,
+        "date": "2023-01-01",
+        "waist_cm": 85.0
+    })
+    await client.post("/subjective/", json={
+        "patient_id": patient_id,
+        "date": "2023-01-01",
+        "metric_name": "Sono",
+        "score": 7
+    })
+
+    response = await client.get(f"/patients/{patient_id}/dashboard")
+    assert response.status_code == 200
+    assert "Server-Timing" in response.headers
+    data = response.json()
+    assert data["patient"]["id"] == patient_id
+
+    # Same payload as the individual endpoints the page used to fan out to
+    assert data["lab_definitions"] == (await client.get("/lab-definitions/")).json()
+    assert data["lab_results"] == (await client.get(f"/patients/{patient_id}/lab-results/")).json()
+    assert data["bioimpedance_entries"] == (await client.get(f"/patients/{patient_id}/bioimpedance/")).json()
+    assert data["anthropometry_entries"] == (await client.get(f"/patients/{patient_id}/anthropometry/")).json()
+    assert data["subjective_entries"] == (await client.get(f"/patients/{patient_id}/subjective/")).json()
+
+    # Unknown patient
+    response = await client.get("/patients/999999/dashboard")
+    assert response.status_code == 404
+
+@pytest.mark.asyncio
+async def test_patient_series_are_ordered_newest_first(client):
+    p_resp = await client.post("/patients/", json={
+        "full_name": "Ordering Patient",
+        "date_of_birth": "1990-01-01",
+        "gender": "Masculino",
+        "height_cm": 180.0
+    })
+    patient_id = p_resp.json()["id"]
+
+    for day in ["2023-02-01", "2023-03-01", "2023-01-01"]:
+        await client.post("/anthropometry/", json={
+            "patient_id": patient_id,
+            "date": day,
+            "waist_cm": 90.0
+        })
+
+    response = await client.get(f"/patients/{patient_id}/anthropometry/")
+    dates = [item["date"] for item in response.json()]
+    assert dates == ["2023-03-01", "2023-02-01", "2023-01-01"]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("build_query, index_name", [
+    (queries.patient_lab_results, "ix_lab_results_patient_date"),
+    (queries.patient_bioimpedance, "ix_bioimpedance_entries_patient_date"),
+    (queries.patient_anthropometry, "ix_anthropometry_entries_patient_date"),
+    (queries.patient_subjective, "ix_subjective_entries_patient_date"),
+])
+async def test_patient_series_query_plans_use_indexes(client, build_query, index_name):
+    """The series queries must be served by the composite index, without a sort step."""
+    statement = build_query(1).compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True})
+    async with engine.connect() as conn:
+        result = await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}")
+        plan = " ".join(row[-1] for row in result.all())
+
+    assert index_name in plan
+    assert "TEMP B-TREE" not in plan
+
+@pytest.mark.asyncio
+async def test_migrations_create_missing_indexes(client):
+    async with engine.begin() as conn:
+        await conn.exec_driver_sql("DROP INDEX ix_lab_results_patient_test_date")
+        await conn.run_sync(migrations.upgrade)
+        result = await conn.exec_driver_sql("PRAGMA index_list('lab_results')")
+        names = {row[1] for row in result.all()}
+
+    assert "ix_lab_results_patient_test_date" in names
+
+@pytest.mark.asyncio
+async def test_patient_search_is_accent_insensitive_and_ranked(client):
+    ids = {}
+    for name in ("Maria Joana", "João da Silva", "Ana Sá", "JOANA Lima", "Pedro Johansson", "Josué"):
+        ids[name] = (await client.post("/patients/", json={
+            "full_name": name, "date_of_birth": "1990-01-01", "gender": "Feminino", "height_cm": 160.0
+        })).json()["id"]
+
+    async def names(q, **params):
+        response = await client.get("/patients/search", params={"q": q, **params})
+        assert response.status_code == 200
+        return [patient["full_name"] for patient in response.json()]
+
+    assert await names("JOAO") == ["João da Silva"]
+    assert await names("sá") == ["Ana Sá"]
+    assert await names("silva joão") == ["João da Silva"]
+    assert await names("%") == []
+    # Name prefix, then word prefix, then substring; newest first within each
+    assert await names("ana") == ["Ana Sá", "JOANA Lima", "Maria Joana"]
+    assert await names("jo") == ["Josué", "JOANA Lima", "João da Silva", "Pedro Johansson", "Maria Joana"]
+
+    seen, cursor = [], None
+    while True:
+        response = await client.get("/patients/search", params={"q": "jo", "limit": 2, **({"cursor": cursor} if cursor else {})})
+        seen += [patient["full_name"] for patient in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert seen == await names("jo")
+
+    # Renames and deletes keep the index in sync
+    await client.put(f"/patients/{ids['João da Silva']}", json={"full_name": "Zé Ninguém"})
+    assert await names("silva") == []
+    assert await names("ninguem") == ["Zé Ninguém"]
+    await client.delete(f"/patients/{ids['João da Silva']}")
+    assert await names("ninguem") == []
+
+@pytest.mark.asyncio
+async def test_migrations_backfill_patient_search(client):
+    await client.post("/patients/", json={
+        "full_name": "Conceição Araújo", "date_of_birth": "1990-01-01", "gender": "Feminino", "height_cm": 160.0
+    })
+    async with engine.begin() as conn:
+        # A database from before the search index
+        await conn.exec_driver_sql("UPDATE patients SET search_name = NULL")
+        await conn.exec_driver_sql(f"DROP TABLE {search.SEARCH_TABLE}")
+        for trigger in ("insert", "delete", "update"):
+            await conn.exec_driver_sql(f"DROP TRIGGER {search.SEARCH_TABLE}_{trigger}")
+        await conn.run_sync(migrations.upgrade)
+
+    response = await client.get("/patients/search", params={"q": "conceicao arau"})
+    assert [patient["full_name"] for patient in response.json()] == ["Conceição Araújo"]
+
+@pytest.mark.asyncio
+async def test_migrations_backfill_lab_result_flags(client):
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Legacy Flags", "date_of_birth": "1990-01-01", "gender": "Masculino", "height_cm": 180.0
+    })).json()["id"]
+    ranged = (await client.post("/lab-definitions/", json={
+        "name": "Hemoglobina", "category": "Hemograma", "unit": "g/dL", "ref_min_male": 12.5, "ref_max_male": 17.0
+    })).json()["id"]
+    unranged = (await client.post("/lab-definitions/", json={
+        "name": "Observação", "category": "Outros", "unit": "-"
+    })).json()["id"]
+    today = date.today().isoformat()
+    await client.post("/lab-results/batch", json=[
+        {"patient_id": patient_id, "test_definition_id": ranged, "collection_date": today, "value": 20.0},
+        {"patient_id": patient_id, "test_definition_id": unranged, "collection_date": today, "value": 1.0, "flag": "Alto"},
+    ])
+    matrix_url = f"/patients/{patient_id}/lab-results/matrix"
+    etag = (await client.get(matrix_url)).headers["ETag"]
+    async with engine.begin() as conn:
+        # Results stored before flags were computed on write
+        await conn.exec_driver_sql(f"UPDATE lab_results SET flag = NULL WHERE test_definition_id = {ranged}")
+        await conn.run_sync(migrations.upgrade)
+        # Runs once: later flags are the write path's
+        await conn.exec_driver_sql(f"UPDATE lab_results SET flag = 'Normal' WHERE test_definition_id = {unranged}")
+        await conn.run_sync(migrations.upgrade)
+
+    response = await client.get(matrix_url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["flags"] == [["Alto"], ["Normal"]]
+    alerts = (await client.get("/lab-results/alerts")).json()
+    assert [(alert["value"], alert["flag"]) for alert in alerts] == [(20.0, "Alto")]
+
+@pytest.mark.asyncio
+async def test_read_patients_cursor_pagination(client):
+    for i in range(5):
+        await client.post("/patients/", json={
+            "full_name": f"Page Patient {i}",
+            "date_of_birth": "1990-01-01",
+            "gender": "Feminino",
+            "height_cm": 160.0
+        })
+
+    seen = []
+    cursor = None
+    pages = 0
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = await client.get("/patients/", params=params)
+        assert response.status_code == 200
+        seen.extend(item["id"] for item in response.json())
+        pages += 1
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+
+    assert pages == 3
+    assert seen == sorted(seen)
+    assert len(seen) == len(set(seen)) == 5
+
+@pytest.mark.asyncio
+async def test_patient_series_cursor_pagination(client):
+    p_resp = await client.post("/patients/", json={
+        "full_name": "Series Page Patient",
+        "date_of_birth": "1990-01-01",
+        "gender": "Masculino",
+        "height_cm": 180.0
+    })
+    patient_id = p_resp.json()["id"]
+
+    # Two entries share a date so the id tie-breaker is exercised
+    for day in ["2023-01-01", "2023-02-01", "2023-02-01", "2023-03-01"]:
+        await client.post("/subjective/", json={
+            "patient_id": patient_id,
+            "date": day,
+            "metric_name": "Sono",
+            "score": 7
+        })
+
+    first = await client.get(f"/patients/{patient_id}/subjective/", params={"limit": 2})
+    assert [item["date"] for item in first.json()] == ["2023-03-01", "2023-02-01"]
+    cursor = first.headers["X-Next-Cursor"]
+
+    second = await client.get(f"/patients/{patient_id}/subjective/", params={"limit": 2, "cursor": cursor})
+    assert [item["date"] for item in second.json()] == ["2023-02-01", "2023-01-01"]
+    assert "X-Next-Cursor" not in second.headers
+
+    ids = [item["id"] for item in first.json() + second.json()]
+    assert len(set(ids)) == 4
+
+@pytest.mark.asyncio
+async def test_invalid_cursor(client):
+    response = await client.get("/patients/", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+    response = await client.get("/patients/1/bioimpedance/", params={"cursor": "WzFd"})  # [1]: wrong arity
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_lab_result_flag_computed_on_write(client):
+    female = (await client.post("/patients/", json={
+        "full_name": "Flag Female",
+        "date_of_birth": "1990-01-01",
+        "gender": "Feminino",
+        "height_cm": 160.0
+    })).json()["id"]
+    male = (await client.post("/patients/", json={
+        "full_name": "Flag Male",
+        "date_of_birth": "1990-01-01",
+        "gender": "Masculino",
+        "height_cm": 180.0
+    })).json()["id"]
+    def_id = (await client.post("/lab-definitions/", json={
+        "name": "Flag Test",
+        "category": "Test",
+        "unit": "g/dL",
+        "ref_min_male": 12.5,
+        "ref_max_male": 17.0,
+        "ref_min_female": 11.5,
+        "ref_max_female": 15.0
+    })).json()["id"]
+
+    payload = {"test_definition_id": def_id, "collection_date": "2023-01-01", "value": 16.0}
+    female_result = (await client.post("/lab-results/", json={**payload, "patient_id": female})).json()
+    male_result = (await client.post("/lab-results/", json={**payload, "patient_id": male, "flag": "Alto"})).json()
+    assert female_result["flag"] == "Alto"
+    # Client flags are ignored when a reference range exists
+    assert male_result["flag"] == "Normal"
+
+    response = await client.put(f"/lab-results/{female_result['id']}", json={"value": 10.0})
+    assert response.json()["flag"] == "Baixo"
+
+    # Changing the ranges re-flags stored results
+    await client.put(f"/lab-definitions/{def_id}", json={"ref_min_male": 16.5})
+    response = await client.get(f"/lab-results/{male_result['id']}")
+    assert response.json()["flag"] == "Baixo"
+
+    # So does changing the patient's gender
+    await client.put(f"/patients/{female}", json={"gender": "Masculino"})
+    response = await client.get(f"/lab-results/{female_result['id']}")
+    assert response.json()["flag"] == "Baixo"
+    response = await client.put(f"/lab-results/{female_result['id']}", json={"value": 17.5})
+    assert response.json()["flag"] == "Alto"
+
+    # Changes made by another worker process (here, straight through a session) are
+    # seen too: single writes flag in SQL, batches check the definitions version
+    async with TestingSessionLocal() as session:
+        patient = await session.get(Patient, male)
+        patient.gender = "Feminino"
+        definition = await session.get(LabTestDefinition, def_id)
+        definition.ref_max_female = 14.0
+        await versioning.touch_definitions(session)
+        await session.commit()
+    response = await client.post("/lab-results/", json={**payload, "patient_id": male, "value": 14.5})
+    assert response.json()["flag"] == "Alto"
+
+    # Unknown tests are remembered rather than reloading the catalog on every miss
+    unknown = {**payload, "patient_id": male, "test_definition_id": 999}
+    await client.post("/lab-results/batch", json=[unknown])
+    response = await client.post("/lab-results/batch", json=[unknown])
+    assert response.json()["errors"][0]["detail"] == "Lab Test Definition 999 not found"
+    assert int(response.headers[metrics.STATEMENTS_HEADER]) == 2
+
+@pytest.mark.asyncio
+async def test_create_lab_results_batch(client):
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Batch Patient",
+        "date_of_birth": "1990-01-01",
+        "gender": "Masculino",
+        "height_cm": 180.0
+    })).json()["id"]
+    def_id = (await client.post("/lab-definitions/", json={
+        "name": "Batch Test",
+        "category": "Test",
+        "unit": "mg/dL",
+        "ref_min_male": 70.0,
+        "ref_max_male": 99.0
+    })).json()["id"]
+
+    row = {"patient_id": patient_id, "test_definition_id": def_id, "collection_date": "2023-01-01"}
+    response = await client.post("/lab-results/batch", json=[
+        {**row, "value": 85.0},
+        {**row, "value": "not a number"},
+        {**row, "value": 120.0},
+        {**row, "value": 80.0, "patient_id": 999999},
+        {**row, "value": 80.0, "test_definition_id": 999999},
+    ])
+    assert response.status_code == 201
+    data = response.json()
+    assert [item["flag"] for item in data["created"]] == ["Normal", "Alto"]
+    assert [error["index"] for error in data["errors"]] == [1, 3, 4]
+
+    response = await client.get(f"/patients/{patient_id}/lab-results/")
+    assert len(response.json()) == 2
+
+@pytest.mark.asyncio
+async def test_create_bioimpedance_batch(client):
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Bio Batch Patient",
+        "date_of_birth": "1990-01-01",
+        "gender": "Feminino",
+        "height_cm": 165.0
+    })).json()["id"]
+
+    rows = [{
+        "patient_id": patient_id,
+        "date": f"2023-01-{day:02d}",
+        "weight_kg": 60.0 + day,
+        "bmi": 22.0,
+        "body_fat_percent": 20.0,
+        "fat_mass_kg": 12.0,
+        "muscle_mass_kg": 40.0
+    } for day in range(1, 11)]
+    response = await client.post("/bioimpedance/batch", json=rows)
+    assert response.status_code == 201
+    data = response.json()
+    assert len(data["created"]) == 10
+    assert data["errors"] == []
+    assert all("id" in item for item in data["created"])
+
+@pytest.mark.asyncio
+async def test_export_table_streams_ndjson_and_csv(client):
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Export Patient",
+        "date_of_birth": "1990-01-01",
+        "gender": "Feminino",
+        "height_cm": 160.0
+    })).json()["id"]
+    for score in (6, 8):
+        await client.post("/subjective/", json={
+            "patient_id": patient_id,
+            "date": "2023-01-01",
+            "metric_name": "Humor",
+            "score": score
+        })
+
+    response = await client.get("/export/subjective")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["score"] for line in lines] == [6, 8]
+    assert lines[0]["date"] == "2023-01-01"
+
+    response = await client.get("/export/patients", params={"format": "csv"})
+    assert response.status_code == 200
+    rows = list(csv.reader(io.StringIO(response.text)))
+    # The public columns only, not the search key or cache validators
+    assert rows[0] == ["id", "full_name", "date_of_birth", "gender", "height_cm", "created_at"]
+    assert rows[1][1] == "Export Patient"
+
+    response = await client.get("/export/unknown-table")
+    assert response.status_code == 422
+
+@pytest.mark.asyncio
+async def test_export_all_writes_every_table(client, tmp_path):
+    await client.post("/patients/", json={
+        "full_name": "Export All Patient",
+        "date_of_birth": "1990-01-01",
+        "gender": "Masculino",
+        "height_cm": 180.0
+    })
+
+    paths = await export.export_all(TestingSessionLocal, "ndjson", str(tmp_path))
+    assert len(paths) == len(export.EXPORT_TABLES)
+    with open(tmp_path / "patients.ndjson", encoding="utf-8") as handle:
+        patient = json.loads(handle.readline())
+    assert patient["full_name"] == "Export All Patient"
+    assert "search_name" not in patient and "data_version" not in patient
+
+@pytest.mark.asyncio
+async def test_engine_profiles():
+    server = database.engine_options("postgresql+asyncpg://db/app", database.ENGINE_PROFILES["server"])
+    assert server["pool_size"] == 10
+    assert server["connect_args"]["server_settings"] == {"statement_timeout": "30000"}
+
+    serverless = database.engine_options("postgresql+asyncpg://db/app", database.ENGINE_PROFILES["serverless"])
+    assert serverless["poolclass"] is NullPool
+    assert serverless["connect_args"]["statement_cache_size"] == 0
+    assert "pool_size" not in serverless
+    # Cold starts skip the schema checks; migrations run once per deploy
+    assert database.ENGINE_PROFILES["server"].migrate_on_startup
+    assert not database.ENGINE_PROFILES["serverless"].migrate_on_startup
+
+    memory = database.engine_options("sqlite+aiosqlite:///:memory:", database.ENGINE_PROFILES["test"])
+    assert memory["poolclass"] is StaticPool
+
+@pytest.mark.asyncio
+async def test_db_health_reports_pool_stats(client):
+    database.pool_monitor.record_wait(0.002)
+    response = await client.get("/health/db")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["checkouts"] >= 1
+    assert data["wait_seconds_max"] >= 0.002
+    assert "pool" in data
+
+@pytest.mark.asyncio
+async def test_metrics_record_route_templates_and_db_time(client):
+    metrics.registry.clear()
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Metrics Patient",
+        "date_of_birth": "1990-01-01",
+        "gender": "Feminino",
+        "height_cm": 160.0
+    })).json()["id"]
+    await client.get(f"/patients/{patient_id}/lab-results/")
+    await client.get(f"/patients/{patient_id}/lab-results/", params={"limit": 10})
+    await client.get("/patients/999999")
+    await client.get("/no-such-path")
+
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = response.text
+    route = 'method="GET",route="/patients/{patient_id}/lab-results/"'
+    assert f'http_requests_total{{{route},status="200"}} 2' in text
+    assert 'http_requests_total{method="GET",route="/patients/{patient_id}",status="404"} 1' in text
+    assert 'route="unmatched",status="404"} 1' in text
+    assert f'http_request_duration_seconds_bucket{{{route},le="+Inf"}} 2' in text
+    assert f'http_request_duration_seconds_count{{{route}}} 2' in text
+
+    db_seconds = float(text.split(f"http_request_db_seconds_sum{{{route}}} ")[1].split()[0])
+    assert db_seconds > 0
+    statements = int(text.split(f"http_request_db_statements_total{{{route}}} ")[1].split()[0])
+    assert statements >= 4
+    assert "db_pool_checkouts_total" in text
+
+@pytest.mark.asyncio
+async def test_query_budgets(client):
+    """Every route runs a fixed number of statements, however many rows a patient has."""
+    definitions = [(await client.post("/lab-definitions/", json={
+        "name": name, "category": "Bioquímica", "unit": "mg/dL", "ref_min_male": 70.0, "ref_max_male": 99.0,
+    })).json()["id"] for name in ("Glicose", "Ureia")]
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Budget Patient",
+        "date_of_birth": "1980-01-01",
+        "gender": "Masculino",
+        "height_cm": 175.0
+    })).json()["id"]
+    days = [f"2023-0{month}-01" for month in range(1, 6)]
+    await client.post("/lab-results/batch", json=[
+        {"patient_id": patient_id, "test_definition_id": definition, "collection_date": day, "value": 90.0}
+        for definition in definitions for day in days
+    ])
+    await client.post("/bioimpedance/batch", json=[{
+        "patient_id": patient_id, "date": day, "weight_kg": 80.0, "bmi": 26.1,
+        "body_fat_percent": 20.0, "fat_mass_kg": 16.0, "muscle_mass_kg": 35.0,
+    } for day in days])
+    await client.post("/anthropometry/batch", json=[{"patient_id": patient_id, "date": day, "waist_cm": 85.0} for day in days])
+    await client.post("/subjective/batch", json=[
+        {"patient_id": patient_id, "date": day, "metric_name": "Sono", "score": 7} for day in days
+    ])
+
+    pid, definition = patient_id, definitions[0]
+    reads = [
+        (2, f"/patients/{pid}"),
+        (1, "/patients/"),
+        (3, "/patients/search?q=budget"),
+        (7, f"/patients/{pid}/dashboard"),
+        (4, f"/patients/{pid}/latest"),
+        (2, "/lab-definitions/"),
+        (2, f"/lab-definitions/{definition}"),
+        (2, f"/patients/{pid}/lab-results/"),
+        (2, f"/patients/{pid}/lab-results/?points=3"),
+        (2, f"/patients/{pid}/lab-results/?resample=month"),
+        (2, f"/patients/{pid}/lab-results/matrix"),
+        (2, "/lab-results/alerts"),
+        (2, f"/patients/{pid}/bioimpedance/"),
+        (2, f"/patients/{pid}/anthropometry/"),
+        (2, f"/patients/{pid}/subjective/"),
+        (3, f"/patients/{pid}/subjective/pivot"),
+        (2, f"/stats/lab-tests/{definition}"),
+        (2, "/stats/bioimpedance/weight_kg"),
+    ]
+    for budget, url in reads:
+        await assert_max_queries(client, budget, "GET", url)
+
+    lab = {"patient_id": pid, "test_definition_id": definition, "collection_date": "2023-06-01", "value": 120.0}
+    result_id = (await assert_max_queries(client, 6, "POST", "/lab-results/", json=lab)).json()["id"]
+    await assert_max_queries(client, 8, "POST", "/lab-results/batch", json=[lab, lab, lab])
+    await assert_max_queries(client, 1, "GET", f"/lab-results/{result_id}")
+    await assert_max_queries(client, 6, "PUT", f"/lab-results/{result_id}", json={"value": 60.0})
+    await assert_max_queries(client, 7, "DELETE", f"/lab-results/{result_id}")
+
+    scan = {
+        "patient_id": pid, "date": "2023-06-01", "weight_kg": 79.0, "bmi": 25.8,
+        "body_fat_percent": 19.0, "fat_mass_kg": 15.0, "muscle_mass_kg": 35.0,
+    }
+    tape = {"patient_id": pid, "date": "2023-06-01", "waist_cm": 84.0}
+    log = {"patient_id": pid, "date": "2023-06-01", "metric_name": "Sono", "score": 8}
+    # (create, batch, read, update, delete)
+    for path, payload, change, budgets in (
+        ("bioimpedance", scan, {"weight_kg": 78.0}, (6, 7, 1, 6, 7)),
+        ("anthropometry", tape, {"waist_cm": 83.0}, (3, 4, 1, 2, 4)),
+        ("subjective", log, {"score": 6}, (3, 4, 1, 3, 2)),
+    ):
+        create, batch, read, update, delete = budgets
+        entry_id = (await assert_max_queries(client, create, "POST", f"/{path}/", json=payload)).json()["id"]
+        await assert_max_queries(client, batch, "POST", f"/{path}/batch", json=[payload, payload, payload])
+        await assert_max_queries(client, read, "GET", f"/{path}/{entry_id}")
+        await assert_max_queries(client, update, "PUT", f"/{path}/{entry_id}", json=change)
+        await assert_max_queries(client, delete, "DELETE", f"/{path}/{entry_id}")
+
+    await assert_max_queries(client, 3, "PUT", f"/lab-definitions/{definition}", json={"ref_max_male": 110.0})
+    await assert_max_queries(client, 7, "PUT", f"/patients/{pid}", json={"date_of_birth": "1950-01-01"})
+    await assert_max_queries(client, 5, "DELETE", f"/lab-definitions/{definitions[1]}")
+
+    empty = {"full_name": "Empty Patient", "date_of_birth": "1990-01-01", "gender": "Feminino", "height_cm": 160.0}
+    empty_id = (await assert_max_queries(client, 1, "POST", "/patients/", json=empty)).json()["id"]
+    await assert_max_queries(client, 11, "DELETE", f"/patients/{empty_id}")
+    await assert_max_queries(client, 13, "DELETE", f"/patients/{pid}")
+
+@pytest.mark.asyncio
+async def test_mutations_on_missing_rows_return_404(client):
+    for path in ("patients", "lab-definitions", "lab-results", "bioimpedance", "anthropometry", "subjective"):
+        assert (await client.put(f"/{path}/999", json={})).status_code == 404
+        assert (await client.delete(f"/{path}/999")).status_code == 404
+    # Fields that need the previous row take the other path
+    assert (await client.put("/patients/999", json={"gender": "Feminino"})).status_code == 404
+    assert (await client.put("/anthropometry/999", json={"patient_id": 1})).status_code == 404
+    assert (await client.put("/subjective/999", json={"score": 3})).status_code == 404
+
+@pytest.mark.asyncio
+async def test_slow_query_log_redacts_and_explains(tmp_path, monkeypatch, caplog):
+    file_engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'slow.db'}")
+    slow_queries.instrument_engine(file_engine)
+    async with file_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    monkeypatch.setattr(settings, "SLOW_QUERY_MS", 0.0)
+
+    class Route:
+        path = "/patients/{patient_id}/lab-results/"
+    token = metrics.request_stats.set(metrics.RequestStats({"method": "GET", "route": Route()}))
+    try:
+        with caplog.at_level("WARNING", logger="slow_queries"):
+            async with file_engine.connect() as conn:
+                # An anonymous bind (param_1) is not known to be an id
+                await conn.execute(
+                    select(Patient.id, literal(1985)).where(Patient.id == 7, Patient.full_name == "Maria Souza")
+                )
+            await slow_queries.drain()
+    finally:
+        metrics.request_stats.reset(token)
+        await file_engine.dispose()
+
+    records = [json.loads(record.getMessage()) for record in caplog.records if record.name == "slow_queries"]
+    record = next(record for record in records if "full_name" in record["statement"])
+    assert record["route"] == "/patients/{patient_id}/lab-results/"
+    assert record["method"] == "GET"
+    assert record["duration_ms"] >= 0
+    # Ids are kept, patient data is not
+    assert record["parameters"] == ["<int>", 7, "<str>"]
+    assert "Maria" not in json.dumps(records)
+    assert any("patients" in line for line in record["plan"])
+
+@pytest.mark.asyncio
+async def test_slow_query_explain_memory_is_bounded(tmp_path, monkeypatch):
+    file_engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'slow.db'}")
+    monkeypatch.setattr(slow_queries, "MAX_EXPLAINED_STATEMENTS", 3)
+    monkeypatch.setattr(slow_queries, "_explained_at", slow_queries.OrderedDict())
+    statements = [f"SELECT id FROM patients WHERE id IN ({', '.join('?' * size)})" for size in range(1, 6)]
+    try:
+        assert all(slow_queries._should_explain(file_engine, statement, False) for statement in statements)
+        assert list(slow_queries._explained_at) == statements[-3:]
+        assert not slow_queries._should_explain(file_engine, statements[-1], False)
+
+        # Entries past the interval are dropped, and the statement explained again
+        now = slow_queries.time.monotonic()
+        monkeypatch.setattr(slow_queries.time, "monotonic", lambda: now + slow_queries.EXPLAIN_INTERVAL_SECONDS)
+        assert slow_queries._should_explain(file_engine, statements[-1], False)
+        assert list(slow_queries._explained_at) == statements[-1:]
+    finally:
+        await file_engine.dispose()
+
+@pytest.mark.asyncio
+async def test_patient_scoped_gets_support_etags(client):
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "ETag Patient",
+        "date_of_birth": "1990-01-01",
+        "gender": "Feminino",
+        "height_cm": 160.0
+    })).json()["id"]
+    url = f"/patients/{patient_id}/anthropometry/"
+
+    first = await client.get(url)
+    etag = first.headers["ETag"]
+    assert "Last-Modified" in first.headers
+
+    response = await client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+
+    # Any write to the patient's entries invalidates the previous validator
+    entry_id = (await client.post("/anthropometry/", json={
+        "patient_id": patient_id,
+        "date": "2023-01-01",
+        "waist_cm": 80.0
+    })).json()["id"]
+    response = await client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+    etag = response.headers["ETag"]
+
+    await client.put(f"/anthropometry/{entry_id}", json={"waist_cm": 79.0})
+    response = await client.get(f"/patients/{patient_id}/dashboard", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    await client.delete(f"/anthropometry/{entry_id}")
+    response = await client.get(f"/patients/{patient_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+@pytest.mark.asyncio
+async def test_definition_changes_bump_one_version(client):
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Catalog Patient",
+        "date_of_birth": "1990-01-01",
+        "gender": "Masculino",
+        "height_cm": 175.0
+    })).json()["id"]
+    definition_id = (await client.post("/lab-definitions/", json={
+        "name": "Glicose", "category": "Bioquímica", "unit": "mg/dL", "ref_max_male": 99.0,
+    })).json()["id"]
+    await client.post("/lab-results/", json={
+        "patient_id": patient_id, "test_definition_id": definition_id, "collection_date": "2023-01-01", "value": 105.0,
+    })
+    urls = [f"/patients/{patient_id}/{path}" for path in ("dashboard", "latest", "lab-results/", "lab-results/matrix")]
+    etags = {url: (await client.get(url)).headers["ETag"] for url in urls}
+    patient_etag = (await client.get(f"/patients/{patient_id}")).headers["ETag"]
+    async with TestingSessionLocal() as session:
+        version = await session.scalar(select(Patient.data_version).where(Patient.id == patient_id))
+
+    await client.put(f"/lab-definitions/{definition_id}", json={"ref_max_male": 110.0})
+
+    # Views built from the catalog get new validators and cache entries...
+    for url, etag in etags.items():
+        response = await client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["X-Cache"] == "MISS"
+    assert response.json()["flags"] == [["Normal"]]
+    # ...while patient rows are left alone
+    response = await client.get(f"/patients/{patient_id}", headers={"If-None-Match": patient_etag})
+    assert response.status_code == 304
+    async with TestingSessionLocal() as session:
+        assert await session.scalar(select(Patient.data_version).where(Patient.id == patient_id)) == version
+
+@pytest.mark.asyncio
+async def test_response_cache_hits_and_invalidates(client):
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Cached Patient",
+        "date_of_birth": "1990-01-01",
+        "gender": "Masculino",
+        "height_cm": 175.0
+    })).json()["id"]
+    url = f"/patients/{patient_id}/anthropometry/"
+    for date in ("2023-01-01", "2023-02-01"):
+        await client.post("/anthropometry/", json={"patient_id": patient_id, "date": date, "waist_cm": 80.0})
+
+    first = await client.get(url, params={"limit": 1})
+    assert first.headers["X-Cache"] == "MISS"
+    second = await client.get(url, params={"limit": 1})
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.content == first.content
+    assert second.headers["ETag"] == first.headers["ETag"]
+    assert second.headers["X-Next-Cursor"] == first.headers["X-Next-Cursor"]
+
+    # A write bumps the patient's version, so the cached page is no longer reachable
+    await client.post("/anthropometry/", json={"patient_id": patient_id, "date": "2023-03-01", "waist_cm": 79.0})
+    response = await client.get(url, params={"limit": 1})
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.json()[0]["date"] == "2023-03-01"
+
+    await client.post("/lab-definitions/", json={"name": "Glicose", "category": "Bioquímica", "unit": "mg/dL"})
+    assert (await client.get("/lab-definitions/")).headers["X-Cache"] == "MISS"
+    assert (await client.get("/lab-definitions/")).headers["X-Cache"] == "HIT"
+    await client.post("/lab-definitions/", json={"name": "Ureia", "category": "Bioquímica", "unit": "mg/dL"})
+    response = await client.get("/lab-definitions/")
+    assert response.headers["X-Cache"] == "MISS"
+    assert len(response.json()) == 2
+
+    # The key is the catalog version in the database, so a write handled by another
+    # worker process (here, straight through a session) is seen as well
+    async with TestingSessionLocal() as session:
+        session.add(LabTestDefinition(name="Creatinina", category="Bioquímica", unit="mg/dL"))
+        await versioning.touch_definitions(session)
+        await session.commit()
+    response = await client.get("/lab-definitions/", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 200
+    assert response.headers["X-Cache"] == "MISS"
+    assert len(response.json()) == 3
+
+    stats = (await client.get("/health/cache")).json()
+    assert stats["hits"] == 2
+    assert stats["entries"] >= 3
+
+@pytest.mark.asyncio
+async def test_memory_cache_backend_ttl_and_eviction(monkeypatch):
+    backend = MemoryCacheBackend(max_bytes=30)
+    await backend.set("a", b"x" * 10, ttl=60)
+    await backend.set("b", b"x" * 10, ttl=60)
+    assert await backend.get("a") is not None
+    # "b" is now least recently used and goes first when the cap is exceeded
+    await backend.set("c", b"x" * 10, ttl=60)
+    assert await backend.get("b") is None
+    assert await backend.get("a") is not None
+    assert backend.evictions == 1
+
+    now = cache.time.monotonic()
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now + 120)
+    assert await backend.get("a") is None
+    assert backend.expirations == 1
+    assert backend.stats()["bytes"] == 11
+
+@pytest.mark.asyncio
+async def test_projection_matches_orm_serialization(client):
+    """The column-projection fast path emits the same bytes the ORM + pydantic path did."""
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Projeção Ação",
+        "date_of_birth": "1985-05-05",
+        "gender": "Feminino",
+        "height_cm": 162
+    })).json()["id"]
+    definition_id = (await client.post("/lab-definitions/", json={
+        "name": "Glicose", "category": "Bioquímica", "unit": "mg/dL", "ref_min_female": 70, "ref_max_female": 99
+    })).json()["id"]
+    await client.post("/lab-results/", json={
+        "patient_id": patient_id, "test_definition_id": definition_id, "collection_date": "2023-01-01", "value": 101
+    })
+    await client.post("/bioimpedance/", json={
+        "patient_id": patient_id, "date": "2023-01-01", "weight_kg": 60.5, "bmi": 23.1,
+        "body_fat_percent": 25.0, "fat_mass_kg": 15.1, "muscle_mass_kg": 42.0
+    })
+    await client.post("/anthropometry/", json={"patient_id": patient_id, "date": "2023-01-01", "waist_cm": 70})
+    await client.post("/subjective/", json={
+        "patient_id": patient_id, "date": "2023-01-01", "metric_name": "Sono", "score": 7, "notes": "Noite agitada"
+    })
+
+    endpoints = [
+        ("/patients/", Patient, schemas.Patient),
+        ("/lab-definitions/", LabTestDefinition, schemas.LabTestDefinition),
+        (f"/patients/{patient_id}/lab-results/", LabResult, schemas.LabResult),
+        (f"/patients/{patient_id}/bioimpedance/", BioimpedanceEntry, schemas.BioimpedanceEntry),
+        (f"/patients/{patient_id}/anthropometry/", AnthropometryEntry, schemas.AnthropometryEntry),
+        (f"/patients/{patient_id}/subjective/", SubjectiveEntry, schemas.SubjectiveEntry),
+    ]
+    async with TestingSessionLocal() as session:
+        for url, model, schema in endpoints:
+            adapter = TypeAdapter(List[schema])
+            entities = (await session.execute(select(model))).scalars().all()
+            expected = adapter.dump_json(adapter.validate_python(entities, from_attributes=True))
+            response = await client.get(url)
+            assert response.status_code == 200
+            assert response.content == expected, url
+
+        response = await client.get(f"/patients/{patient_id}/dashboard")
+        patient = await session.get(Patient, patient_id)
+        assert response.json()["patient"] == json.loads(schemas.Patient.model_validate(patient).model_dump_json())
+
+@pytest.mark.asyncio
+async def test_series_downsampling_and_resampling(client):
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Long History",
+        "date_of_birth": "1970-01-01",
+        "gender": "Masculino",
+        "height_cm": 170.0
+    })).json()["id"]
+    definitions = [
+        (await client.post("/lab-definitions/", json={"name": name, "category": "Bioquímica", "unit": "mg/dL"})).json()["id"]
+        for name in ("Glicose", "Ureia")
+    ]
+    start = date(2020, 1, 1)
+    rows = [
+        {
+            "patient_id": patient_id, "test_definition_id": definition_id,
+            "collection_date": (start + timedelta(days=day)).isoformat(),
+            # A single spike LTTB must keep
+            "value": 500.0 if day == 100 else 90.0 + day % 7,
+        }
+        for definition_id in definitions for day in range(300)
+    ]
+    assert (await client.post("/lab-results/batch", json=rows)).status_code == 201
+
+    url = f"/patients/{patient_id}/lab-results/"
+    sampled = (await client.get(url, params={"points": 20})).json()
+    for definition_id in definitions:
+        series = [row for row in sampled if row["test_definition_id"] == definition_id]
+        assert len(series) == 20
+        dates = [row["collection_date"] for row in series]
+        assert dates[0] == "2020-10-26" and dates[-1] == "2020-01-01"
+        assert dates == sorted(dates, reverse=True)
+        assert any(row["value"] == 500.0 for row in series)
+
+    for month, score in (("2023-01-05", 4), ("2023-01-20", 8), ("2023-02-03", 6)):
+        await client.post("/subjective/", json={"patient_id": patient_id, "date": month, "metric_name": "Sono", "score": score})
+    buckets = (await client.get(f"/patients/{patient_id}/subjective/", params={"resample": "month"})).json()
+    assert buckets == [
+        {"period": "2023-02-01", "group": "Sono", "count": 1, "mean": {"score": 6.0}, "min": {"score": 6}, "max": {"score": 6}},
+        {"period": "2023-01-01", "group": "Sono", "count": 2, "mean": {"score": 6.0}, "min": {"score": 4}, "max": {"score": 8}},
+    ]
+    weeks = (await client.get(f"/patients/{patient_id}/subjective/", params={"resample": "week"})).json()
+    assert [bucket["period"] for bucket in weeks] == ["2023-01-30", "2023-01-16", "2023-01-02"]
+
+    assert (await client.get(url, params={"points": 20, "resample": "week"})).status_code == 400
+    cursor = (await client.get(url, params={"limit": 1})).headers["X-Next-Cursor"]
+    assert (await client.get(url, params={"points": 20, "cursor": cursor})).status_code == 400
+
+def test_lttb_large_series():
+    n, threshold = 200_000, 1000
+    xs = [float(i) for i in range(n)]
+    spikes = {12_345, 150_000}
+    ys = [1000.0 if i in spikes else float(i % 50) for i in range(n)]
+    kept = downsample.lttb_indices(xs, ys, threshold)
+    assert len(kept) == threshold
+    assert kept[0] == 0 and kept[-1] == n - 1
+    assert kept == sorted(set(kept))
+    assert spikes <= set(kept)
+
+@pytest.mark.asyncio
+async def test_population_stats_maintained_incrementally(client, monkeypatch):
+    definition_id = (await client.post("/lab-definitions/", json={
+        "name": "Hemoglobina", "category": "Hemograma", "unit": "g/dL"
+    })).json()["id"]
+
+    async def add_patient(gender, born):
+        return (await client.post("/patients/", json={
+            "full_name": f"{gender} {born}", "date_of_birth": born, "gender": gender, "height_cm": 165.0
+        })).json()["id"]
+
+    women = [await add_patient("Feminino", "1990-06-01") for _ in range(3)]
+    man = await add_patient("Masculino", "1950-01-01")
+    result_ids = []
+    for patient_id, value in zip(women + [man], (12.0, 13.0, 14.0, 15.0)):
+        result_ids.append((await client.post("/lab-results/", json={
+            "patient_id": patient_id, "test_definition_id": definition_id,
+            "collection_date": "2023-01-01", "value": value
+        })).json()["id"])
+
+    url = f"/stats/lab-tests/{definition_id}"
+    cells = {(cell["gender"], cell["age_band"]): cell for cell in (await client.get(url)).json()}
+    assert set(cells) == {("Feminino", "30-39"), ("Masculino", "70-79")}
+    women_cell = cells[("Feminino", "30-39")]
+    assert women_cell["count"] == 3
+    assert women_cell["mean"] == pytest.approx(13.0)
+    assert women_cell["variance"] == pytest.approx(1.0)
+    assert women_cell["percentiles"]["p50"] == pytest.approx(13.0, rel=0.01)
+    assert women_cell["percentiles"]["p5"] == pytest.approx(12.0, rel=0.01)
+    assert women_cell["percentiles"]["p95"] == pytest.approx(14.0, rel=0.01)
+
+    # Edits, deletions and patient changes move values between cells
+    await client.put(f"/lab-results/{result_ids[0]}", json={"value": 16.0})
+    await client.delete(f"/lab-results/{result_ids[1]}")
+    await client.put(f"/patients/{man}", json={"gender": "Feminino", "date_of_birth": "1990-01-01"})
+    response = await client.get(url, params={"gender": "Feminino", "age_band": "30-39"})
+    [women_cell] = response.json()
+    assert women_cell["count"] == 3
+    assert women_cell["mean"] == pytest.approx((16.0 + 14.0 + 15.0) / 3)
+    assert women_cell["variance"] == pytest.approx(1.0)
+    assert (await client.get(url, params={"gender": "Masculino"})).json() == []
+
+    await client.post("/bioimpedance/", json={
+        "patient_id": women[0], "date": "2023-01-01", "weight_kg": 60.0, "bmi": 22.0,
+        "body_fat_percent": 28.0, "fat_mass_kg": 16.8, "muscle_mass_kg": 40.0
+    })
+    [cell] = (await client.get("/stats/bioimpedance/body_fat_percent")).json()
+    assert cell["count"] == 1 and cell["mean"] == pytest.approx(28.0) and cell["std_dev"] == 0.0
+    assert (await client.get("/stats/bioimpedance/unknown")).status_code == 404
+
+    # A rebuild from the raw tables, merged a few rows at a time, agrees with the incremental aggregates
+    incremental = (await client.get(url)).json()
+    monkeypatch.setattr(population_stats, "REBUILD_CHUNK_SIZE", 2)
+    async with TestingSessionLocal() as session:
+        await population_stats.rebuild(session)
+        await session.commit()
+    rebuilt = (await client.get(url)).json()
+    assert [cell["count"] for cell in rebuilt] == [cell["count"] for cell in incremental]
+    assert [cell["mean"] for cell in rebuilt] == pytest.approx([cell["mean"] for cell in incremental])
+    assert [cell["variance"] for cell in rebuilt] == pytest.approx([cell["variance"] for cell in incremental])
+
+@pytest.mark.asyncio
+async def test_population_stats_variance_of_large_values(client):
+    """Values far from zero with a small spread, where a sum of squares loses every digit of the variance."""
+    definition_id = (await client.post("/lab-definitions/", json={
+        "name": "Plaquetas", "category": "Hemograma", "unit": "/mm3"
+    })).json()["id"]
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Large Values", "date_of_birth": "1990-01-01", "gender": "Feminino", "height_cm": 160.0
+    })).json()["id"]
+    created = (await client.post("/lab-results/batch", json=[
+        {"patient_id": patient_id, "test_definition_id": definition_id, "collection_date": "2023-01-01", "value": 1e9 + offset}
+        for offset in (1.0, 2.0, 3.0)
+    ])).json()["created"]
+    url = f"/stats/lab-tests/{definition_id}"
+    [cell] = (await client.get(url)).json()
+    assert cell["mean"] == pytest.approx(1e9 + 2.0, abs=1e-6)
+    assert cell["variance"] == pytest.approx(1.0)
+
+    # An edit within the cell
+    await client.put(f"/lab-results/{created[2]['id']}", json={"value": 1e9 + 4.0})
+    [cell] = (await client.get(url)).json()
+    assert cell["mean"] == pytest.approx(1e9 + 7 / 3, abs=1e-6)
+    assert cell["variance"] == pytest.approx(7 / 3)
+
+@pytest.mark.asyncio
+async def test_migrations_population_stats_running_moments(client):
+    async with engine.begin() as conn:
+        # The table as it was with sums of the values
+        await conn.exec_driver_sql("DROP TABLE population_stats")
+        await conn.exec_driver_sql(
+            "CREATE TABLE population_stats (source VARCHAR(20), metric VARCHAR(50), gender VARCHAR(20), "
+            "age_band VARCHAR(10), count INTEGER NOT NULL, total FLOAT NOT NULL, total_sq FLOAT NOT NULL, "
+            "PRIMARY KEY (source, metric, gender, age_band))"
+        )
+        # Values 12, 13 and 14
+        await conn.exec_driver_sql(
+            "INSERT INTO population_stats VALUES ('lab', '1', 'Feminino', '30-39', 3, 39.0, 509.0)"
+        )
+        await conn.run_sync(migrations.upgrade)
+        # Idempotent
+        await conn.run_sync(migrations.upgrade)
+        columns = {row[1] for row in (await conn.exec_driver_sql("PRAGMA table_info('population_stats')")).all()}
+
+    assert "total" not in columns and "total_sq" not in columns
+    async with TestingSessionLocal() as session:
+        [cell] = await population_stats.read(session, "lab", "1")
+    assert cell["count"] == 3
+    assert cell["mean"] == pytest.approx(13.0)
+    assert cell["variance"] == pytest.approx(1.0)
+
+@pytest.mark.asyncio
+async def test_population_stats_upserts_in_key_order(client):
+    """Overlapping batches lock stat rows in the same order, whatever order their rows came in."""
+    definitions = [(await client.post("/lab-definitions/", json={
+        "name": name, "category": "Bioquímica", "unit": "mg/dL"
+    })).json()["id"] for name in ("Glicose", "Ureia", "Creatinina")]
+    patients = [(await client.post("/patients/", json={
+        "full_name": f"Order {gender}", "date_of_birth": born, "gender": gender, "height_cm": 170.0
+    })).json()["id"] for gender, born in (("Feminino", "1990-01-01"), ("Masculino", "1950-01-01"))]
+    rows = [
+        {"patient_id": patient_id, "test_definition_id": definition_id, "collection_date": "2023-01-01", "value": value}
+        for patient_id in patients for definition_id in definitions for value in (1.0, 50.0)
+    ]
+
+    upserts = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO population_stat"):
+            upserts.append([tuple(row[:4]) for row in parameters] if executemany else [tuple(parameters[:4])])
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+    try:
+        for batch in (rows, rows[::-1]):
+            response = await client.post("/lab-results/batch", json=batch)
+            assert response.status_code == 201
+            assert len(response.json()["created"]) == len(rows)
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", record)
+
+    # Stats then bins, each in key order, for both batches
+    assert len(upserts) == 4
+    assert upserts[:2] == upserts[2:]
+    for keys in upserts:
+        assert keys == sorted(keys)
+    for definition_id in definitions:
+        cells = (await client.get(f"/stats/lab-tests/{definition_id}")).json()
+        assert [cell["count"] for cell in cells] == [4, 4]
+
+@pytest.mark.asyncio
+async def test_latest_values_maintained_on_writes(client):
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Latest Patient",
+        "date_of_birth": "1980-01-01",
+        "gender": "Masculino",
+        "height_cm": 180.0
+    })).json()["id"]
+    glucose, urea = [
+        (await client.post("/lab-definitions/", json={"name": name, "category": "Bioquímica", "unit": "mg/dL"})).json()["id"]
+        for name in ("Glicose", "Ureia")
+    ]
+    url = f"/patients/{patient_id}/latest"
+    assert (await client.get(url)).json() == {"lab_results": [], "bioimpedance": None, "anthropometry": None}
+
+    batch = await client.post("/lab-results/batch", json=[
+        {"patient_id": patient_id, "test_definition_id": glucose, "collection_date": "2023-01-01", "value": 90.0},
+        {"patient_id": patient_id, "test_definition_id": glucose, "collection_date": "2023-03-01", "value": 95.0},
+        {"patient_id": patient_id, "test_definition_id": urea, "collection_date": "2023-02-01", "value": 30.0},
+    ])
+    newest_glucose = batch.json()["created"][1]["id"]
+    older = (await client.post("/lab-results/", json={
+        "patient_id": patient_id, "test_definition_id": urea, "collection_date": "2022-01-01", "value": 25.0
+    })).json()["id"]
+    await client.post("/anthropometry/", json={"patient_id": patient_id, "date": "2023-01-01", "waist_cm": 90.0})
+    await client.post("/anthropometry/", json={"patient_id": patient_id, "date": "2022-01-01", "waist_cm": 99.0})
+
+    data = (await client.get(url)).json()
+    assert [(row["test_definition_id"], row["value"]) for row in data["lab_results"]] == [(glucose, 95.0), (urea, 30.0)]
+    assert data["anthropometry"]["waist_cm"] == 90.0
+    assert data["bioimpedance"] is None
+
+    # Moving an old result forward, deleting the newest and editing in place
+    await client.put(f"/lab-results/{older}", json={"collection_date": "2024-01-01"})
+    await client.delete(f"/lab-results/{newest_glucose}")
+    data = (await client.get(url)).json()
+    assert [(row["test_definition_id"], row["value"]) for row in data["lab_results"]] == [(glucose, 90.0), (urea, 25.0)]
+
+    await client.put(f"/lab-results/{older}", json={"value": 26.0})
+    data = (await client.get(url)).json()
+    assert data["lab_results"][1]["value"] == 26.0
+
+    # Moving the latest result back in time or to another test recomputes its old slot
+    await client.put(f"/lab-results/{older}", json={"collection_date": "2020-01-01"})
+    data = (await client.get(url)).json()
+    assert [(row["test_definition_id"], row["value"]) for row in data["lab_results"]] == [(glucose, 90.0), (urea, 30.0)]
+    await client.put(f"/lab-results/{older}", json={"test_definition_id": glucose, "collection_date": "2023-01-01"})
+    data = (await client.get(url)).json()
+    # Same date as the other glucose result: the higher id wins
+    assert [(row["test_definition_id"], row["value"]) for row in data["lab_results"]] == [(glucose, 26.0), (urea, 30.0)]
+
+    # An older entry does not displace the pointer; moving the latest to another patient does
+    other = (await client.post("/patients/", json={
+        "full_name": "Other Patient", "date_of_birth": "1980-01-01", "gender": "Feminino", "height_cm": 160.0
+    })).json()["id"]
+    tapes = (await client.post("/anthropometry/batch", json=[
+        {"patient_id": other, "date": "2021-01-01", "waist_cm": 70.0},
+        {"patient_id": other, "date": "2021-06-01", "waist_cm": 71.0},
+    ])).json()["created"]
+    await client.post("/anthropometry/", json={"patient_id": other, "date": "2020-01-01", "waist_cm": 72.0})
+    assert (await client.get(f"/patients/{other}/latest")).json()["anthropometry"]["waist_cm"] == 71.0
+    await client.put(f"/anthropometry/{tapes[1]['id']}", json={"patient_id": patient_id, "date": "2024-01-01"})
+    assert (await client.get(f"/patients/{other}/latest")).json()["anthropometry"]["waist_cm"] == 70.0
+    assert (await client.get(url)).json()["anthropometry"]["waist_cm"] == 71.0
+
+    # The incremental pointers agree with a rebuild from the raw tables
+    async def pointers():
+        async with TestingSessionLocal() as session:
+            return [
+                sorted((await session.execute(select(pointers.table.__table__))).tuples().all())
+                for pointers in latest.ALL
+            ]
+    incremental = await pointers()
+    async with TestingSessionLocal() as session:
+        await latest.rebuild(session)
+        await session.commit()
+    assert await pointers() == incremental
+
+    # The pointer lookup is a primary key range scan, not a history scan
+    async with engine.connect() as conn:
+        plan = await conn.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT lab_result_id FROM latest_lab_values WHERE patient_id = ?", (patient_id,)
+        )
+        details = " ".join(row[-1] for row in plan.fetchall())
+    assert "USING PRIMARY KEY" in details or "sqlite_autoindex_latest_lab_values" in details
+
+@pytest.mark.asyncio
+async def test_lab_alerts_worklist(client):
+    patients = [
+        (await client.post("/patients/", json={
+            "full_name": name, "date_of_birth": "1980-01-01", "gender": "Feminino", "height_cm": 160.0
+        })).json()["id"]
+        for name in ("Ana", "Bia")
+    ]
+    glucose = (await client.post("/lab-definitions/", json={
+        "name": "Glicose", "category": "Bioquímica", "unit": "mg/dL", "ref_min_female": 70, "ref_max_female": 99
+    })).json()["id"]
+    hemoglobin = (await client.post("/lab-definitions/", json={
+        "name": "Hemoglobina", "category": "Hemograma", "unit": "g/dL", "ref_min_female": 11.5, "ref_max_female": 15
+    })).json()["id"]
+    today = date.today()
+    rows = [
+        # (patient, test, days ago, value) -> flag
+        (patients[0], glucose, 1, 120.0),     # Alto
+        (patients[0], glucose, 2, 85.0),      # Normal
+        (patients[1], hemoglobin, 3, 9.0),    # Baixo
+        (patients[1], glucose, 4, 50.0),      # Baixo
+        (patients[0], hemoglobin, 5, 17.0),   # Alto
+        (patients[1], glucose, 60, 150.0),    # Alto, outside the default window
+    ]
+    await client.post("/lab-results/batch", json=[
+        {"patient_id": patient_id, "test_definition_id": test_id,
+         "collection_date": (today - timedelta(days=days)).isoformat(), "value": value}
+        for patient_id, test_id, days, value in rows
+    ])
+
+    first = await client.get("/lab-results/alerts", params={"limit": 2})
+    assert first.status_code == 200
+    page = first.json()
+    assert [(alert["value"], alert["flag"]) for alert in page] == [(120.0, "Alto"), (9.0, "Baixo")]
+    assert page[0]["patient_name"] == "Ana" and page[0]["test_name"] == "Glicose" and page[0]["unit"] == "mg/dL"
+    second = await client.get("/lab-results/alerts", params={"limit": 2, "cursor": first.headers["X-Next-Cursor"]})
+    assert [alert["value"] for alert in second.json()] == [50.0, 17.0]
+    assert "X-Next-Cursor" not in second.headers
+
+    response = await client.get("/lab-results/alerts", params={"category": "Hemograma", "flag": "Alto"})
+    assert [alert["value"] for alert in response.json()] == [17.0]
+    since = (today - timedelta(days=90)).isoformat()
+    response = await client.get("/lab-results/alerts", params={"since": since, "flag": "Alto"})
+    assert [alert["value"] for alert in response.json()] == [120.0, 17.0, 150.0]
+    assert (await client.get("/lab-results/alerts", params={"flag": "Normal"})).status_code == 422
+
+    statement = queries.lab_alerts("Alto", today).compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True})
+    async with engine.connect() as conn:
+        plan = " ".join(row[-1] for row in (await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}")).all())
+    assert "ix_lab_results_flag_date" in plan
+    assert "TEMP B-TREE" not in plan
+
+@pytest.mark.asyncio
+async def test_bench_scenarios_run(client):
+    patient_id = (await client.post("/patients/", json={
+        "full_name": "Bench Patient", "date_of_birth": "1980-01-01", "gender": "Feminino", "height_cm": 165.0
+    })).json()["id"]
+    definition_id = (await client.post("/lab-definitions/", json={
+        "name": "Glicose", "category": "Bioquímica", "unit": "mg/dL", "ref_min_female": 70, "ref_max_female": 99
+    })).json()["id"]
+    await client.post("/lab-results/", json={
+        "patient_id": patient_id, "test_definition_id": definition_id, "collection_date": "2025-12-01", "value": 120.0
+    })
+
+    # Paired scenarios do the same work
+    async with TestingSessionLocal() as session:
+        assert await bench.lab_results_orm(session, patient_id) == await bench.lab_results_projection(session, patient_id)
+        orm, returning = await bench.insert_patient_orm(session), await bench.insert_patient_returning(session)
+        assert orm.keys() == returning.keys() and orm["id"] + 1 == returning["id"]
+
+    ctx = bench.Context(client, TestingSessionLocal, patient_id=patient_id, definition_id=definition_id)
+    for name, scenario in bench.SCENARIOS.items():
+        result = await bench.measure(scenario, ctx, iterations=2, warmup=1, concurrency=1)
+        assert result["p50_ms"] <= result["p99_ms"], name
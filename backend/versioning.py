@@ -0,0 +1,134 @@
+"""
+Per-patient data versions for conditional GETs.
+
+Every write that changes what a patient-scoped GET would return bumps the patient's
+``data_version`` (and ``data_updated_at``) in the same transaction. Patient-scoped
+GETs then send ``ETag``/``Last-Modified`` derived from that version, and answer
+``If-None-Match`` with ``304 Not Modified`` after reading only the version row.
+
+Views that are also built from the lab definition catalog (flags, test names and
+the definitions themselves) depend on one more version: the ``lab-definitions``
+row of ``data_versions``, which the definition write handlers bump instead of
+every patient's. ``conditional_get_with_definitions`` folds it into the ETag, so
+a catalog change is one row write and only invalidates the views that use it.
+The definition endpoints themselves are validated by that version alone
+(``conditional_get_definitions``). Being read from the database, these versions
+are the same in every worker process.
+"""
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from typing import Optional
+
+from fastapi import Depends, HTTPException, Request, Response
+from sqlalchemy import update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from database import get_db
+from models import DataVersion, Patient
+
+DEFINITIONS = "lab-definitions"
+
+
+def patient_etag(patient_id: int, version: int, definitions_version: Optional[int] = None) -> str:
+    if definitions_version is None:
+        return f'W/"patient-{patient_id}-v{version}"'
+    return f'W/"patient-{patient_id}-v{version}-d{definitions_version}"'
+
+
+def definitions_etag(version: int) -> str:
+    return f'W/"lab-definitions-v{version}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in if_none_match.split(","))
+
+
+async def touch_patients(db: AsyncSession, *patient_ids: Optional[int]) -> None:
+    """Bump the data version of the given patients; call before committing the write."""
+    ids = {patient_id for patient_id in patient_ids if patient_id is not None}
+    if not ids:
+        return
+    await db.execute(
+        update(Patient).where(Patient.id.in_(ids))
+        .values(data_version=Patient.data_version + 1, data_updated_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def touch_definitions(db: AsyncSession) -> None:
+    """Bump the lab definitions version; call before committing a catalog change."""
+    now = datetime.utcnow()
+    insert = postgresql.insert if db.get_bind().dialect.name == "postgresql" else sqlite.insert
+    await db.execute(
+        insert(DataVersion).values(name=DEFINITIONS, version=1, updated_at=now)
+        .on_conflict_do_update(index_elements=["name"], set_={"version": DataVersion.version + 1, "updated_at": now})
+    )
+
+
+def _definitions_version(column):
+    return select(column).where(DataVersion.name == DEFINITIONS).scalar_subquery()
+
+
+async def _conditional_get(
+    patient_id: int, request: Request, response: Response, db: AsyncSession, with_definitions: bool,
+) -> None:
+    columns = [Patient.data_version, Patient.data_updated_at, Patient.created_at]
+    if with_definitions:
+        columns += [
+            _definitions_version(DataVersion.version).label("definitions_version"),
+            _definitions_version(DataVersion.updated_at).label("definitions_updated_at"),
+        ]
+    row = (await db.execute(select(*columns).where(Patient.id == patient_id))).first()
+    if row is None:
+        return
+
+    modified_at = row.data_updated_at or row.created_at
+    if with_definitions:
+        etag = patient_etag(patient_id, row.data_version or 0, row.definitions_version or 0)
+        if row.definitions_updated_at is not None and (modified_at is None or row.definitions_updated_at > modified_at):
+            modified_at = row.definitions_updated_at
+    else:
+        etag = patient_etag(patient_id, row.data_version or 0)
+    _set_validators(request, response, etag, modified_at)
+
+
+def _set_validators(request: Request, response: Response, etag: str, modified_at: Optional[datetime]) -> None:
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if modified_at is not None:
+        headers["Last-Modified"] = format_datetime(modified_at.replace(tzinfo=timezone.utc), usegmt=True)
+
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        raise HTTPException(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+
+async def conditional_get(patient_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_db)):
+    """
+    Dependency for patient-scoped GETs. Sets the validators on the response, or
+    short-circuits with 304 when the client already has the current version.
+    Unknown patients pass through so the handler keeps its own 404/empty behavior.
+    """
+    await _conditional_get(patient_id, request, response, db, with_definitions=False)
+
+
+async def conditional_get_with_definitions(
+    patient_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_db),
+):
+    """``conditional_get`` for patient views that also show lab definition data."""
+    await _conditional_get(patient_id, request, response, db, with_definitions=True)
+
+
+async def conditional_get_definitions(request: Request, response: Response, db: AsyncSession = Depends(get_db)):
+    """Dependency for the lab definition GETs, validated by the catalog version."""
+    row = (await db.execute(
+        select(DataVersion.version, DataVersion.updated_at).where(DataVersion.name == DEFINITIONS)
+    )).first()
+    version, modified_at = (row.version or 0, row.updated_at) if row is not None else (0, None)
+    _set_validators(request, response, definitions_etag(version), modified_at)
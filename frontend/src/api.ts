@@ -3,12 +3,15 @@ import type {
   AnthropometryEntryCreate,
   BioimpedanceEntry,
   BioimpedanceEntryCreate,
+  LabAlert,
   LabResult,
   LabResultCreate,
+  LabResultMatrix,
   LabTestDefinition,
   LabTestDefinitionCreate,
   Patient,
   PatientCreate,
+  PatientDashboard,
   PatientUpdate,
   SubjectiveEntry,
   SubjectiveEntryCreate,
@@ -18,11 +21,11 @@ const API_BASE_URL = import.meta.env.VITE_API_BASE_URL ?? "/api";
 
 type ApiMethod = "GET" | "POST" | "PUT" | "DELETE";
 
-async function request<T>(
-  endpoint: string,
-  method: ApiMethod = "GET",
-  body?: unknown,
-): Promise<T> {
+// Lists are paginated: a response holds one page and the next page's cursor
+// comes in this header (absent on the last page)
+const NEXT_CURSOR_HEADER = "X-Next-Cursor";
+
+async function send(endpoint: string, method: ApiMethod, body?: unknown): Promise<Response> {
   const headers: HeadersInit = body ? { "Content-Type": "application/json" } : {};
 
   const response = await fetch(`${API_BASE_URL}${endpoint}`, {
@@ -48,6 +51,16 @@ async function request<T>(
     throw new Error(`API ${response.status}: ${detail}`);
   }
 
+  return response;
+}
+
+async function request<T>(
+  endpoint: string,
+  method: ApiMethod = "GET",
+  body?: unknown,
+): Promise<T> {
+  const response = await send(endpoint, method, body);
+
   if (response.status === 204) {
     return undefined as T;
   }
@@ -55,44 +68,74 @@ async function request<T>(
   return (await response.json()) as T;
 }
 
+// Every page of a list, following the cursor. Patient series are capped at 500
+// rows per page, so a long history spans several requests.
+async function requestAll<T>(endpoint: string): Promise<T[]> {
+  const items: T[] = [];
+  let cursor: string | null = null;
+  do {
+    const separator = endpoint.includes("?") ? "&" : "?";
+    const url: string = cursor ? `${endpoint}${separator}${new URLSearchParams({ cursor }).toString()}` : endpoint;
+    const response = await send(url, "GET");
+    items.push(...((await response.json()) as T[]));
+    cursor = response.headers.get(NEXT_CURSOR_HEADER);
+  } while (cursor);
+  return items;
+}
+
 export const medicalApi = {
-  listPatients: (skip = 0, limit = 100) =>
-    request<Patient[]>(`/patients/?skip=${skip}&limit=${limit}`),
+  listPatients: (limit = 100) => request<Patient[]>(`/patients/?limit=${limit}`),
+  searchPatients: (q: string, limit = 100) =>
+    request<Patient[]>(`/patients/search?${new URLSearchParams({ q, limit: String(limit) }).toString()}`),
   getPatient: (patientId: number) => request<Patient>(`/patients/${patientId}`),
   createPatient: (payload: PatientCreate) => request<Patient>("/patients/", "POST", payload),
   updatePatient: (patientId: number, payload: PatientUpdate) =>
     request<Patient>(`/patients/${patientId}`, "PUT", payload),
   deletePatient: (patientId: number) => request<void>(`/patients/${patientId}`, "DELETE"),
+  // Each series holds only its newest 500 rows; the list helpers below return full histories
+  getPatientDashboard: (patientId: number) =>
+    request<PatientDashboard>(`/patients/${patientId}/dashboard`),
 
-  listLabDefinitions: (skip = 0, limit = 100) =>
-    request<LabTestDefinition[]>(`/lab-definitions/?skip=${skip}&limit=${limit}`),
+  listLabDefinitions: (limit = 100) =>
+    requestAll<LabTestDefinition>(`/lab-definitions/?limit=${limit}`),
   createLabDefinition: (payload: LabTestDefinitionCreate) =>
     request<LabTestDefinition>("/lab-definitions/", "POST", payload),
   updateLabDefinition: (id: number, payload: Partial<LabTestDefinitionCreate>) =>
     request<LabTestDefinition>(`/lab-definitions/${id}`, "PUT", payload),
 
   createLabResult: (payload: LabResultCreate) => request<LabResult>("/lab-results/", "POST", payload),
-  listPatientLabResults: (patientId: number) => request<LabResult[]>(`/patients/${patientId}/lab-results/`),
+  listPatientLabResults: (patientId: number) => requestAll<LabResult>(`/patients/${patientId}/lab-results/`),
+  getPatientLabMatrix: (patientId: number, category?: string) =>
+    request<LabResultMatrix>(
+      `/patients/${patientId}/lab-results/matrix${category ? `?${new URLSearchParams({ category }).toString()}` : ""}`,
+    ),
 
   createBioimpedanceEntry: (payload: BioimpedanceEntryCreate) =>
     request<BioimpedanceEntry>("/bioimpedance/", "POST", payload),
   listPatientBioimpedance: (patientId: number) =>
-    request<BioimpedanceEntry[]>(`/patients/${patientId}/bioimpedance/`),
+    requestAll<BioimpedanceEntry>(`/patients/${patientId}/bioimpedance/`),
 
   createAnthropometryEntry: (payload: AnthropometryEntryCreate) =>
     request<AnthropometryEntry>("/anthropometry/", "POST", payload),
   listPatientAnthropometry: (patientId: number) =>
-    request<AnthropometryEntry[]>(`/patients/${patientId}/anthropometry/`),
+    requestAll<AnthropometryEntry>(`/patients/${patientId}/anthropometry/`),
 
   createSubjectiveEntry: (payload: SubjectiveEntryCreate) =>
     request<SubjectiveEntry>("/subjective/", "POST", payload),
   listPatientSubjectiveEntries: (patientId: number) =>
-    request<SubjectiveEntry[]>(`/patients/${patientId}/subjective/`),
+    requestAll<SubjectiveEntry>(`/patients/${patientId}/subjective/`),
 
   // NEW METHODS
   updateLabResult: (id: number, payload: Partial<LabResultCreate>) =>
     request<LabResult>(`/lab-results/${id}`, "PUT", payload),
   deleteLabResult: (id: number) => request<void>(`/lab-results/${id}`, "DELETE"),
+  listLabAlerts: (params: { since?: string; category?: string; flag?: string; limit?: number } = {}) => {
+    const query = new URLSearchParams();
+    Object.entries(params).forEach(([key, value]) => {
+      if (value !== undefined) query.set(key, String(value));
+    });
+    return request<LabAlert[]>(`/lab-results/alerts?${query.toString()}`);
+  },
 
   deleteLabDefinition: (id: number) => request<void>(`/lab-definitions/${id}`, "DELETE"),
 
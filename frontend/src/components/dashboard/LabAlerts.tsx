@@ -1,57 +1,33 @@
 import { useMemo, useState } from "react";
 import { formatDate } from "../../helpers";
-import type { LabResult, LabTestDefinition, Patient } from "../../types";
+import type { LabResultMatrix, LabTestDefinition, Patient } from "../../types";
 import { Modal } from "../common/Modal";
 
 import { AlertCircle } from "lucide-react";
 
 type Props = {
-    results: LabResult[];
+    matrix: LabResultMatrix | undefined;
     definitions: LabTestDefinition[];
     patient: Patient | null;
 };
 
-export function LabAlerts({ results, definitions, patient }: Props) {
+export function LabAlerts({ matrix, definitions, patient }: Props) {
     const [showAllAlerts, setShowAllAlerts] = useState(false);
 
     const alerts = useMemo(() => {
-        if (!patient) return [];
-
-        const defMap = new Map(definitions.map((d) => [d.id, d]));
-        const isFemale = patient.gender.toLowerCase().startsWith("f");
-
-        const outOfRange = results.filter((result) => {
-            const def = defMap.get(result.test_definition_id);
-            if (!def) return false;
-
-            const min = isFemale ? def.ref_min_female : def.ref_min_male;
-            const max = isFemale ? def.ref_max_female : def.ref_max_male;
-
-            if (min === null && max === null) return false;
-
-            const lower = min ?? -Infinity;
-            const upper = max ?? Infinity;
-
-            return result.value < lower || result.value > upper;
+        if (!patient || !matrix) return [];
+
+        // Flags are computed by the API from the reference ranges and the patient's gender.
+        // Dates are newest first, so each test's first out-of-range cell is its latest.
+        const latest = matrix.tests.flatMap((test, row) => {
+            const column = matrix.flags[row].findIndex((flag) => flag === "Alto" || flag === "Baixo");
+            return column === -1
+                ? []
+                : [{ test, date: matrix.dates[column], value: matrix.values[row][column] }];
         });
 
-        outOfRange.sort((a, b) => b.collection_date.localeCompare(a.collection_date));
-
-        const seenNames = new Set<string>();
-        const uniqueAlerts: LabResult[] = [];
-
-        for (const result of outOfRange) {
-            const def = defMap.get(result.test_definition_id);
-            if (def) {
-                if (!seenNames.has(def.name)) {
-                    seenNames.add(def.name);
-                    uniqueAlerts.push(result);
-                }
-            }
-        }
-
-        return uniqueAlerts;
-    }, [results, definitions, patient]);
+        return latest.sort((a, b) => b.date.localeCompare(a.date));
+    }, [matrix, patient]);
 
     if (alerts.length === 0) {
         return null;
@@ -79,16 +55,16 @@ export function LabAlerts({ results, definitions, patient }: Props) {
                         </thead>
                         <tbody>
                             {alerts.slice(0, 5).map((result) => {
-                                const def = defMap.get(result.test_definition_id);
+                                const def = defMap.get(result.test.id);
                                 const isFemale = patient?.gender.toLowerCase().startsWith("f");
                                 const min = isFemale ? def?.ref_min_female : def?.ref_min_male;
                                 const max = isFemale ? def?.ref_max_female : def?.ref_max_male;
 
                                 return (
-                                    <tr key={result.id}>
-                                        <td>{formatDate(result.collection_date)}</td>
-                                        <td><strong>{def?.name ?? "Desconhecido"}</strong></td>
-                                        <td style={{ color: "var(--danger)", fontWeight: 600 }}>{result.value} {def?.unit}</td>
+                                    <tr key={result.test.id}>
+                                        <td>{formatDate(result.date)}</td>
+                                        <td><strong>{result.test.name}</strong></td>
+                                        <td style={{ color: "var(--danger)", fontWeight: 600 }}>{result.value} {result.test.unit}</td>
                                         <td className="muted-text">
                                             {min !== null ? min : "?"} - {max !== null ? max : "?"}
                                         </td>
@@ -136,16 +112,16 @@ export function LabAlerts({ results, definitions, patient }: Props) {
                         </thead>
                         <tbody>
                             {alerts.map((result) => {
-                                const def = defMap.get(result.test_definition_id);
+                                const def = defMap.get(result.test.id);
                                 const isFemale = patient?.gender.toLowerCase().startsWith("f");
                                 const min = isFemale ? def?.ref_min_female : def?.ref_min_male;
                                 const max = isFemale ? def?.ref_max_female : def?.ref_max_male;
 
                                 return (
-                                    <tr key={result.id}>
-                                        <td>{formatDate(result.collection_date)}</td>
-                                        <td><strong>{def?.name ?? "Desconhecido"}</strong></td>
-                                        <td style={{ color: "var(--danger)", fontWeight: 600 }}>{result.value} {def?.unit}</td>
+                                    <tr key={result.test.id}>
+                                        <td>{formatDate(result.date)}</td>
+                                        <td><strong>{result.test.name}</strong></td>
+                                        <td style={{ color: "var(--danger)", fontWeight: 600 }}>{result.value} {result.test.unit}</td>
                                         <td className="muted-text">
                                             {min !== null ? min : "?"} - {max !== null ? max : "?"}
                                         </td>
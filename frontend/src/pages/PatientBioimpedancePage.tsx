@@ -1,4 +1,4 @@
-﻿import { useEffect, useMemo, useState } from "react";
+﻿import { useEffect, useState } from "react";
 import type { FormEvent } from "react";
 import { useOutletContext } from "react-router-dom";
 import { Edit, Trash2 } from "lucide-react";
@@ -54,9 +54,8 @@ export function PatientBioimpedancePage() {
   // Delete State
   const [deletingId, setDeletingId] = useState<number | null>(null);
 
-  const sorted = useMemo(() => {
-    return [...entries].sort((left, right) => right.date.localeCompare(left.date));
-  }, [entries]);
+  // The API returns the history already ordered newest first.
+  const sorted = entries;
 
   const loadEntries = async () => {
     const loaded = await medicalApi.listPatientBioimpedance(patientId);
@@ -17,36 +17,33 @@ export function PatientDashboardPage() {
 
   /*
    * REACT QUERY:
-   * We fetch all data in parallel using useQuery.
-   * Since there are multiple dependent queries, we can use multiple useQuery hooks or better yet,
-   * a single useQuery that fetches everything if we want them to load together (like Promise.all).
-   *
-   * For simplicity and to keep the "one loading state" behavior without waterfalls, we can do a single query.
-   * Alternatively, separate queries would allow parts of the UI to load independently.
-   * Given the current UI structure (NoticeBanner, then content), a single query is easier to migrate to.
+   * The whole dashboard (patient, definitions and the four series) comes from a single
+   * aggregated endpoint, so the page keeps its "one loading state" behavior with one request.
+   * Each series is capped at its newest 500 rows, so the charts cover that window; the
+   * per-series pages load the full history.
    */
 
   const { data, isLoading: loading, error } = useQuery({
     queryKey: ["patient-dashboard", patientId],
     queryFn: async () => {
-      const [labDefinitions, labResults, bioimpedanceEntries, anthropometryEntries, subjectiveEntries] = await Promise.all([
-        medicalApi.listLabDefinitions(),
-        medicalApi.listPatientLabResults(patientId),
-        medicalApi.listPatientBioimpedance(patientId),
-        medicalApi.listPatientAnthropometry(patientId),
-        medicalApi.listPatientSubjectiveEntries(patientId),
-      ]);
+      const dashboard = await medicalApi.getPatientDashboard(patientId);
 
       return {
-        definitions: labDefinitions,
-        labResults,
-        bioimpedanceEntries,
-        anthropometryEntries,
-        subjectiveEntries,
+        definitions: dashboard.lab_definitions,
+        labResults: dashboard.lab_results,
+        bioimpedanceEntries: dashboard.bioimpedance_entries,
+        anthropometryEntries: dashboard.anthropometry_entries,
+        subjectiveEntries: dashboard.subjective_entries,
       };
     },
   });
 
+  // Lab alerts read the tests × dates matrix, pivoted by the API
+  const { data: labMatrix } = useQuery({
+    queryKey: ["patient-lab-matrix", patientId],
+    queryFn: () => medicalApi.getPatientLabMatrix(patientId),
+  });
+
   // Extract data with safe defaults
   const definitions = data?.definitions ?? [];
   const dashboardData = useMemo(() => {
@@ -67,22 +64,11 @@ export function PatientDashboardPage() {
     return new Map<number, LabTestDefinition>(definitions.map((definition) => [definition.id, definition]));
   }, [definitions]);
 
-  const sortedLabs = useMemo(
-    () => [...dashboardData.labResults].sort((left, right) => right.collection_date.localeCompare(left.collection_date)),
-    [dashboardData.labResults],
-  );
-  const sortedBio = useMemo(
-    () => [...dashboardData.bioimpedanceEntries].sort((left, right) => right.date.localeCompare(left.date)),
-    [dashboardData.bioimpedanceEntries],
-  );
-  const sortedAnthro = useMemo(
-    () => [...dashboardData.anthropometryEntries].sort((left, right) => right.date.localeCompare(left.date)),
-    [dashboardData.anthropometryEntries],
-  );
-  const sortedSubjective = useMemo(
-    () => [...dashboardData.subjectiveEntries].sort((left, right) => right.date.localeCompare(left.date)),
-    [dashboardData.subjectiveEntries],
-  );
+  // Series arrive from the API already ordered newest first.
+  const sortedLabs = dashboardData.labResults;
+  const sortedBio = dashboardData.bioimpedanceEntries;
+  const sortedAnthro = dashboardData.anthropometryEntries;
+  const sortedSubjective = dashboardData.subjectiveEntries;
 
   const latestBio = sortedBio[0] ?? null;
   const latestAnthro = sortedAnthro[0] ?? null;
@@ -149,7 +135,7 @@ export function PatientDashboardPage() {
             </div>
           </section>
 
-          <LabAlerts results={dashboardData.labResults} definitions={definitions} patient={patient} />
+          <LabAlerts matrix={labMatrix} definitions={definitions} patient={patient} />
 
           <section className="grid-two">
             <EvolutionChart
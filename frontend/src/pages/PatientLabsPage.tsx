@@ -49,9 +49,8 @@ export function PatientLabsPage() {
     return new Map<number, LabTestDefinition>(definitions.map((definition) => [definition.id, definition]));
   }, [definitions]);
 
-  const sorted = useMemo(() => {
-    return [...results].sort((left, right) => right.collection_date.localeCompare(left.collection_date));
-  }, [results]);
+  // The API returns the history already ordered newest first.
+  const sorted = results;
 
   const loadData = async () => {
     const [loadedDefinitions, loadedResults] = await Promise.all([
@@ -1,5 +1,5 @@
-﻿import { useMemo, useState } from "react";
-import { useQuery, useQueryClient } from "@tanstack/react-query";
+﻿import { useState } from "react";
+import { keepPreviousData, useQuery, useQueryClient } from "@tanstack/react-query";
 import { Edit, FolderOpen, Trash2 } from "lucide-react";
 import type { FormEvent } from "react";
 import { useNavigate } from "react-router-dom";
@@ -32,9 +32,12 @@ export function PatientsPage() {
   const [notice, setNotice] = useState<Notice | null>(null);
   const [action, setAction] = useState<string | null>(null);
 
+  // Names are matched server-side (accent-insensitive, indexed) once there is a search term
+  const term = search.trim();
   const { data: patients = [], isLoading: loading, error } = useQuery({
-    queryKey: ["patients"],
-    queryFn: () => medicalApi.listPatients(),
+    queryKey: term ? ["patients", "search", term] : ["patients"],
+    queryFn: () => (term ? medicalApi.searchPatients(term) : medicalApi.listPatients()),
+    placeholderData: keepPreviousData,
   });
 
   // Effect to handle query errors if needed, or render error in UI
@@ -49,13 +52,6 @@ export function PatientsPage() {
   const [editPatientId, setEditPatientId] = useState<number | null>(null);
   const [editForm, setEditForm] = useState<PatientFormState>(emptyForm);
 
-  const filteredPatients = useMemo(() => {
-    const normalized = search.trim().toLowerCase();
-    if (!normalized) {
-      return patients;
-    }
-    return patients.filter((patient) => patient.full_name.toLowerCase().includes(normalized));
-  }, [patients, search]);
 
 
 
@@ -172,7 +168,7 @@ export function PatientsPage() {
             style={{ maxWidth: "320px" }}
           />
           <div className="muted-text">
-            {filteredPatients.length} registros
+            {patients.length} registros
           </div>
         </div>
 
@@ -192,14 +188,14 @@ export function PatientsPage() {
                 </tr>
               </thead>
               <tbody>
-                {filteredPatients.length === 0 ? (
+                {patients.length === 0 ? (
                   <tr>
                     <td colSpan={6} className="empty-cell" style={{ padding: "2rem" }}>
                       Nenhum paciente encontrado.
                     </td>
                   </tr>
                 ) : (
-                  filteredPatients.map((patient) => {
+                  patients.map((patient) => {
                     const age = calculateAge(patient.date_of_birth);
                     return (
                       <tr key={patient.id}>
@@ -51,6 +51,34 @@ export interface LabResult {
   flag: string | null;
 }
 
+export interface LabMatrixTest {
+  id: number;
+  name: string;
+  category: string;
+  unit: string;
+}
+
+// values[i][j] and flags[i][j] are tests[i] on dates[j]; dates newest first
+export interface LabResultMatrix {
+  dates: string[];
+  tests: LabMatrixTest[];
+  values: (number | null)[][];
+  flags: (string | null)[][];
+}
+
+export interface LabAlert {
+  id: number;
+  patient_id: number;
+  patient_name: string;
+  test_definition_id: number;
+  test_name: string;
+  category: string;
+  unit: string;
+  collection_date: string;
+  value: number;
+  flag: string;
+}
+
 export interface LabResultCreate {
   patient_id: number;
   test_definition_id: number;
@@ -134,3 +162,12 @@ export interface PatientDashboardData {
   anthropometryEntries: AnthropometryEntry[];
   subjectiveEntries: SubjectiveEntry[];
 }
+
+export interface PatientDashboard {
+  patient: Patient;
+  lab_definitions: LabTestDefinition[];
+  lab_results: LabResult[];
+  bioimpedance_entries: BioimpedanceEntry[];
+  anthropometry_entries: AnthropometryEntry[];
+  subjective_entries: SubjectiveEntry[];
+}